@@ -0,0 +1,404 @@
+import argparse, asyncio, hashlib, json, os, sqlite3, statistics, sys, threading, time
+from collections import Counter
+from cache import cache_key
+from batch import load_prompts
+import custom_prompts
+
+# Stages of `PromptOptimizer` whose model is recorded with every run
+OPTIMIZER_STAGES = ("questions", "refinement", "critique")
+
+# Recorded outcome of every prompt of a run
+RESULT_COLUMNS = (
+    "request_id", "prompt_hash", "original_score", "optimized_score", "score_difference", "latency",
+    "calls", "prompt_tokens", "completion_tokens", "cost", "optimized_prompt", "error",
+)
+
+
+class Dataset:
+    """
+    Versioned set of prompts for A/B runs.
+
+    The version is derived from the content, so editing, adding or removing a prompt yields a
+    new version while a copied or renamed file keeps its own.
+
+    Args:
+        name (str): Name of the dataset.
+        prompts (list): `(request_id, prompt)` tuples.
+    """
+
+    def __init__(self, name, prompts):
+        counts = Counter(request_id for request_id, _ in prompts)
+        duplicates = sorted(request_id for request_id, count in counts.items() if count > 1)
+        if duplicates:
+            raise ValueError(f"Duplicate request ids in dataset {name!r}: {duplicates}")
+        self.name = name
+        self.prompts = list(prompts)
+        self.version = cache_key(self.prompts)[:12]
+
+    @classmethod
+    def load(cls, path, name=None):
+        """
+        Reads a JSONL dataset, see `batch.load_prompts`. The name defaults to the file name
+        without its extension.
+        """
+        return cls(name or os.path.splitext(os.path.basename(path))[0], list(load_prompts(path)))
+
+
+def run_configuration(optimizer):
+    """
+    Describes what a run of `optimizer` depends on, so that reports can tell which
+    templates or models changed between two runs.
+
+    Returns:
+        dict: The model of every optimizer stage, the critique escalation and a short hash
+        of every template of `custom_prompts`.
+    """
+    templates = {
+        name: hashlib.sha256(template.encode("utf-8")).hexdigest()[:12]
+        for name, template in sorted(vars(custom_prompts).items())
+        if not name.startswith("_") and isinstance(template, str)
+    }
+    return {
+        "models": {stage: optimizer.router.model_name(stage, optimizer.model_name) for stage in OPTIMIZER_STAGES},
+        "escalation": optimizer.router.escalation.get("critique"),
+        "templates": templates,
+    }
+
+
+class ResultStore:
+    """
+    SQLite database of A/B runs: one row per run with its dataset version and configuration,
+    one row per prompt with its scores, latency, tokens and cost.
+
+    Args:
+        path (str): Path of the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "run_id INTEGER PRIMARY KEY AUTOINCREMENT, label TEXT, dataset TEXT NOT NULL, "
+                "dataset_version TEXT NOT NULL, configuration TEXT NOT NULL, started_at REAL NOT NULL, "
+                "finished_at REAL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "run_id INTEGER NOT NULL REFERENCES runs (run_id), request_id TEXT NOT NULL, "
+                "prompt_hash TEXT NOT NULL, original_score REAL, optimized_score REAL, score_difference REAL, "
+                "latency REAL, calls INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, cost REAL, "
+                "optimized_prompt TEXT, error TEXT, PRIMARY KEY (run_id, request_id))"
+            )
+
+    def start_run(self, dataset, configuration, label=None):
+        """Records a new run of `dataset` and returns its id."""
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO runs (label, dataset, dataset_version, configuration, started_at) VALUES (?, ?, ?, ?, ?)",
+                (label, dataset.name, dataset.version, json.dumps(configuration), time.time()),
+            )
+            return cursor.lastrowid
+
+    def add_result(self, run_id, result):
+        """Records the outcome of one prompt, a row of `run_ab_suite`."""
+        columns = ("run_id", *RESULT_COLUMNS)
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO results ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                (run_id, *(result.get(column) for column in RESULT_COLUMNS)),
+            )
+
+    def finish_run(self, run_id):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE runs SET finished_at = ? WHERE run_id = ?", (time.time(), run_id))
+
+    def runs(self, dataset=None):
+        """Returns the runs, optionally of one dataset only, oldest first."""
+        query = "SELECT run_id, label, dataset, dataset_version, configuration, started_at, finished_at FROM runs"
+        parameters = ()
+        if dataset is not None:
+            query += " WHERE dataset = ?"
+            parameters = (dataset,)
+        with self._lock:
+            rows = self._connection.execute(query + " ORDER BY run_id", parameters).fetchall()
+        return [
+            {
+                "run_id": run_id, "label": label, "dataset": name, "dataset_version": version,
+                "configuration": json.loads(configuration), "started_at": started_at, "finished_at": finished_at,
+            }
+            for run_id, label, name, version, configuration, started_at, finished_at in rows
+        ]
+
+    def run(self, run_id):
+        """Returns the run `run_id`, or raises KeyError."""
+        for run in self.runs():
+            if run["run_id"] == run_id:
+                return run
+        raise KeyError(f"Unknown run {run_id}")
+
+    def results(self, run_id):
+        """Returns the rows of a run, by request id."""
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT {', '.join(RESULT_COLUMNS)} FROM results WHERE run_id = ?", (run_id,)
+            ).fetchall()
+        return {row[0]: dict(zip(RESULT_COLUMNS, row)) for row in rows}
+
+    def close(self):
+        self._connection.close()
+
+
+async def _run_prompt(optimizer, request_id, prompt, semaphore, answers, ensemble):
+    row = {"request_id": request_id, "prompt_hash": cache_key(prompt)[:12]}
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            result = await optimizer.aoptimize_and_benchmark(prompt, answers=answers, ensemble=ensemble)
+        except Exception as e:
+            row.update(latency=time.perf_counter() - start, error=f"{type(e).__name__}: {e}")
+            return row
+    metrics = result["metrics"]
+    row.update(
+        original_score=result["original_critique_result_score"],
+        optimized_score=result["optimized_critique_result_score"],
+        score_difference=result["score_difference"],
+        latency=time.perf_counter() - start,
+        calls=metrics["calls"],
+        prompt_tokens=metrics["prompt_tokens"],
+        completion_tokens=metrics["completion_tokens"],
+        cost=metrics["cost"],
+        optimized_prompt=result["optimized_prompt"],
+    )
+    return row
+
+
+async def arun_ab_suite(dataset, store, optimizer=None, concurrency=8, answers="skip", ensemble=None, label=None):
+    """
+    Runs `optimize_and_benchmark` over every prompt of `dataset`, up to `concurrency` at a time,
+    and records each original-vs-optimized pair in `store` as soon as it finishes.
+
+    Args:
+        dataset (Dataset): The prompts to run.
+        store (ResultStore): Where the run and its results are recorded.
+        optimizer (PromptOptimizer, optional): Defaults to the process-wide optimizer.
+        concurrency (int): Number of prompts processed at the same time.
+        answers: Answers the clarifying questions, see `optimize_prompt`. Skipped by default.
+        ensemble (dict, optional): Use ensemble critiques, see `optimize_and_benchmark`.
+        label (str, optional): Free-form label of the run, e.g. a branch or commit.
+
+    Returns:
+        int: The id of the run.
+    """
+    if optimizer is None:
+        from main import get_default_optimizer
+        optimizer = get_default_optimizer()
+    run_id = store.start_run(dataset, run_configuration(optimizer), label=label)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_and_store(request_id, prompt):
+        store.add_result(run_id, await _run_prompt(optimizer, request_id, prompt, semaphore, answers, ensemble))
+
+    await asyncio.gather(*(run_and_store(request_id, prompt) for request_id, prompt in dataset.prompts))
+    store.finish_run(run_id)
+    return run_id
+
+
+def run_ab_suite(dataset, store, **options):
+    """
+    Synchronous entry point of `arun_ab_suite`, see its arguments.
+    """
+    return asyncio.run(arun_ab_suite(dataset, store, **options))
+
+
+def _summary(rows):
+    # Aggregates of the successful rows of a run
+    ok = [row for row in rows if not row["error"]]
+    costs = [row["cost"] for row in ok if row["cost"] is not None]
+    return {
+        "prompts": len(rows),
+        "errors": len(rows) - len(ok),
+        "mean_score_difference": statistics.fmean(row["score_difference"] for row in ok) if ok else None,
+        "mean_optimized_score": statistics.fmean(row["optimized_score"] for row in ok) if ok else None,
+        "median_latency": statistics.median(row["latency"] for row in ok) if ok else None,
+        "tokens": sum(row["prompt_tokens"] + row["completion_tokens"] for row in ok),
+        "cost": sum(costs) if costs else None,
+    }
+
+
+def _relative_change(base, head):
+    if base is None or head is None or base == 0:
+        return None
+    return (head - base) / base
+
+
+def compare_runs(store, base_run_id, head_run_id, score_tolerance=0.05, latency_tolerance=0.25, cost_tolerance=0.1,
+                 token_tolerance=0.1):
+    """
+    Compares two runs prompt by prompt. Only the prompts present in both runs with the same
+    text are compared, so runs of different dataset versions can still be compared on what
+    they share.
+
+    A prompt regresses when its score difference drops by more than `score_tolerance`, when its
+    latency, cost or token count grows by more than `latency_tolerance`, `cost_tolerance` or
+    `token_tolerance` (relative changes; the cost is unknown for unpriced models), or when it
+    fails in the head run only.
+
+    Args:
+        store (ResultStore): The database holding both runs.
+        base_run_id (int): The reference run.
+        head_run_id (int): The run under evaluation.
+
+    Returns:
+        dict: Both runs, the templates and models that changed, the summary of each run over
+        the compared prompts, a row per compared prompt and the list of regressions.
+    """
+    base_run, head_run = store.run(base_run_id), store.run(head_run_id)
+    base_results, head_results = store.results(base_run_id), store.results(head_run_id)
+    shared = [
+        request_id for request_id, row in head_results.items()
+        if request_id in base_results and base_results[request_id]["prompt_hash"] == row["prompt_hash"]
+    ]
+
+    prompts = []
+    regressions = []
+    for request_id in sorted(shared):
+        base, head = base_results[request_id], head_results[request_id]
+        row = {"request_id": request_id, "reasons": []}
+        if head["error"] and not base["error"]:
+            row["reasons"].append(f"error: {head['error']}")
+        elif not head["error"] and not base["error"]:
+            base_tokens = base["prompt_tokens"] + base["completion_tokens"]
+            head_tokens = head["prompt_tokens"] + head["completion_tokens"]
+            row.update(
+                score_delta=head["score_difference"] - base["score_difference"],
+                latency_change=_relative_change(base["latency"], head["latency"]),
+                token_change=_relative_change(base_tokens, head_tokens),
+                cost_change=_relative_change(base["cost"], head["cost"]),
+            )
+            if row["score_delta"] < -score_tolerance:
+                row["reasons"].append(f"score difference {row['score_delta']:+.3f}")
+            if row["latency_change"] is not None and row["latency_change"] > latency_tolerance:
+                row["reasons"].append(f"latency {row['latency_change']:+.0%}")
+            if row["cost_change"] is not None and row["cost_change"] > cost_tolerance:
+                row["reasons"].append(f"cost {row['cost_change']:+.0%}")
+            if row["token_change"] is not None and row["token_change"] > token_tolerance:
+                row["reasons"].append(f"tokens {row['token_change']:+.0%}")
+        prompts.append(row)
+        if row["reasons"]:
+            regressions.append(row)
+
+    base_configuration, head_configuration = base_run["configuration"], head_run["configuration"]
+    return {
+        "base": {key: base_run[key] for key in ("run_id", "label", "dataset", "dataset_version")},
+        "head": {key: head_run[key] for key in ("run_id", "label", "dataset", "dataset_version")},
+        "changed_templates": sorted(
+            name for name in set(base_configuration["templates"]) | set(head_configuration["templates"])
+            if base_configuration["templates"].get(name) != head_configuration["templates"].get(name)
+        ),
+        "changed_models": {
+            stage: [base_configuration["models"].get(stage), head_configuration["models"].get(stage)]
+            for stage in OPTIMIZER_STAGES
+            if base_configuration["models"].get(stage) != head_configuration["models"].get(stage)
+        },
+        "compared_prompts": len(shared),
+        "summary": {
+            "base": _summary([base_results[request_id] for request_id in shared]),
+            "head": _summary([head_results[request_id] for request_id in shared]),
+        },
+        "prompts": prompts,
+        "regressions": regressions,
+    }
+
+
+def format_report(report):
+    """
+    Renders a `compare_runs` report as plain text.
+    """
+    def describe(run):
+        return f"run {run['run_id']}" + (f" ({run['label']})" if run["label"] else "") + f", {run['dataset']}@{run['dataset_version']}"
+
+    lines = [
+        f"Base: {describe(report['base'])}",
+        f"Head: {describe(report['head'])}",
+        f"Changed templates: {', '.join(report['changed_templates']) or 'none'}",
+        "Changed models: " + (
+            ", ".join(f"{stage} {base} -> {head}" for stage, (base, head) in report["changed_models"].items()) or "none"
+        ),
+        f"Compared prompts: {report['compared_prompts']}",
+        "",
+        f"{'':24}{'base':>14}{'head':>14}",
+    ]
+    for key in ("errors", "mean_score_difference", "mean_optimized_score", "median_latency", "tokens", "cost"):
+        base, head = report["summary"]["base"][key], report["summary"]["head"][key]
+        lines.append(f"{key:24}{_format_value(base):>14}{_format_value(head):>14}")
+    lines.append("")
+    lines.append(f"Regressions: {len(report['regressions'])}")
+    for row in report["regressions"]:
+        lines.append(f"  {row['request_id']}: {'; '.join(row['reasons'])}")
+    return "\n".join(lines)
+
+
+def _format_value(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.4f}"
+    return str(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A/B benchmark suite of original vs optimized prompts.")
+    parser.add_argument("--db", default="ab_results.db", help="SQLite database of the runs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run a dataset and record the results")
+    run_parser.add_argument("dataset", help="JSONL file with one prompt per line")
+    run_parser.add_argument("--name", help="Dataset name, defaults to the file name")
+    run_parser.add_argument("--label", help="Label of the run, e.g. a branch or commit")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--ensemble", action="store_true", help="Use ensemble critiques")
+    run_parser.add_argument("--fake", action="store_true", help="Use the offline fake model backend")
+
+    report_parser = commands.add_parser("report", help="Compare two runs, by default the last two of a dataset")
+    report_parser.add_argument("--dataset", help="Dataset whose last two runs are compared")
+    report_parser.add_argument("--base", type=int, help="Id of the reference run")
+    report_parser.add_argument("--head", type=int, help="Id of the run under evaluation")
+    report_parser.add_argument("--score-tolerance", type=float, default=0.05)
+    report_parser.add_argument("--latency-tolerance", type=float, default=0.25)
+    report_parser.add_argument("--cost-tolerance", type=float, default=0.1)
+    report_parser.add_argument("--token-tolerance", type=float, default=0.1)
+    report_parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    report_parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 on regressions")
+
+    commands.add_parser("runs", help="List the recorded runs")
+    args = parser.parse_args()
+
+    store = ResultStore(args.db)
+    if args.command == "run":
+        if args.fake:
+            os.environ["PROMPT_OPTIMIZER_BACKEND"] = "fake"
+        dataset = Dataset.load(args.dataset, name=args.name)
+        run_id = run_ab_suite(
+            dataset, store, concurrency=args.concurrency, ensemble={} if args.ensemble else None, label=args.label
+        )
+        print(json.dumps({"run_id": run_id, **_summary(list(store.results(run_id).values()))}, indent=4))
+    elif args.command == "report":
+        base, head = args.base, args.head
+        if base is None or head is None:
+            runs = [run["run_id"] for run in store.runs(args.dataset)]
+            if len(runs) < 2:
+                sys.exit("Need two runs to compare, pass --base and --head or run the dataset again.")
+            base, head = runs[-2:]
+        report = compare_runs(
+            store, base, head, score_tolerance=args.score_tolerance, latency_tolerance=args.latency_tolerance,
+            cost_tolerance=args.cost_tolerance, token_tolerance=args.token_tolerance,
+        )
+        print(json.dumps(report, indent=4) if args.json else format_report(report))
+        if args.fail_on_regression and report["regressions"]:
+            sys.exit(1)
+    else:
+        for run in store.runs():
+            print(f"{run['run_id']}\t{run['label'] or ''}\t{run['dataset']}@{run['dataset_version']}")
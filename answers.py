@@ -0,0 +1,181 @@
+import asyncio, inspect
+from abc import ABC, abstractmethod
+from langchain_core.prompts import ChatPromptTemplate
+from custom_prompts import simulated_user_system_prompt, simulated_user_request
+from metrics import chain_config
+from ratelimit import scheduled_invoke, scheduled_ainvoke
+
+
+class AnswerProvider(ABC):
+    """
+    Answers the clarifying questions asked by `optimize_prompt`.
+
+    Subclasses implement `answer`, which receives all the questions about a prompt at once
+    and returns one answer per question. An empty answer means the question was skipped.
+    The `recorder` of the optimization is given too, for providers making LLM calls.
+    """
+
+    @abstractmethod
+    def answer(self, prompt_to_optimize, questions, recorder=None):
+        """Returns one answer per question."""
+
+    async def aanswer(self, prompt_to_optimize, questions, recorder=None):
+        """Async version of `answer`. By default runs `answer` in a worker thread."""
+        return await asyncio.to_thread(self.answer, prompt_to_optimize, questions, recorder)
+
+
+class CommandLineAnswers(AnswerProvider):
+    """
+    Asks the user on the command line, one question at a time. This is the interactive default.
+    """
+
+    def answer(self, prompt_to_optimize, questions, recorder=None):
+        return [input(f"Answer to '{question}': ") for question in questions]
+
+
+class SkipAnswers(AnswerProvider):
+    """
+    Leaves every question unanswered, for headless runs.
+    """
+
+    def answer(self, prompt_to_optimize, questions, recorder=None):
+        return ["" for _ in questions]
+
+    async def aanswer(self, prompt_to_optimize, questions, recorder=None):
+        return self.answer(prompt_to_optimize, questions, recorder)
+
+
+class DictAnswers(AnswerProvider):
+    """
+    Answers from a precomputed mapping of question to answer.
+
+    Args:
+        answers (dict): Maps each known question to its answer.
+        default (str): Answer used for questions missing from the mapping.
+    """
+
+    def __init__(self, answers, default=""):
+        self.answers = answers
+        self.default = default
+
+    def answer(self, prompt_to_optimize, questions, recorder=None):
+        return [self.answers.get(question, self.default) for question in questions]
+
+    async def aanswer(self, prompt_to_optimize, questions, recorder=None):
+        return self.answer(prompt_to_optimize, questions, recorder)
+
+
+class CallableAnswers(AnswerProvider):
+    """
+    Answers each question by calling a function with the question.
+
+    Args:
+        function (callable): Takes a question and returns its answer. In the async code path it
+            may also be a coroutine function.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def answer(self, prompt_to_optimize, questions, recorder=None):
+        return [self.function(question) for question in questions]
+
+    async def aanswer(self, prompt_to_optimize, questions, recorder=None):
+        answers = []
+        for question in questions:
+            answer = self.function(question)
+            if inspect.isawaitable(answer):
+                answer = await answer
+            answers.append(answer)
+        return answers
+
+
+class SimulatedUserAnswers(AnswerProvider):
+    """
+    Lets an LLM play the user who wrote the prompt.
+
+    All the questions about a prompt are answered with a single structured call, made through
+    the rate limit scheduler like the optimizer's own calls.
+
+    Args:
+        model: The chat model simulating the user, e.g. a `ChatOpenAI` instance.
+        scheduler (ratelimit.RateLimitScheduler, optional): Shared scheduler the calls go through,
+            usually the optimizer's. Calls are made directly without it.
+        recorder (metrics.MetricsRecorder, optional): Records the calls under the "simulated_user" stage,
+            when the optimization gives no recorder of its own.
+    """
+
+    # Define JSON schema
+    json_schema = {
+        "title": "simulatedAnswers",
+        "description": "Answers to the clarifying questions, as the user would give them",
+        "type": "object",
+        "properties": {
+            "answers": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "One answer per question, in the same order as the questions",
+            },
+        },
+        "required": ["answers"],
+    }
+
+    def __init__(self, model, scheduler=None, recorder=None):
+        self.chain = ChatPromptTemplate.from_messages(
+            [("system", simulated_user_system_prompt), ("user", simulated_user_request)]
+        ) | model.with_structured_output(self.json_schema)
+        self.scheduler = scheduler
+        self.recorder = recorder
+
+    def _inputs(self, prompt_to_optimize, questions):
+        return {
+            "prompt_to_optimize": prompt_to_optimize,
+            "clarifying_questions": "\n".join(f"{i}. {question}" for i, question in enumerate(questions, start=1)),
+        }
+
+    @staticmethod
+    def _align(answers, questions):
+        # The model may return too few or too many answers
+        return (list(answers) + [""] * len(questions))[:len(questions)]
+
+    def answer(self, prompt_to_optimize, questions, recorder=None):
+        if not questions:
+            return []
+        response = scheduled_invoke(
+            self.scheduler, self.chain, self._inputs(prompt_to_optimize, questions),
+            chain_config(recorder if recorder is not None else self.recorder, "simulated_user"),
+        )
+        return self._align(response["answers"], questions)
+
+    async def aanswer(self, prompt_to_optimize, questions, recorder=None):
+        if not questions:
+            return []
+        response = await scheduled_ainvoke(
+            self.scheduler, self.chain, self._inputs(prompt_to_optimize, questions),
+            chain_config(recorder if recorder is not None else self.recorder, "simulated_user"),
+        )
+        return self._align(response["answers"], questions)
+
+
+def resolve_answer_provider(answers):
+    """
+    Turns the `answers` argument of `optimize_prompt` into an `AnswerProvider`.
+
+    Args:
+        answers: None (ask on the command line), "skip", a dict of question to answer,
+            a function called with each question, or an `AnswerProvider`.
+
+    Returns:
+        AnswerProvider: The matching provider.
+    """
+    if answers is None:
+        return CommandLineAnswers()
+    if isinstance(answers, AnswerProvider):
+        return answers
+    if answers == "skip":
+        return SkipAnswers()
+    if isinstance(answers, dict):
+        return DictAnswers(answers)
+    if callable(answers):
+        return CallableAnswers(answers)
+    raise ValueError(f"Unsupported answers argument: {answers!r}")
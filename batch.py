@@ -0,0 +1,172 @@
+import argparse, json, os, threading
+from concurrent.futures import ThreadPoolExecutor
+from main import PromptOptimizer, optimize_and_benchmark, get_default_optimizer, set_default_optimizer
+from answers import SimulatedUserAnswers
+from near_duplicates import NearDuplicateIndex
+from ratelimit import BATCH, RateLimitScheduler, priority
+
+
+def load_prompts(input_path):
+    """
+    Reads a JSONL corpus of prompts.
+
+    Each line is a JSON object with a `request_id` and the prompt text, taken from
+    `prompt` or, for files shaped like `requests.jsonl`, from `body`.
+
+    Args:
+        input_path (str): Path to the JSONL file.
+
+    Yields:
+        tuple: `(request_id, prompt)` for every non-empty line.
+    """
+    with open(input_path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            prompt = record.get("prompt") or record.get("body")
+            if "request_id" not in record or not prompt:
+                raise ValueError(f"{input_path}:{line_number}: expected 'request_id' and 'prompt' (or 'body').")
+            yield record["request_id"], prompt
+
+
+def completed_request_ids(output_path):
+    """
+    Returns the ids that already have a successful result in `output_path`.
+
+    A truncated last line (e.g. after the process was killed mid-write) is ignored,
+    so the matching prompt is simply processed again.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("status") == "ok":
+                done.add(record["request_id"])
+    return done
+
+
+def _drop_partial_line(output_path):
+    """
+    Truncates `output_path` after its last complete line, so that records appended on resume
+    do not start on the fragment a crash left behind.
+    """
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            f.truncate(content.rfind(b"\n") + 1)
+
+
+def run_batch(input_path, output_path, max_workers=8, resume=True, answers="skip"):
+    """
+    Runs `optimize_and_benchmark` over every prompt of a JSONL corpus.
+
+    Prompts are fanned out over a bounded thread pool and each result is appended to
+    `output_path` as soon as it finishes, so a partial run is never lost. With `resume`,
+    prompts that already have a successful result in `output_path` are skipped and
+    failed ones are retried.
+
+    Args:
+        input_path (str): JSONL file of prompts, see `load_prompts`.
+        output_path (str): JSONL file the results are streamed to.
+        max_workers (int): Number of prompts processed concurrently.
+        resume (bool): Skip prompts already completed in `output_path`.
+        answers: Answers the clarifying questions, see `optimize_prompt`. Skipped by default.
+
+    Returns:
+        dict: Counts of `ok`, `error` and `skipped` prompts.
+    """
+    done = completed_request_ids(output_path) if resume else set()
+    if resume:
+        _drop_partial_line(output_path)
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+    write_lock = threading.Lock()
+    write_errors = []
+    # Bound the number of submitted prompts so large corpora are not loaded in memory at once
+    in_flight = threading.BoundedSemaphore(max_workers * 2)
+
+    def process(request_id, prompt):
+        try:
+            # Interactive callers sharing the rate limit scheduler go first
+            with priority(BATCH):
+                result = optimize_and_benchmark(prompt, answers=answers)
+            return {"request_id": request_id, "status": "ok", "result": result}
+        except Exception as e:
+            return {"request_id": request_id, "status": "error", "error": f"{type(e).__name__}: {e}"}
+        finally:
+            in_flight.release()
+
+    def write(future):
+        # Runs as a done callback, whose exceptions the executor would swallow: they are kept
+        # and raised by the main thread instead
+        try:
+            record = future.result()
+            with write_lock:
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                counts[record["status"]] += 1
+        except BaseException as e:
+            write_errors.append(e)
+
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for request_id, prompt in load_prompts(input_path):
+            if write_errors:
+                break
+            if request_id in done:
+                counts["skipped"] += 1
+                continue
+            in_flight.acquire()
+            future = executor.submit(process, request_id, prompt)
+            future.add_done_callback(write)
+
+    if write_errors:
+        raise write_errors[0]
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimize and benchmark a JSONL corpus of prompts.")
+    parser.add_argument("input_path", help="JSONL file with one prompt per line")
+    parser.add_argument("output_path", help="JSONL file where results are streamed")
+    parser.add_argument("--workers", type=int, default=8, help="Number of prompts processed concurrently")
+    parser.add_argument("--simulate-user", action="store_true", help="Let an LLM answer the clarifying questions")
+    parser.add_argument("--rpm", type=int, help="Requests per minute quota shared by all workers")
+    parser.add_argument("--tpm", type=int, help="Tokens per minute quota shared by all workers")
+    parser.add_argument("--no-resume", action="store_true", help="Start over instead of skipping completed prompts")
+    parser.add_argument(
+        "--speculate", action="store_true",
+        help="Refine each prompt while its questions are generated, kept when the answers are blank"
+    )
+    parser.add_argument(
+        "--near-duplicates", type=float, metavar="THRESHOLD",
+        help="Seed the optimization of prompts at least this similar (0 to 1) to an optimized one"
+    )
+    args = parser.parse_args()
+
+    if args.rpm or args.tpm or args.speculate or args.near_duplicates is not None:
+        scheduler = None
+        if args.rpm or args.tpm:
+            scheduler = RateLimitScheduler(
+                requests_per_minute=args.rpm or 500, tokens_per_minute=args.tpm or 200_000
+            )
+        prompt_index = None
+        if args.near_duplicates is not None:
+            prompt_index = NearDuplicateIndex(threshold=args.near_duplicates)
+        set_default_optimizer(PromptOptimizer(
+            scheduler=scheduler, speculative_refinement=args.speculate, prompt_index=prompt_index
+        ))
+    optimizer = get_default_optimizer()
+    answers = SimulatedUserAnswers(optimizer.model, scheduler=optimizer.scheduler) if args.simulate_user else "skip"
+    counts = run_batch(
+        args.input_path, args.output_path, max_workers=args.workers, resume=not args.no_resume, answers=answers
+    )
+    print(json.dumps(counts, indent=4))
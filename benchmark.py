@@ -0,0 +1,104 @@
+import argparse, json, math, time
+from concurrent.futures import ThreadPoolExecutor
+from fake_llm import FakeChatModel
+from main import PromptOptimizer
+import gan_feedback_loop, gan_chain_of_thoughts
+
+TARGETS = ("optimize_and_benchmark", "gan_feedback_loop", "gan_chain_of_thoughts")
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile of `values` (e.g. `fraction=0.95` for p95).
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def make_job(target, model):
+    """
+    Returns a function running one `target` workload on `model`, taking the prompt as argument.
+    """
+    if target == "optimize_and_benchmark":
+        optimizer = PromptOptimizer(llm=model)
+        return lambda prompt: optimizer.optimize_and_benchmark(prompt, answers="skip")
+    if target == "gan_feedback_loop":
+        critic = model.with_structured_output(gan_feedback_loop.json_schema)
+        return lambda prompt: gan_feedback_loop.gan_feedback_loop(
+            model, critic, prompt, min_score=85, max_attempts=6, stagnation_threshold=3
+        )
+    if target == "gan_chain_of_thoughts":
+        critic = model.with_structured_output(gan_chain_of_thoughts.json_schema)
+        return lambda prompt: gan_chain_of_thoughts.gan_feedback_loop(
+            model, critic, prompt, min_score=85, max_attempts=4, stagnation_threshold=3
+        )
+    raise ValueError(f"Unknown target {target!r}, expected one of {TARGETS}.")
+
+
+def run_benchmark(target, concurrency, requests=32, latency=0.05, jitter=0.02, error_rate=0.0, seed=0):
+    """
+    Runs `requests` workloads of `target` against a `FakeChatModel` with `concurrency` workers.
+
+    Args:
+        target (str): One of `TARGETS`.
+        concurrency (int): Number of workloads running at the same time.
+        requests (int): Number of workloads to run.
+        latency (float): Simulated mean latency of an LLM call, in seconds.
+        jitter (float): Maximum deviation from `latency`, in seconds.
+        error_rate (float): Probability that an LLM call fails.
+        seed (int): Seed of the simulated latencies and errors.
+
+    Returns:
+        dict: Throughput (results per second), p50/p95/p99 latency of a workload in seconds,
+        LLM calls per successful result and the number of failed workloads.
+    """
+    model = FakeChatModel(latency=latency, jitter=jitter, error_rate=error_rate, seed=seed)
+    job = make_job(target, model)
+
+    def timed(prompt):
+        start = time.perf_counter()
+        try:
+            job(prompt)
+            return time.perf_counter() - start, True
+        except Exception:
+            return time.perf_counter() - start, False
+
+    prompts = [f"Benchmark prompt #{i}: write a short article about topic {i}." for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, prompts))
+    elapsed = time.perf_counter() - start
+
+    latencies = [duration for duration, ok in outcomes if ok]
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": requests - len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "calls_per_result": model.calls / len(latencies) if latencies else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure orchestration overhead against an offline fake LLM.")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated LLM latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Maximum latency deviation in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a simulated LLM error")
+    args = parser.parse_args()
+
+    for target in args.targets:
+        for concurrency in args.concurrency:
+            report = run_benchmark(
+                target, concurrency, requests=args.requests, latency=args.latency,
+                jitter=args.jitter, error_rate=args.error_rate,
+            )
+            print(json.dumps(report))
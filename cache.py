@@ -0,0 +1,209 @@
+import hashlib, json, sqlite3, threading, time
+from collections import OrderedDict
+
+
+def cache_key(*parts):
+    """
+    Builds a content-addressed cache key from JSON-serializable parts.
+
+    Args:
+        *parts: Everything the cached response depends on, e.g. model name, prompt templates,
+            output schema and the chain inputs.
+
+    Returns:
+        str: A hex SHA-256 digest of the parts.
+    """
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """
+    In-memory LRU cache with an optional time-to-live.
+
+    Args:
+        max_entries (int): Number of entries kept before the least recently used one is evicted.
+        ttl (float, optional): Seconds after which an entry expires. Entries never expire if None.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Stores `value` under `key`, evicting the least recently used entries if needed."""
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Returns the hit/miss counters and the current size."""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
+class SQLiteCache:
+    """
+    Persistent cache stored in a SQLite database, with an optional time-to-live.
+
+    Values must be JSON-serializable. When the cache grows past `max_entries`, the least
+    recently used entries are evicted. The number of entries is counted once when the cache is
+    opened and then kept up to date, so that a write only scans the table when it has to evict.
+
+    Args:
+        path (str): Path of the SQLite database file.
+        max_entries (int): Number of entries kept on disk.
+        ttl (float, optional): Seconds after which an entry expires. Entries never expire if None.
+    """
+
+    def __init__(self, path, max_entries=100_000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+            self._size = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None on a miss."""
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        """Stores `value` under `key`, evicting the least recently used entries if needed."""
+        now = time.time()
+        with self._lock, self._connection:
+            exists = self._connection.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            if exists is None:
+                self._size += 1
+            if self.ttl is not None:
+                self._size -= self._connection.execute(
+                    "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+                ).rowcount
+            if self._size > self.max_entries:
+                # Recount first, other processes may share the database
+                self._size = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                excess = self._size - self.max_entries
+                if excess > 0:
+                    self._connection.execute(
+                        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                        (excess,),
+                    )
+                    self._size -= excess
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses")
+            self._size = 0
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self):
+        """Returns the hit/miss counters and the current size."""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
+class TieredCache:
+    """
+    Two-tier cache: a fast in-memory LRU in front of a persistent on-disk cache.
+
+    Lookups try the memory tier first, then the disk tier; disk hits are promoted to memory.
+    Writes go to both tiers.
+
+    Args:
+        memory (MemoryCache): The in-memory tier.
+        disk (SQLiteCache, optional): The persistent tier.
+    """
+
+    def __init__(self, memory=None, disk=None):
+        self.memory = memory if memory is not None else MemoryCache()
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None on a miss."""
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        """Returns the overall hit/miss counters and the counters of each tier."""
+        stats = {"hits": self.hits, "misses": self.misses, "memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
@@ -0,0 +1,37 @@
+import json, os, tempfile
+
+
+def save_checkpoint(path, data):
+    """
+    Writes `data` as JSON to `path` atomically: the file is written next to its destination and
+    then renamed over it, so that a crash never leaves a truncated checkpoint behind.
+
+    Args:
+        path (str): The checkpoint file.
+        data (dict): JSON-serializable checkpoint.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".checkpoint-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def load_checkpoint(path):
+    """
+    Reads a checkpoint written by `save_checkpoint`.
+
+    Args:
+        path (str): The checkpoint file.
+
+    Returns:
+        dict: The checkpoint data.
+    """
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,83 @@
+import hashlib
+from sections import split_sections, join_sections
+from tokens import count_tokens
+
+# Prepended to every chunk sent for critique. It does not depend on the position of the chunk,
+# so that an unchanged chunk keeps its cache key when the content around it changes.
+CHUNK_HEADER = "The text below is one part of a longer content. Critique it on its own merits:\n\n"
+
+
+def _ends_chunk(section, tokens, target_tokens):
+    # A chunk ends after a section with a probability proportional to its size, drawn from a hash
+    # of its text alone, so that chunks average about `target_tokens` and a boundary only moves
+    # when the section before it changes
+    digest = int.from_bytes(hashlib.blake2b(section.encode("utf-8"), digest_size=8).digest(), "big")
+    return digest < min(1.0, tokens / target_tokens) * 2 ** 64
+
+
+def chunk_content(content, max_tokens, model="gpt-4o-mini"):
+    """
+    Splits content into chunks of at most about `max_tokens` tokens, made of whole sections
+    (blocks separated by blank lines, see `sections.split_sections`). A section longer than
+    `max_tokens` makes a chunk of its own.
+
+    The boundaries are content-defined: whether a chunk ends after a section depends on that
+    section only (and on the `max_tokens` cap), so editing, inserting or deleting a section
+    changes its own chunk and at most its neighbours, and the other chunks keep their cache keys.
+
+    Args:
+        content (str): The text to split.
+        max_tokens (int): Token budget of a chunk.
+        model (str): The model whose tokenizer is used.
+
+    Returns:
+        list: The chunks, in order. A single chunk if the content fits the budget.
+    """
+    sections = split_sections(content)
+    tokens = [count_tokens(section, model) for section in sections]
+    if sum(tokens) <= max_tokens:
+        return [join_sections(sections)] if sections else []
+    chunks = []
+    current, current_tokens = [], 0
+    for section, section_tokens in zip(sections, tokens):
+        if current and current_tokens + section_tokens > max_tokens:
+            chunks.append(join_sections(current))
+            current, current_tokens = [], 0
+        current.append(section)
+        current_tokens += section_tokens
+        if _ends_chunk(section, section_tokens, max(1, max_tokens // 2)):
+            chunks.append(join_sections(current))
+            current, current_tokens = [], 0
+    if current:
+        chunks.append(join_sections(current))
+    return chunks
+
+
+def reduce_critiques(critiques, weights, text_key, score_key, list_keys=()):
+    """
+    Reduces the critiques of the chunks of a content into a critique of the whole content, in the
+    same schema: the texts are joined part by part, the scores averaged with the weight of their
+    chunk (e.g. its token count), and the lists concatenated without duplicates.
+
+    Args:
+        critiques (list): The critique dicts, in chunk order.
+        weights (list): The positive weight of each chunk.
+        text_key (str): Key of the critique text, e.g. "reasoning" or "Critique".
+        score_key (str): Key of the score, e.g. "score" or "Score". Integer scores stay integers.
+        list_keys (tuple): Keys of list values, e.g. ("FollowUpSuggestions",).
+
+    Returns:
+        dict: The reduced critique.
+    """
+    score = sum(critique[score_key] * weight for critique, weight in zip(critiques, weights)) / sum(weights)
+    if all(isinstance(critique[score_key], int) for critique in critiques):
+        score = round(score)
+    reduced = {
+        text_key: "\n\n".join(
+            f"Part {i} of {len(critiques)}: {critique[text_key]}" for i, critique in enumerate(critiques, start=1)
+        ),
+        score_key: score,
+    }
+    for key in list_keys:
+        reduced[key] = list(dict.fromkeys(item for critique in critiques for item in critique.get(key, [])))
+    return reduced
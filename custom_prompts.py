@@ -58,10 +58,9 @@ Ask any clarifying questions to gather the missing details. Once you have all th
 """
 
 
+# The instructions come first and the prompt last, so that every critique call starts with the
+# same static prefix and benefits from provider-side prompt caching
 prompt_critique_request = """
-Here is a prompt that needs evaluation and improvement:
-{current_prompt}
-
 Please:
 1. Critique the prompt based on clarity, completeness, actionability, optimization, and alignment.
 2. Suggest specific changes or additions to improve it.
@@ -88,6 +87,9 @@ Reasoning for Improvements:
 - Improved clarity and specificity.
 - Actionable and complete instructions.
 - Aligned with the likely user intent.
+
+Here is a prompt that needs evaluation and improvement:
+{current_prompt}
 """
 
 prompt_critique_system_prompt = """
@@ -117,4 +119,16 @@ Your output should include:
 - Suggestions for improvement.
 - An optimized version of the prompt.
 - A final rating (with reasoning behind the score).
-"""
\ No newline at end of file
+"""
+simulated_user_system_prompt = """
+You are simulating the user who wrote a prompt that is being optimized. An assistant asked you some clarifying questions about it.
+Answer every question briefly and plausibly, staying consistent with the intent of the original prompt. If the prompt gives no hint about the answer, choose the most common and sensible option.
+"""
+
+simulated_user_request = """
+Here is the prompt you wrote:
+{prompt_to_optimize}
+
+Answer these clarifying questions, in the same order:
+{clarifying_questions}
+"""
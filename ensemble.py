@@ -0,0 +1,157 @@
+import math, statistics
+
+def _incomplete_beta(a, b, x):
+    # Regularized incomplete beta function I_x(a, b), by its continued fraction (modified Lentz)
+    if x <= 0 or x >= 1:
+        return 0.0 if x <= 0 else 1.0
+    if x > (a + 1) / (a + b + 2):
+        return 1.0 - _incomplete_beta(b, a, 1.0 - x)
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x)) / a
+    tiny = 1e-300
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    result = d
+    for m in range(1, 300):
+        for numerator in (
+            m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+            -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1)),
+        ):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            result *= c * d
+        if abs(c * d - 1.0) < 1e-14:
+            break
+    return front * result
+
+
+def _t_tail(t, degrees_of_freedom):
+    # Two-sided tail probability P(|T| > t) of Student's t distribution, for t >= 0
+    return _incomplete_beta(degrees_of_freedom / 2, 0.5, degrees_of_freedom / (degrees_of_freedom + t * t))
+
+
+def critical_value(confidence, degrees_of_freedom):
+    """
+    Returns the two-sided critical value of Student's t distribution for a `confidence` interval
+    with `degrees_of_freedom`, which need not be an integer (see `welch_degrees_of_freedom`).
+    """
+    if not 0 < confidence < 1:
+        raise ValueError(f"confidence must be between 0 and 1, got {confidence}.")
+    if degrees_of_freedom <= 0:
+        raise ValueError(f"degrees_of_freedom must be positive, got {degrees_of_freedom}.")
+    # The tail decreases with t: bisect between the normal quantile, a lower bound, and an upper bound
+    low = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    high = low
+    while _t_tail(high, degrees_of_freedom) > 1 - confidence:
+        low, high = high, high * 2
+    for _ in range(100):
+        middle = (low + high) / 2
+        if _t_tail(middle, degrees_of_freedom) > 1 - confidence:
+            low = middle
+        else:
+            high = middle
+        if high - low < 1e-10 * high:
+            break
+    return (low + high) / 2
+
+
+def welch_degrees_of_freedom(before, after):
+    """
+    Returns the Welch–Satterthwaite degrees of freedom of the difference of the means of two
+    results of `score_statistics`.
+    """
+    before_term = before["variance"] / before["samples"]
+    after_term = after["variance"] / after["samples"]
+    denominator = before_term ** 2 / (before["samples"] - 1) + after_term ** 2 / (after["samples"] - 1)
+    if denominator == 0:
+        return before["samples"] + after["samples"] - 2
+    return (before_term + after_term) ** 2 / denominator
+
+
+def score_statistics(scores, confidence=0.95):
+    """
+    Summarizes a sample of critique scores.
+
+    Args:
+        scores (list): The sampled scores.
+        confidence (float): Confidence level of the interval.
+
+    Returns:
+        dict: The mean, the sample variance, the `confidence` interval of the mean (a `[low, high]`
+        list, unbounded with a single sample), its half width and the number of samples.
+    """
+    mean = statistics.fmean(scores)
+    variance = statistics.variance(scores) if len(scores) > 1 else 0.0
+    half_width = math.inf
+    if len(scores) > 1:
+        half_width = critical_value(confidence, len(scores) - 1) * math.sqrt(variance / len(scores))
+    return {
+        "mean": mean,
+        "variance": variance,
+        "ci": [mean - half_width, mean + half_width],
+        "half_width": half_width,
+        "samples": len(scores),
+    }
+
+
+def difference_interval(before, after, confidence=0.95):
+    """
+    Returns the `confidence` interval of `after["mean"] - before["mean"]` for two results of
+    `score_statistics`: Welch's interval, with Student's t critical value at the
+    Welch–Satterthwaite degrees of freedom.
+    """
+    difference = after["mean"] - before["mean"]
+    if before["samples"] < 2 or after["samples"] < 2:
+        return [-math.inf, math.inf]
+    standard_error = math.sqrt(before["variance"] / before["samples"] + after["variance"] / after["samples"])
+    half_width = critical_value(confidence, welch_degrees_of_freedom(before, after)) * standard_error
+    return [difference - half_width, difference + half_width]
+
+
+def _next_batch(scores, min_samples, max_samples, batch_size, tolerance, confidence):
+    # Returns how many more samples to draw, 0 once the interval is tight enough or the budget spent
+    if len(scores) < min_samples:
+        return min_samples - len(scores)
+    if len(scores) >= max_samples or score_statistics(scores, confidence)["half_width"] <= tolerance:
+        return 0
+    return min(batch_size, max_samples - len(scores))
+
+
+def sample_until_confident(sample, score_key, min_samples=3, max_samples=10, batch_size=2, tolerance=0.05,
+                           confidence=0.95):
+    """
+    Samples critiques in batches until the confidence interval of their mean score is tight enough.
+
+    Args:
+        sample (callable): Function taking a number of samples and returning that many critique
+            dicts, ideally from one batched call.
+        score_key (str): Key of the score in the critique dicts.
+        min_samples (int): Samples drawn in the first batch.
+        max_samples (int): Maximum number of samples.
+        batch_size (int): Samples drawn per additional batch.
+        tolerance (float): Stop once the half width of the interval is at most this.
+        confidence (float): Confidence level of the interval.
+
+    Returns:
+        tuple: The list of critiques and their `score_statistics`.
+    """
+    critiques = []
+    while count := _next_batch(
+        [critique[score_key] for critique in critiques], min_samples, max_samples, batch_size, tolerance, confidence
+    ):
+        critiques.extend(sample(count))
+    return critiques, score_statistics([critique[score_key] for critique in critiques], confidence)
+
+
+async def asample_until_confident(sample, score_key, min_samples=3, max_samples=10, batch_size=2, tolerance=0.05,
+                                  confidence=0.95):
+    """
+    Async version of `sample_until_confident`, where `sample` is a coroutine function.
+    """
+    critiques = []
+    while count := _next_batch(
+        [critique[score_key] for critique in critiques], min_samples, max_samples, batch_size, tolerance, confidence
+    ):
+        critiques.extend(await sample(count))
+    return critiques, score_statistics([critique[score_key] for critique in critiques], confidence)
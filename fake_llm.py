@@ -0,0 +1,182 @@
+import asyncio, json, random, threading, time
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.output_parsers import JsonOutputParser
+from pydantic import PrivateAttr
+
+_WORDS = (
+    "clarity context audience structure example format tone reasoning step detail constraint goal "
+    "summary outline section evidence argument flow engagement accuracy revision draft"
+).split()
+
+
+class FakeLLMError(Exception):
+    """
+    Simulated upstream failure raised by `FakeChatModel`, carrying an HTTP status code like
+    the OpenAI errors do.
+    """
+
+    def __init__(self, message, status_code=429):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def fake_value(schema, rng):
+    """
+    Generates a value conforming to a (simple) JSON schema.
+
+    Supports objects, arrays, strings, numbers, integers and booleans, honouring
+    `minimum`/`maximum` bounds and `enum` values.
+
+    Args:
+        schema (dict): The JSON schema.
+        rng (random.Random): Source of randomness.
+    """
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    schema_type = schema.get("type", "string")
+    if schema_type == "object":
+        return {key: fake_value(value, rng) for key, value in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [fake_value(schema.get("items", {}), rng) for _ in range(rng.randint(1, 3))]
+    if schema_type == "number":
+        return round(rng.uniform(schema.get("minimum", 0), schema.get("maximum", 1)), 2)
+    if schema_type == "integer":
+        return rng.randint(schema.get("minimum", 0), schema.get("maximum", 100))
+    if schema_type == "boolean":
+        return rng.random() < 0.5
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(8, 24))).capitalize() + "."
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Offline stand-in for `ChatOpenAI`, for tests and benchmarks.
+
+    Responses are deterministic for a given input: plain calls return lorem-style text, and
+    `with_structured_output` returns values conforming to the given JSON schema. Calls sleep for
+    a configurable simulated latency and fail at a configurable rate, so the orchestration code
+    can be measured without paying for or waiting on OpenAI.
+
+    Args:
+        model_name (str): Reported model name.
+        latency (float): Mean simulated latency of a call, in seconds.
+        jitter (float): Maximum random deviation from `latency`, in seconds.
+        error_rate (float): Probability that a call raises `FakeLLMError`.
+        error_status_code (int): HTTP status code of the simulated errors (429 by default).
+        response_words (int): Number of words of a plain-text response.
+        seed (int): Seed of the latency and error randomness.
+    """
+
+    model_name: str = "fake-model"
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    error_status_code: int = 429
+    response_words: int = 120
+    seed: int = 0
+
+    _rng: random.Random = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _calls: int = PrivateAttr(default=0)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._rng = random.Random(self.seed)
+
+    @property
+    def _llm_type(self):
+        return "fake-chat-model"
+
+    @property
+    def calls(self):
+        """Number of calls made to the model so far, failed ones included."""
+        return self._calls
+
+    def reset_calls(self):
+        with self._lock:
+            self._calls = 0
+
+    def _next_call(self):
+        # Returns the simulated latency of the call and whether it fails
+        with self._lock:
+            self._calls += 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            fails = self._rng.random() < self.error_rate
+        return delay, fails
+
+    def _respond(self, messages, schema):
+        prompt_text = "\n".join(str(message.content) for message in messages)
+        rng = random.Random(f"{self.model_name}:{prompt_text}")
+        if schema is not None:
+            content = json.dumps(fake_value(schema, rng))
+        else:
+            content = " ".join(rng.choice(_WORDS) for _ in range(self.response_words))
+        # Rough token counts, so that instrumentation has something to report
+        input_tokens = (len(prompt_text) + 3) // 4
+        output_tokens = (len(content) + 3) // 4
+        message = AIMessage(
+            content=content,
+            usage_metadata={
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            },
+            response_metadata={"model_name": self.model_name},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, fake_schema=None, **kwargs):
+        delay, fails = self._next_call()
+        time.sleep(delay)
+        if fails:
+            raise FakeLLMError("Simulated upstream error.", self.error_status_code)
+        return self._respond(messages, fake_schema)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, fake_schema=None, **kwargs):
+        delay, fails = self._next_call()
+        await asyncio.sleep(delay)
+        if fails:
+            raise FakeLLMError("Simulated upstream error.", self.error_status_code)
+        return self._respond(messages, fake_schema)
+
+    def _chunks(self, messages, schema):
+        # Splits the response into word chunks, with the usage reported on the last one like OpenAI does
+        message = self._respond(messages, schema).generations[0].message
+        words = message.content.split(" ")
+        for i, word in enumerate(words):
+            last = i == len(words) - 1
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=word if last else word + " ",
+                usage_metadata=message.usage_metadata if last else None,
+                response_metadata=message.response_metadata if last else {},
+            ))
+
+    def _stream(self, messages, stop=None, run_manager=None, fake_schema=None, **kwargs):
+        delay, fails = self._next_call()
+        if fails:
+            raise FakeLLMError("Simulated upstream error.", self.error_status_code)
+        chunks = list(self._chunks(messages, fake_schema))
+        for chunk in chunks:
+            # The simulated latency is spread over the chunks
+            time.sleep(delay / len(chunks))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, fake_schema=None, **kwargs):
+        delay, fails = self._next_call()
+        if fails:
+            raise FakeLLMError("Simulated upstream error.", self.error_status_code)
+        chunks = list(self._chunks(messages, fake_schema))
+        for chunk in chunks:
+            await asyncio.sleep(delay / len(chunks))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def with_structured_output(self, schema, **kwargs):
+        """
+        Returns a runnable producing dicts that conform to the JSON schema `schema`.
+        """
+        return self.bind(fake_schema=schema) | JsonOutputParser()
@@ -0,0 +1,105 @@
+def assign_parents(beam, beam_width):
+    """
+    Spreads `beam_width` children over the candidates of the current beam.
+
+    Every candidate gets the same share of children; the remainder goes to the best ones.
+    On the first round the beam is empty and every child starts from the prompt (parent None).
+    """
+    if not beam:
+        return [None] * beam_width
+    return [beam[i % len(beam)] for i in range(beam_width)]
+
+
+def beam_search(
+    generate,
+    critique,
+    score_key,
+    beam_width=3,
+    top_k=1,
+    min_score=8,
+    max_attempts=5,
+    stagnation_threshold=2
+):
+    """
+    Beam (best-of-N) variant of the GAN feedback loop.
+
+    Each round generates `beam_width` candidates in parallel from the current beam, critiques
+    them with one batched critic call and keeps the `top_k` best candidates (previous survivors
+    included) for the next round. The stopping rules match the sequential loop, applied to the
+    best score of each round.
+
+    Parameters:
+    - generate: Function taking the list of parent candidates (None on the first round) and
+      returning one generated content per parent, ideally with a single batched call.
+    - critique: Function taking the list of generated contents and their parents and returning
+      one critique dict per content, ideally with a single batched call.
+    - score_key: Key of the score in the critique dicts (e.g. "Score").
+    - beam_width: Number of candidates generated per round.
+    - top_k: Number of candidates kept for the next round.
+    - min_score: The minimum score to reach before stopping.
+    - max_attempts: Maximum number of rounds.
+    - stagnation_threshold: Number of rounds with no improvement of the best score before stopping.
+
+    Returns:
+    - A dictionary with the reason for stopping, the final score, the best candidate, the critique
+      of the best candidate of each round and the number of rounds and critic calls.
+      A candidate is a dict with its "content", "critique", "score" and "parent" candidate.
+    """
+    if beam_width < 1 or top_k < 1:
+        raise ValueError("beam_width and top_k must be at least 1.")
+
+    beam = []
+    critique_history = []
+    reason_to_stop = ""
+    final_score = 0
+    rounds = 0
+    critic_calls = 0
+    stagnation_counter = 0
+    previous_score = 0
+
+    while rounds < max_attempts:
+        rounds += 1
+
+        # Step 1: Generate the candidates of this round in parallel
+        parents = assign_parents(beam, beam_width)
+        contents = generate(parents)
+
+        # Step 2: Critique all the candidates with one batched call
+        critiques = critique(contents, parents)
+        critic_calls += len(contents)
+
+        candidates = [
+            {"content": content, "critique": critique_json, "score": critique_json.get(score_key, 0), "parent": parent}
+            for content, critique_json, parent in zip(contents, critiques, parents)
+        ]
+
+        # Step 3: Keep the best candidates, survivors of the previous rounds included
+        beam = sorted(beam + candidates, key=lambda candidate: candidate["score"], reverse=True)[:top_k]
+        critique_history.append(beam[0]["critique"])
+        final_score = beam[0]["score"]
+
+        # Check for stagnation
+        if final_score <= previous_score:
+            stagnation_counter += 1
+        else:
+            stagnation_counter = 0  # Reset if improvement is detected
+        previous_score = final_score
+
+        # Exit conditions
+        if final_score >= min_score:
+            reason_to_stop = "Desired score reached."
+            break
+        if stagnation_counter >= stagnation_threshold:
+            reason_to_stop = "No significant improvement detected."
+            break
+    else:
+        reason_to_stop = "Maximum attempts reached."
+
+    return {
+        "ReasonToStop": reason_to_stop,
+        "FinalScore": final_score,
+        "BestCandidate": beam[0] if beam else None,
+        "CritiqueHistory": critique_history,
+        "Rounds": rounds,
+        "CriticCalls": critic_calls
+    }
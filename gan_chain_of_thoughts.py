@@ -1,37 +1,28 @@
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from dotenv import load_dotenv
-import os, json, pprint
+from models import make_chat_model
+from routing import get_router
+from tokens import count_tokens
+from gan_beam import beam_search
+from precheck import negligible_change
+from retention import IterationHistory
+from metrics import MetricsRecorder, chain_config
+from ratelimit import scheduled_invoke, scheduled_batch
+from functools import lru_cache
+import json, logging, pprint
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-def gan_feedback_loop(
-    model_generator_llm,  # LLM instance for Model 1
-    model_critic_llm,     # LLM instance for Model 2
-    prompt,
-    require_user_feedback=False,
-    require_user_confirmation=False,
-    min_score=8,
-    max_attempts=5,
-    stagnation_threshold=2
-):
+
+def build_chains(model_generator_llm, model_critic_llm):
     """
-    Implements a Generative-Adversarial inspired feedback loop between two LLMs using LangChain.
-    Now includes a chain of thought approach for improved reasoning.
-    
+    Builds the generator and critic chains used by the feedback loop.
+
     Parameters:
-    - model_generator_llm: The LLM instance for Model 1 (e.g., OpenAI model).
+    - model_generator_llm: The LLM instance for Model 1.
     - model_critic_llm: The LLM instance for Model 2.
-    - prompt: The initial prompt to generate content.
-    - require_user_feedback: Boolean flag for user feedback between iterations.
-    - require_user_confirmation: Boolean flag for user confirmation between iterations.
-    - min_score: The minimum score to reach before stopping.
-    - max_attempts: Maximum number of iterations.
-    - stagnation_threshold: Number of iterations with no improvement before stopping.
-    
+
     Returns:
-    - A dictionary containing the final results, including the reason for stopping, final score, 
-      generated content, critique history, and any user feedback incorporated.
+    - A tuple with the generator chain and the critic chain.
     """
     # Define PromptTemplates
     # Model 1 PromptTemplate - Chain of Thought Generation
@@ -69,9 +60,104 @@ Clarifying Questions:
     )
     model2_chain = model2_prompt_template | model_critic_llm
 
-    # Initialization
+    return model1_chain, model2_chain
+
+
+def gan_feedback_loop(
+    model_generator_llm,  # LLM instance for Model 1
+    model_critic_llm,     # LLM instance for Model 2
+    prompt,
+    require_user_feedback=False,
+    require_user_confirmation=False,
+    min_score=8,
+    max_attempts=5,
+    stagnation_threshold=2,
+    history_mode="full",
+    history_window=3,
+    model_summary_llm=None,
+    min_change=None,
+    model_precheck_llm=None,
+    retention="full",
+    keep_last=3,
+    metrics_sink=None,
+    scheduler=None
+):
+    """
+    Implements a Generative-Adversarial inspired feedback loop between two LLMs using LangChain.
+    Now includes a chain of thought approach for improved reasoning.
+    
+    Parameters:
+    - model_generator_llm: The LLM instance for Model 1 (e.g., OpenAI model).
+    - model_critic_llm: The LLM instance for Model 2. Critiques scoring within the ambiguity band of
+      the "cot_critique" escalation of the router are redone with its stronger model, see
+      `routing.ModelRouter`.
+    - prompt: The initial prompt to generate content.
+    - require_user_feedback: Boolean flag for user feedback between iterations.
+    - require_user_confirmation: Boolean flag for user confirmation between iterations.
+    - min_score: The minimum score to reach before stopping.
+    - max_attempts: Maximum number of iterations.
+    - stagnation_threshold: Number of iterations with no improvement before stopping.
+    - history_mode: How the critique history is sent to the critic, so that its size stays bounded:
+        - "full": every previous critique (the prompt grows with each iteration).
+        - "window": only the last `history_window` critiques.
+        - "summary": the last `history_window` critiques plus a rolling summary of the older ones,
+          updated incrementally as critiques leave the window.
+        - "delta": only the last critique and the score changes between iterations.
+    - history_window: Number of recent critiques kept verbatim in "window" and "summary" modes.
+    - model_summary_llm: The LLM instance summarizing older critiques in "summary" mode.
+      Defaults to the generator model.
+    - min_change: Minimum fraction of words changed since the last critiqued chain of thought for a
+      new critique (e.g. 0.05). Below it, the critic call is skipped: the last score is reused and
+      the iteration counts toward `stagnation_threshold`. None always critiques.
+    - model_precheck_llm: Optional cheaper critic LLM (structured with the same schema) run before
+      the critic from the second iteration on. If it predicts no improvement over the last score,
+      the critic call is skipped as above.
+    - retention: Which critiques the result keeps in `CritiqueHistory`: "full" (all of them),
+      "scores" (none, only `ScoreHistory`) or "last_n" (the last `keep_last`). The critiques the
+      critic needs for `history_mode` are kept during the run regardless: all of them with "full",
+      otherwise only the recent ones, so that the memory of the run stays flat.
+    - keep_last: Number of critiques kept with the "last_n" retention.
+    - metrics_sink: Optional sink receiving a span for every LLM call (e.g. a `metrics.JSONLMetricsSink`).
+    - scheduler: Optional `ratelimit.RateLimitScheduler` shared with the other callers of the same quota.
+    
+    Returns:
+    - A dictionary containing the final results, including the reason for stopping, final score, 
+      generated content, critique history (see `retention`), score history, any user feedback
+      incorporated, the number of history tokens saved by compaction at each iteration, the number of iterations and of
+      skipped critiques and the calls, tokens, latency and cost of the run and of each iteration.
+    """
+    if history_mode not in ("full", "window", "summary", "delta"):
+        raise ValueError(f"Unknown history_mode: {history_mode!r}")
+
+    model1_chain, model2_chain = build_chains(model_generator_llm, model_critic_llm)
+
+    # Summary PromptTemplate - folds critiques leaving the window into a rolling summary
+    summary_prompt_template = ChatPromptTemplate.from_messages(
+        [
+            ("system", "You maintain a concise running summary of the critiques a reasoning chain received across iterations. Keep the recurring issues, what has already been fixed, and the score trend. Never exceed a few short paragraphs."),
+            ("user", "Current summary:\n{summary}\n\nCritique to fold into the summary:\n{critique}\n\nProvide the updated summary:")
+        ]
+    )
+    summary_chain = summary_prompt_template | (model_summary_llm or model_generator_llm)
+    if model_precheck_llm is not None:
+        # Same critic prompt, cheaper model
+        precheck_chain = build_chains(model_generator_llm, model_precheck_llm)[1]
+    router = get_router()
+    escalated_chain = None
+    if router.escalation_model_name("cot_critique"):
+        # Same critic prompt, stronger model, for the critiques with an ambiguous score
+        escalated_chain = build_chains(
+            model_generator_llm,
+            get_critic_llm(router.escalation_model_name("cot_critique"), scheduled=scheduler is not None)
+        )[1]
+    recorder = MetricsRecorder(sink=metrics_sink)
+
+    # Initialization. `critique_history` only holds the critiques `history_mode` still needs:
+    # all of them ("full"), the window ("window"), the last one ("delta"), or the window and
+    # the critiques not summarized yet ("summary")
     critique_history = []
     score_history = []
+    history = IterationHistory(retention, keep_last)
     user_feedback_incorporated = []
     reason_to_stop = ""
     final_score = 0
@@ -79,6 +165,11 @@ Clarifying Questions:
     stagnation_counter = 0
     previous_score = 0
     user_feedback = ""
+    history_summary = ""
+    history_tokens_saved = []
+    full_history_tokens = 0  # Tokens of the whole history, counted once per critique
+    critiqued_chain_of_thought = None
+    skipped_critiques = 0
     
     # Main loop
     while attempts < max_attempts:
@@ -92,14 +183,16 @@ Clarifying Questions:
                 "critique": "",
                 "clarifying_questions": ""
             }
-           generated_response = model1_chain.invoke(model1_inputs)
+           generated_response = scheduled_invoke(
+                scheduler, model1_chain, model1_inputs, chain_config(recorder, "generator", attempt=attempts)
+            )
         else:
-            generated_response = model1_chain.invoke({
+            generated_response = scheduled_invoke(scheduler, model1_chain, {
                 "initial_prompt": prompt,
                 "chain_of_thought": chain_of_thought,
                 "critique": critique_json.get('Critique', ''),
                 "clarifying_questions": "\n".join(critique_json.get('ClarifyingQuestions', []))
-            })
+            }, chain_config(recorder, "generator", attempt=attempts))
         
         chain_of_thought = generated_response.content
 
@@ -111,18 +204,62 @@ Clarifying Questions:
                 reason_to_stop = "User terminated the process."
                 break
         
-        # Step 2: Model 2 critiques the chain of thought
-        model2_inputs = {
-            "chain_of_thought": chain_of_thought,
-            "critique_history": json.dumps(critique_history),
-            "score_history": json.dumps(score_history)
-        }
-        critique_json = model2_chain.invoke(model2_inputs)
+        # Step 2: Model 2 critiques the chain of thought, unless a pre-check predicts no improvement
+        skip_critique = negligible_change(critiqued_chain_of_thought, chain_of_thought, min_change)
+        if skip_critique:
+            history_tokens_saved.append(0)
+        else:
+            if history_mode == "summary":
+                # Fold the critiques that left the window into the summary, one at a time
+                while len(critique_history) > max(history_window, 0):
+                    history_summary = scheduled_invoke(scheduler, summary_chain, {
+                        "summary": history_summary or "(empty)",
+                        "critique": json.dumps(critique_history[0])
+                    }, chain_config(recorder, "summary", attempt=attempts)).content
+                    del critique_history[0]
+            critique_history_input, score_history_input = compact_history(
+                critique_history, score_history, history_mode, history_window, history_summary
+            )
+            history_tokens_saved.append(0 if history_mode == "full" else max(
+                0, full_history_tokens - count_tokens(critique_history_input + score_history_input)
+            ))
+            model2_inputs = {
+                "chain_of_thought": chain_of_thought,
+                "critique_history": critique_history_input,
+                "score_history": score_history_input
+            }
+            if model_precheck_llm is not None and len(history):
+                precheck_json = scheduled_invoke(
+                    scheduler, precheck_chain, model2_inputs, chain_config(recorder, "precheck", attempt=attempts)
+                )
+                skip_critique = precheck_json.get('ReasoningScore', 0) <= previous_score
 
-        critique_history.append(critique_json)
-        score_history.append(critique_json.get('ReasoningScore', 0))
-        
-        final_score = critique_json.get('ReasoningScore', 0)
+        if skip_critique:
+            # Reuse the last score, the iteration counts toward stagnation
+            skipped_critiques += 1
+        else:
+            critique_json = scheduled_invoke(
+                scheduler, model2_chain, model2_inputs, chain_config(recorder, "cot_critic", attempt=attempts)
+            )
+            score = critique_json.get('ReasoningScore')
+            if escalated_chain is not None and router.needs_escalation("cot_critique", score):
+                # Redo the ambiguous critique with the stronger model
+                critique_json = scheduled_invoke(
+                    scheduler, escalated_chain, model2_inputs,
+                    chain_config(recorder, "cot_critic_escalation", attempt=attempts)
+                )
+
+            critique_history.append(critique_json)
+            score_history.append(critique_json.get('ReasoningScore', 0))
+            # Drop the critiques the critic will not see again
+            keep = {"window": max(history_window, 0), "delta": 1}.get(history_mode)
+            if keep is not None and len(critique_history) > keep:
+                del critique_history[:len(critique_history) - keep]
+            full_history_tokens += count_tokens(json.dumps(critique_json)) + count_tokens(json.dumps(score_history[-1]))
+            critiqued_chain_of_thought = chain_of_thought
+            
+            final_score = critique_json.get('ReasoningScore', 0)
+            history.append(attempts, final_score, critique_json)
         
         # Check for stagnation
         if final_score <= previous_score:
@@ -172,21 +309,181 @@ Clarifying Questions:
         "ReasonToStop": reason_to_stop,
         "FinalScore": final_score,
         "ChainOfThought": chain_of_thought,
-        "CritiqueHistory": critique_history,
-        "UserFeedbackIncorporated": user_feedback_incorporated if user_feedback_incorporated else None
+        "CritiqueHistory": history.critiques(),
+        "ScoreHistory": history.scores(),
+        "UserFeedbackIncorporated": user_feedback_incorporated if user_feedback_incorporated else None,
+        "HistoryTokensSaved": history_tokens_saved,
+        "Iterations": attempts,
+        "SkippedCritiques": skipped_critiques,
+        "Metrics": recorder.summary(),
+        "IterationMetrics": [recorder.summary(attempt=attempt) for attempt in range(1, attempts + 1)]
     }
     
+    logger.info(
+        "GAN chain of thoughts loop finished: %s Final score %s after %s iterations.",
+        reason_to_stop, final_score, attempts
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("GAN chain of thoughts loop result:\n%s", pprint.pformat(result))
+    
     return result
 
 
-# Load API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    raise ValueError("Please set the OPENAI_API_KEY environment variable.")
+def compact_history(critique_history, score_history, history_mode, history_window, history_summary=""):
+    """
+    Serializes the critique and score histories sent to the critic according to `history_mode`.
+
+    Parameters:
+    - critique_history: All the previous critiques, oldest first.
+    - score_history: All the previous scores, oldest first.
+    - history_mode: "full", "window", "summary" or "delta", see `gan_feedback_loop`.
+    - history_window: Number of recent critiques kept verbatim in "window" and "summary" modes.
+    - history_summary: Rolling summary of the critiques older than the window ("summary" mode).
+
+    Returns:
+    - A tuple with the critique history and the score history as JSON strings.
+    """
+    if history_mode == "full":
+        return json.dumps(critique_history), json.dumps(score_history)
+    if history_mode == "delta":
+        score_deltas = [current - previous for previous, current in zip(score_history, score_history[1:])]
+        return (
+            json.dumps(critique_history[-1:]),
+            json.dumps({"LastScore": score_history[-1] if score_history else None, "ScoreDeltas": score_deltas})
+        )
+    recent_critiques = critique_history[-history_window:] if history_window > 0 else []
+    if history_mode == "window":
+        return json.dumps(recent_critiques), json.dumps(score_history[-history_window:] if history_window > 0 else [])
+    # Scores are tiny, so the summary mode keeps all of them to preserve the trend
+    return json.dumps({"SummaryOfOlderCritiques": history_summary, "RecentCritiques": recent_critiques}), json.dumps(score_history)
+
 
+def gan_beam_feedback_loop(
+    model_generator_llm,
+    model_critic_llm,
+    prompt,
+    beam_width=3,
+    top_k=1,
+    min_score=8,
+    max_attempts=5,
+    stagnation_threshold=2,
+    history_mode="full",
+    history_window=3,
+    max_concurrency=None,
+    metrics_sink=None,
+    scheduler=None
+):
+    """
+    Beam variant of `gan_feedback_loop`: generates `beam_width` chains of thought per round in
+    parallel, critiques them with batched critic calls and keeps the `top_k` best ones for the
+    next round. Each candidate is critiqued against the critique history of its own lineage.
+    User feedback and confirmation are not supported in this mode.
+
+    Parameters:
+    - model_generator_llm: The LLM instance for Model 1. Use a non-zero temperature so that the
+      candidates of a round differ.
+    - model_critic_llm: The LLM instance for Model 2.
+    - prompt: The initial prompt to generate content.
+    - beam_width: Number of candidates generated per round.
+    - top_k: Number of candidates kept for the next round.
+    - min_score: The minimum score to reach before stopping.
+    - max_attempts: Maximum number of rounds.
+    - stagnation_threshold: Number of rounds with no improvement before stopping.
+    - history_mode: "full", "window" or "delta", see `gan_feedback_loop`. The "summary" mode
+      is not available here since it would need one rolling summary per lineage.
+    - history_window: Number of recent critiques kept verbatim in "window" mode.
+    - max_concurrency: Maximum number of parallel calls per batch (unbounded if None).
+    - metrics_sink: Optional sink receiving a span for every LLM call.
+    - scheduler: Optional `ratelimit.RateLimitScheduler` shared with the other callers of the same quota.
+
+    Returns:
+    - The same dictionary as `gan_feedback_loop`, with the number of rounds and critic calls.
+    """
+    if history_mode not in ("full", "window", "delta"):
+        raise ValueError(f"Unsupported history_mode for the beam search: {history_mode!r}")
+
+    model1_chain, model2_chain = build_chains(model_generator_llm, model_critic_llm)
+    recorder = MetricsRecorder(sink=metrics_sink)
+    generator_config = {**chain_config(recorder, "generator"), "max_concurrency": max_concurrency}
+    critic_config = {**chain_config(recorder, "cot_critic"), "max_concurrency": max_concurrency}
+    router = get_router()
+    escalated_chain = None
+    if router.escalation_model_name("cot_critique"):
+        escalated_chain = build_chains(
+            model_generator_llm,
+            get_critic_llm(router.escalation_model_name("cot_critique"), scheduled=scheduler is not None)
+        )[1]
+    escalation_config = {**chain_config(recorder, "cot_critic_escalation"), "max_concurrency": max_concurrency}
+
+    def lineage(candidate):
+        # Critiques of the candidate and its ancestors, oldest first
+        critiques = []
+        while candidate is not None:
+            critiques.append(candidate["critique"])
+            candidate = candidate["parent"]
+        return critiques[::-1]
+
+    def generate(parents):
+        responses = scheduled_batch(scheduler, model1_chain, [
+            {
+                "initial_prompt": prompt,
+                "chain_of_thought": parent["content"] if parent else "",
+                "critique": parent["critique"].get('Critique', '') if parent else "",
+                "clarifying_questions": "\n".join(parent["critique"].get('ClarifyingQuestions', [])) if parent else ""
+            }
+            for parent in parents
+        ], generator_config)
+        return [response.content for response in responses]
+
+    def critique(contents, parents):
+        inputs = []
+        for content, parent in zip(contents, parents):
+            critique_history = lineage(parent)
+            score_history = [critique_json.get('ReasoningScore', 0) for critique_json in critique_history]
+            critique_history_input, score_history_input = compact_history(
+                critique_history, score_history, history_mode, history_window
+            )
+            inputs.append({
+                "chain_of_thought": content,
+                "critique_history": critique_history_input,
+                "score_history": score_history_input
+            })
+        critiques = scheduled_batch(scheduler, model2_chain, inputs, critic_config)
+        # Redo the ambiguous critiques with the stronger model, in one batched call
+        ambiguous = [
+            i for i, critique_json in enumerate(critiques)
+            if escalated_chain is not None
+            and router.needs_escalation("cot_critique", critique_json.get('ReasoningScore'))
+        ]
+        if ambiguous:
+            critiques = list(critiques)
+            escalated = scheduled_batch(scheduler, escalated_chain, [inputs[i] for i in ambiguous], escalation_config)
+            for i, critique_json in zip(ambiguous, escalated):
+                critiques[i] = critique_json
+        return critiques
+
+    search = beam_search(
+        generate,
+        critique,
+        "ReasoningScore",
+        beam_width=beam_width,
+        top_k=top_k,
+        min_score=min_score,
+        max_attempts=max_attempts,
+        stagnation_threshold=stagnation_threshold
+    )
+
+    return {
+        "ReasonToStop": search["ReasonToStop"],
+        "FinalScore": search["FinalScore"],
+        "ChainOfThought": search["BestCandidate"]["content"] if search["BestCandidate"] else "",
+        "CritiqueHistory": search["CritiqueHistory"],
+        "UserFeedbackIncorporated": None,
+        "Rounds": search["Rounds"],
+        "CriticCalls": search["CriticCalls"],
+        "Metrics": recorder.summary()
+    }
 
-# Replace 'your-openai-api-key' with your actual API key
-generator_llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=openai_api_key)
 
 # Define JSON schema for critic LLM
 json_schema = {
@@ -213,22 +510,48 @@ json_schema = {
     "required": ["Critique", "ClarifyingQuestions", "ReasoningScore"]
 }
 
-critic_llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=openai_api_key ).with_structured_output(json_schema)
 
-input_prompt = input("Add here your request: ")
+@lru_cache(maxsize=None)
+def get_generator_llm(model=None, scheduled=False):
+    """
+    Returns the generator LLM, creating it on first use and reusing it afterwards.
+    Defaults to the model the router assigns to the "generator" stage, see `routing.get_router`.
+    Set `scheduled` when its calls go through a `ratelimit.RateLimitScheduler`, which retries
+    them: the client then does not retry on its own.
+    """
+    return make_chat_model(model or get_router().model_name("generator"), scheduled=scheduled)
 
-result = gan_feedback_loop(
-    model_generator_llm=generator_llm,
-    model_critic_llm=critic_llm,
-    prompt=input_prompt,
-    require_user_feedback=False,
-    require_user_confirmation=False,
-    min_score=85,
-    max_attempts=4,
-    stagnation_threshold=3
-)
+
+@lru_cache(maxsize=None)
+def get_critic_llm(model=None, scheduled=False):
+    """
+    Returns the critic LLM with structured output, creating it on first use and reusing it afterwards.
+    Defaults to the model the router assigns to the "cot_critique" stage, see `routing.get_router`.
+    See `get_generator_llm` for `scheduled`.
+    """
+    return make_chat_model(
+        model or get_router().model_name("cot_critique"), scheduled=scheduled
+    ).with_structured_output(json_schema)
+
+
+def main():
+    input_prompt = input("Add here your request: ")
+
+    result = gan_feedback_loop(
+        model_generator_llm=get_generator_llm(),
+        model_critic_llm=get_critic_llm(),
+        prompt=input_prompt,
+        require_user_feedback=False,
+        require_user_confirmation=False,
+        min_score=85,
+        max_attempts=4,
+        stagnation_threshold=3
+    )
+
+    print("Reason to Stop:", result['ReasonToStop'])
+    print("Final Score:", result['FinalScore'])
+    print("Generated Chain of Thought:\n", result['ChainOfThought'])
 
 
-print("Reason to Stop:", result['ReasonToStop'])
-print("Final Score:", result['FinalScore'])
-print("Generated Chain of Thought:\n", result['ChainOfThought'])
+if __name__ == "__main__":
+    main()
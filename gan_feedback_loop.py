@@ -1,36 +1,36 @@
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from dotenv import load_dotenv
-import os, json, pprint
+from langchain_core.runnables import RunnableBinding, RunnableSequence
+from langchain_core.language_models import BaseChatModel
+from models import make_chat_model
+from routing import get_router
+from gan_beam import beam_search
+from precheck import negligible_change
+from checkpoint import save_checkpoint, load_checkpoint
+from retention import IterationHistory
+from cache import MemoryCache, cache_key
+from chunked import CHUNK_HEADER, chunk_content, reduce_critiques
+from tokens import count_tokens
+from sections import section_patches_schema, split_sections, join_sections, number_sections, apply_patches
+from metrics import MetricsRecorder, chain_config
+from ratelimit import (
+    scheduled_invoke, scheduled_ainvoke, scheduled_batch, scheduled_abatch, scheduled_stream, scheduled_astream
+)
+from functools import lru_cache
+import json, logging, pprint
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-def gan_feedback_loop(
-    model_generator_llm,  # LLM instance for Model 1
-    model_critic_llm,     # LLM instance for Model 2
-    prompt,
-    require_user_feedback=False,
-    require_user_confirmation=False,
-    min_score=8,
-    max_attempts=5,
-    stagnation_threshold=2
-):
+
+def build_chains(model_generator_llm, model_critic_llm):
     """
-    Implements a Generative-Adversarial inspired feedback loop between two LLMs using LangChain.
-    
+    Builds the generator and critic chains used by the feedback loop.
+
     Parameters:
-    - model_generator_llm: The LLM instance for Model 1 (e.g., OpenAI model).
+    - model_generator_llm: The LLM instance for Model 1.
     - model_critic_llm: The LLM instance for Model 2.
-    - prompt: The initial prompt to generate content.
-    - require_user_feedback: Boolean flag for user feedback between iterations.
-    - require_user_confirmation: Boolean flag for user confirmation between iterations.
-    - min_score: The minimum score to reach before stopping.
-    - max_attempts: Maximum number of iterations.
-    - stagnation_threshold: Number of iterations with no improvement before stopping.
-    
+
     Returns:
-    - A dictionary containing the final results, including the reason for stopping, final score, 
-      generated content, critique history, and any user feedback incorporated.
+    - A tuple with the generator chain and the critic chain.
     """
     # Define PromptTemplates
     # Model 1 PromptTemplate
@@ -70,74 +70,405 @@ Provide the improved content below:
     )
     model2_chain = model2_prompt_template | model_critic_llm
 
-    # Initialization
-    critique_history = []
-    user_feedback_incorporated = []
-    reason_to_stop = ""
-    final_score = 0
-    attempts = 0
-    stagnation_counter = 0
-    previous_score = 0
-    user_feedback = ""
+    return model1_chain, model2_chain
+
+
+def build_edit_chain(model_generator_llm):
+    """
+    Builds the generator chain of the edit mode, which returns patches to the numbered sections
+    of the content instead of rewriting all of it.
+
+    Parameters:
+    - model_generator_llm: The LLM instance for Model 1.
+
+    Returns:
+    - The chain, returning a dictionary shaped like `sections.section_patches_schema`.
+    """
+    prompt_edit_system_prompt = "You are an expert content editor with a mission to enhance the quality, clarity, coherence, engagement, and overall impact of the content provided, with targeted edits."
+    prompt_edit_job = """
+Your role is to significantly improve the quality of the content below, by editing only the sections that the critique, the suggestions or the user feedback call for. Focus on enhancing clarity, engagement, logical flow, factual accuracy, and persuasiveness. The sections are numbered; leave the good ones alone and do not repeat them.
+
+Original Content:
+{original_content}
+
+Critique:
+{critique}
+
+Follow-up Suggestions:
+{followup_suggestions}
+
+User Feedback:
+{user_feedback}
+
+Provide the patches to apply to the sections: "replace" with the full new text of section N, "insert" a new section after section N (0 for the beginning), or "delete" section N.
+"""
+    prompt_template = ChatPromptTemplate.from_messages(
+        [
+            ("system", prompt_edit_system_prompt),
+            ("user", prompt_edit_job)
+        ]
+    )
+    return prompt_template | model_generator_llm.with_structured_output(section_patches_schema)
+
+
+def _edit_critique_input(sections, changed, deleted, critique, score):
+    """
+    Builds the critic input of an edited content: the previous critique and score, and only the
+    sections that changed, so that the critique costs as much as the edit instead of the content.
+    """
+    return f"""
+You critiqued a previous version of this content with a score of {score}:
+{critique.get('Critique', '')}
+
+Only the sections below were rewritten or added since then, the other sections are unchanged:
+{number_sections(sections, changed) or "None."}
+
+Deleted sections:
+{chr(10).join(deleted) or "None."}
+
+Critique and score the revised content as a whole.
+"""
+
+
+def _chain_identity(runnable):
+    # Stable description of a chain: its templates, model names and bound arguments (such as the
+    # output schema), leaving out the clients, whose repr changes with every instance
+    if isinstance(runnable, RunnableSequence):
+        return [_chain_identity(step) for step in runnable.steps]
+    if isinstance(runnable, ChatPromptTemplate):
+        return [
+            (type(message).__name__, getattr(getattr(message, "prompt", None), "template", None)
+             or getattr(message, "content", None))
+            for message in runnable.messages
+        ]
+    if isinstance(runnable, RunnableBinding):
+        return {"bound": _chain_identity(runnable.bound), "kwargs": runnable.kwargs}
+    if isinstance(runnable, BaseChatModel):
+        return {
+            "class": type(runnable).__name__,
+            "model": getattr(runnable, "model_name", None),
+            "temperature": getattr(runnable, "temperature", None),
+        }
+    return type(runnable).__name__
+
+
+def _critic_namespace(model2_chain):
+    """
+    Identifies the critic chain (model, templates and output schema) in the keys of its chunk
+    critiques, so that loops with different critics can share a chunk cache, and a persistent
+    cache still hits in another process.
+    """
+    return cache_key(_chain_identity(model2_chain))
+
+
+def _chunked_critique_steps(model2_chain, chunks, chunk_cache, config, attempt, router=None, escalated_chain=None,
+                            escalation_config=None):
+    """
+    Critiques content chunk by chunk, as part of `_feedback_loop_steps`: yields one batched call
+    for the chunks not in `chunk_cache`, and returns the critiques reduced into one. With an
+    `escalated_chain`, the chunk critiques scoring within the "critic" ambiguity band of `router`
+    are redone with it in a second batched call.
+    """
+    namespace = _critic_namespace(model2_chain)
+    if escalated_chain is not None:
+        namespace = cache_key(namespace, _critic_namespace(escalated_chain), router.escalation.get("critic"))
+    keys = [cache_key("critic", namespace, CHUNK_HEADER + chunk) for chunk in chunks]
+    critiques = [chunk_cache.get(key) for key in keys]
+    missing = [i for i, critique in enumerate(critiques) if critique is None]
+    if missing:
+        inputs = [{"content_to_critique": CHUNK_HEADER + chunks[i]} for i in missing]
+        responses = yield {
+            "call": "critique_batch", "attempt": attempt, "runnable": model2_chain, "inputs": inputs, "config": config
+        }
+        ambiguous = [
+            j for j, response in enumerate(responses)
+            if escalated_chain is not None and router.needs_escalation("critic", response.get("Score"))
+        ]
+        if ambiguous:
+            escalated_responses = yield {
+                "call": "critique_batch", "attempt": attempt, "runnable": escalated_chain,
+                "inputs": [inputs[j] for j in ambiguous], "config": escalation_config
+            }
+            responses = list(responses)
+            for j, response in zip(ambiguous, escalated_responses):
+                responses[j] = response
+        for i, response in zip(missing, responses):
+            critiques[i] = response
+            chunk_cache.set(keys[i], response)
+    return reduce_critiques(
+        critiques, [count_tokens(chunk) for chunk in chunks], "Critique", "Score",
+        ("ClarifyingQuestions", "FollowUpSuggestions")
+    )
+
+
+class LoopState:
+    """
+    Progress of a `gan_feedback_loop` run: everything needed to resume it, serializable to JSON.
+
+    `phase` is the next step of the current attempt, "generate" or "critique" (the content of the
+    attempt was generated but not critiqued yet). `critique_input` is what the critic gets instead
+    of the whole content in edit mode (empty if the edits changed nothing). `history` is the
+    `retention.IterationHistory` of the critiqued iterations, and `spans` holds the metrics
+    recorded so far.
+    """
+
+    def __init__(
+        self,
+        prompt,
+        attempts=0,
+        phase="generate",
+        generated_content="",
+        critique_input=None,
+        critique=None,
+        history=None,
+        critiqued_content=None,
+        user_feedback="",
+        user_feedback_incorporated=None,
+        final_score=0,
+        previous_score=0,
+        stagnation_counter=0,
+        skipped_critiques=0,
+        reason_to_stop="",
+        spans=None
+    ):
+        self.prompt = prompt
+        self.attempts = attempts
+        self.phase = phase
+        self.generated_content = generated_content
+        self.critique_input = critique_input
+        self.critique = critique or {}
+        self.history = history if history is not None else IterationHistory()
+        self.critiqued_content = critiqued_content
+        self.user_feedback = user_feedback
+        self.user_feedback_incorporated = user_feedback_incorporated or []
+        self.final_score = final_score
+        self.previous_score = previous_score
+        self.stagnation_counter = stagnation_counter
+        self.skipped_critiques = skipped_critiques
+        self.reason_to_stop = reason_to_stop
+        self.spans = spans or []
+
+    def to_dict(self):
+        return {**vars(self), "history": self.history.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{**data, "history": IterationHistory.from_dict(data["history"])})
+
+
+def _feedback_loop_steps(
+    model_generator_llm,
+    model_critic_llm,
+    prompt,
+    require_user_feedback=False,
+    require_user_confirmation=False,
+    min_score=8,
+    max_attempts=5,
+    stagnation_threshold=2,
+    min_change=None,
+    model_precheck_llm=None,
+    retention="full",
+    keep_last=3,
+    edit_mode=False,
+    critique_chunk_tokens=None,
+    chunk_cache=None,
+    metrics_sink=None,
+    checkpoint_path=None,
+    state=None,
+    echo_content=True,
+    scheduled=False
+):
+    """
+    The feedback loop of `gan_feedback_loop`, written as a generator so that the same logic can be
+    driven with blocking or async calls, streaming the generator tokens or not.
+
+    Yields call requests, dictionaries with a "call" key ("generate", "edit", "critique" or
+    "critique_batch"), the runnable, its inputs (a list of them for "critique_batch") and config,
+    and expects the generated text, the patches, the critique or the list of critiques back through
+    `send`.
+    Also yields progress events, dictionaries with a "type" key. Returns the final result dictionary.
+
+    Starts from `state` (a `LoopState`) when resuming, and saves the state to `checkpoint_path`
+    after every generator and critic step. Critiques scoring within the ambiguity band of the
+    "critic" stage of the router are redone with its stronger model, see `routing.ModelRouter`;
+    `scheduled` tells whether the calls go through a rate limit scheduler.
+    """
+    model1_chain, model2_chain = build_chains(model_generator_llm, model_critic_llm)
+    if model_precheck_llm is not None:
+        # Same critic prompt, cheaper model
+        precheck_chain = build_chains(model_generator_llm, model_precheck_llm)[1]
+    if edit_mode:
+        edit_chain = build_edit_chain(model_generator_llm)
+    router = get_router()
+    escalated_chain = None
+    if router.escalation_model_name("critic"):
+        # Same critic prompt, stronger model, for the critiques with an ambiguous score
+        escalated_chain = build_chains(
+            model_generator_llm, get_critic_llm(router.escalation_model_name("critic"), scheduled=scheduled)
+        )[1]
+    recorder = MetricsRecorder(sink=metrics_sink)
+    if critique_chunk_tokens is not None and chunk_cache is None:
+        chunk_cache = MemoryCache()
+
+    # Initialization, or the state of the interrupted run
+    state = state or LoopState(prompt, history=IterationHistory(retention, keep_last))
+    recorder.spans = list(state.spans)
+    settings = {
+        "require_user_feedback": require_user_feedback,
+        "require_user_confirmation": require_user_confirmation,
+        "min_score": min_score,
+        "max_attempts": max_attempts,
+        "stagnation_threshold": stagnation_threshold,
+        "min_change": min_change,
+        "retention": retention,
+        "keep_last": keep_last,
+        "edit_mode": edit_mode,
+        "critique_chunk_tokens": critique_chunk_tokens
+    }
+
+    def checkpoint():
+        if checkpoint_path is not None:
+            state.spans = list(recorder.spans)
+            save_checkpoint(checkpoint_path, {"settings": settings, "state": state.to_dict()})
     
     # Main loop
-    while attempts < max_attempts:
-        attempts += 1
-        
-        # Step 1: Model 1 generates content
-        if attempts == 1:
-            # First iteration uses the initial prompt
-            generated_content = model_generator_llm.invoke(prompt).content
-        else:
-            # Subsequent iterations use the updated content
-            model1_inputs = {
-                "original_content": generated_content,
-                "critique": critique_json.get('Critique', ''),
-                "followup_suggestions": "\n".join(critique_json.get('FollowUpSuggestions', [])),
-                "user_feedback": user_feedback
-            }
-            generated_content = model1_chain.invoke(model1_inputs).content
+    while not state.reason_to_stop:
+        if state.phase == "generate":
+            if state.attempts >= max_attempts:
+                state.reason_to_stop = "Maximum attempts reached."
+                break
+            state.attempts += 1
+            attempts = state.attempts
+            
+            # Step 1: Model 1 generates content
+            if attempts == 1:
+                # First iteration uses the initial prompt
+                state.generated_content = yield {
+                    "call": "generate", "attempt": attempts, "runnable": model_generator_llm,
+                    "inputs": state.prompt, "config": chain_config(recorder, "generator", attempt=attempts)
+                }
+            else:
+                # Subsequent iterations use the updated content
+                model1_inputs = {
+                    "original_content": state.generated_content,
+                    "critique": state.critique.get('Critique', ''),
+                    "followup_suggestions": "\n".join(state.critique.get('FollowUpSuggestions', [])),
+                    "user_feedback": state.user_feedback
+                }
+                if edit_mode:
+                    # The generator patches the numbered sections, the patches are applied here
+                    sections = split_sections(state.generated_content)
+                    patches = yield {
+                        "call": "edit", "attempt": attempts, "runnable": edit_chain,
+                        "inputs": {**model1_inputs, "original_content": number_sections(sections)},
+                        "config": chain_config(recorder, "generator", attempt=attempts, edit=True)
+                    }
+                    sections, changed, deleted, rejected = apply_patches(sections, patches.get('Patches', []))
+                    if rejected:
+                        logger.warning("Attempt %s: %s patches could not be applied.", attempts, len(rejected))
+                    state.generated_content = join_sections(sections)
+                    state.critique_input = ""
+                    if changed or deleted:
+                        state.critique_input = _edit_critique_input(
+                            sections, changed, deleted, state.critique, state.final_score
+                        )
+                else:
+                    state.generated_content = yield {
+                        "call": "generate", "attempt": attempts, "runnable": model1_chain, "inputs": model1_inputs,
+                        "config": chain_config(recorder, "generator", attempt=attempts)
+                    }
+            state.phase = "critique"
+            checkpoint()
+        attempts = state.attempts
+        generated_content = state.generated_content
+        yield {"type": "generation", "attempt": attempts, "content": generated_content}
         
         if require_user_confirmation:
-            print("\nGenerated Content:")
-            print(generated_content)
+            if echo_content:
+                print("\nGenerated Content:")
+                print(generated_content)
             user_input = input("\nPress Enter to continue or type 'stop' to terminate: ")
             if user_input.lower() == 'stop':
-                reason_to_stop = "User terminated the process."
+                state.reason_to_stop = "User terminated the process."
                 break
         
-        # Step 2: Model 2 critiques the content
-        model2_inputs = {"content_to_critique": generated_content}
-        critique_json = model2_chain.invoke(model2_inputs)
+        # Step 2: Model 2 critiques the content (only its changed sections in edit mode), unless
+        # nothing changed or a pre-check predicts no improvement
+        model2_inputs = {
+            "content_to_critique": generated_content if state.critique_input is None else state.critique_input
+        }
+        skip_critique = (
+            state.critique_input == "" or negligible_change(state.critiqued_content, generated_content, min_change)
+        )
+        if not skip_critique and model_precheck_llm is not None and len(state.history):
+            precheck_json = yield {
+                "call": "critique", "attempt": attempts, "runnable": precheck_chain, "inputs": model2_inputs,
+                "config": chain_config(recorder, "precheck", attempt=attempts)
+            }
+            skip_critique = precheck_json.get('Score', 0) <= state.previous_score
 
-        critique_history.append(critique_json)
-        
-        final_score = critique_json.get('Score', 0)
+        chunks = []
+        if critique_chunk_tokens is not None and not skip_critique:
+            chunks = chunk_content(model2_inputs["content_to_critique"], critique_chunk_tokens)
+
+        if skip_critique:
+            # Reuse the last score, the iteration counts toward stagnation
+            state.skipped_critiques += 1
+        else:
+            if len(chunks) > 1:
+                # Long content: critique the chunks concurrently, the unchanged ones come from the cache
+                state.critique = yield from _chunked_critique_steps(
+                    model2_chain, chunks, chunk_cache, chain_config(recorder, "critic", attempt=attempts, chunked=True),
+                    attempts, router, escalated_chain,
+                    chain_config(recorder, "critic_escalation", attempt=attempts, chunked=True)
+                )
+            else:
+                state.critique = yield {
+                    "call": "critique", "attempt": attempts, "runnable": model2_chain, "inputs": model2_inputs,
+                    "config": chain_config(recorder, "critic", attempt=attempts)
+                }
+                if escalated_chain is not None and router.needs_escalation("critic", state.critique.get("Score")):
+                    # Redo the ambiguous critique with the stronger model
+                    state.critique = yield {
+                        "call": "critique", "attempt": attempts, "runnable": escalated_chain, "inputs": model2_inputs,
+                        "config": chain_config(recorder, "critic_escalation", attempt=attempts)
+                    }
+            state.critiqued_content = generated_content
+            state.final_score = state.critique.get('Score', 0)
+            state.history.append(attempts, state.final_score, state.critique)
+        critique_json = state.critique
+        final_score = state.final_score
+        yield {
+            "type": "critique", "attempt": attempts, "critique": critique_json, "score": final_score,
+            "skipped": skip_critique
+        }
         
         # Check for stagnation
-        if final_score <= previous_score:
-            stagnation_counter += 1
+        if final_score <= state.previous_score:
+            state.stagnation_counter += 1
         else:
-            stagnation_counter = 0  # Reset if improvement is detected
-        previous_score = final_score
+            state.stagnation_counter = 0  # Reset if improvement is detected
+        state.previous_score = final_score
+        state.phase = "generate"
         
         # Exit conditions
         if final_score >= min_score:
-            reason_to_stop = "Desired score reached."
-            break
-        if stagnation_counter >= stagnation_threshold:
-            reason_to_stop = "No significant improvement detected."
-            break
+            state.reason_to_stop = "Desired score reached."
+        elif state.stagnation_counter >= stagnation_threshold:
+            state.reason_to_stop = "No significant improvement detected."
         
         # Step 3: User feedback if required
-        if require_user_feedback and critique_json.get('ClarifyingQuestions'):
+        elif require_user_feedback and critique_json.get('ClarifyingQuestions'):
             print("\nModel 2 has the following questions:")
             for question in critique_json['ClarifyingQuestions']:
                 print(f"- {question}")
-            user_feedback = input("\nPlease provide answers to the above questions: ")
-            user_feedback_incorporated.append(user_feedback)
+            state.user_feedback = input("\nPlease provide answers to the above questions: ")
+            state.user_feedback_incorporated.append(state.user_feedback)
         else:
-            user_feedback = ""
+            state.user_feedback = ""
+        checkpoint()
+        if state.reason_to_stop:
+            break
         
         # Optional user confirmation
         if require_user_confirmation:
@@ -146,34 +477,373 @@ Provide the improved content below:
             print(f"Score: {final_score}")
             user_input = input("\nPress Enter to continue or type 'stop' to terminate: ")
             if user_input.lower() == 'stop':
-                reason_to_stop = "User terminated the process."
+                state.reason_to_stop = "User terminated the process."
                 break
-        
-    else:
-        reason_to_stop = "Maximum attempts reached."
+    checkpoint()
     
     # Compile the final result
-    result = {
-        "ReasonToStop": reason_to_stop,
-        "FinalScore": final_score,
-        "ContentGenerated": generated_content,
-        "CritiqueHistory": critique_history,
-        "UserFeedbackIncorporated": user_feedback_incorporated if user_feedback_incorporated else None
+    return {
+        "ReasonToStop": state.reason_to_stop,
+        "FinalScore": state.final_score,
+        "ContentGenerated": state.generated_content,
+        "CritiqueHistory": state.history.critiques(),
+        "ScoreHistory": state.history.scores(),
+        "UserFeedbackIncorporated": state.user_feedback_incorporated if state.user_feedback_incorporated else None,
+        "Iterations": state.attempts,
+        "SkippedCritiques": state.skipped_critiques,
+        "Metrics": recorder.summary(),
+        "IterationMetrics": [recorder.summary(attempt=attempt) for attempt in range(1, state.attempts + 1)]
     }
+
+
+def _run_steps(steps, stream=False, scheduler=None):
+    """
+    Drives `_feedback_loop_steps` with blocking calls. Yields its progress events, a "token" event
+    per generated chunk if `stream` is set, and finally a "result" event.
+    """
+    response = None
+    while True:
+        try:
+            step = steps.send(response)
+        except StopIteration as stop:
+            yield {"type": "result", "result": stop.value}
+            return
+        response = None
+        if "type" in step:
+            yield step
+        elif step["call"] in ("critique", "edit"):
+            response = scheduled_invoke(scheduler, step["runnable"], step["inputs"], step["config"])
+        elif step["call"] == "critique_batch":
+            response = scheduled_batch(scheduler, step["runnable"], step["inputs"], step["config"])
+        elif stream:
+            chunks = []
+            for chunk in scheduled_stream(scheduler, step["runnable"], step["inputs"], step["config"]):
+                chunks.append(chunk.content)
+                yield {"type": "token", "attempt": step["attempt"], "text": chunk.content}
+            # The critic starts on the joined chunks, without waiting for anything else
+            response = "".join(chunks)
+        else:
+            response = scheduled_invoke(scheduler, step["runnable"], step["inputs"], step["config"]).content
+
+
+async def _arun_steps(steps, stream=False, scheduler=None):
+    """
+    Async version of `_run_steps`.
+    """
+    response = None
+    while True:
+        try:
+            step = steps.send(response)
+        except StopIteration as stop:
+            yield {"type": "result", "result": stop.value}
+            return
+        response = None
+        if "type" in step:
+            yield step
+        elif step["call"] in ("critique", "edit"):
+            response = await scheduled_ainvoke(scheduler, step["runnable"], step["inputs"], step["config"])
+        elif step["call"] == "critique_batch":
+            response = await scheduled_abatch(scheduler, step["runnable"], step["inputs"], step["config"])
+        elif stream:
+            chunks = []
+            async for chunk in scheduled_astream(scheduler, step["runnable"], step["inputs"], step["config"]):
+                chunks.append(chunk.content)
+                yield {"type": "token", "attempt": step["attempt"], "text": chunk.content}
+            response = "".join(chunks)
+        else:
+            response = (await scheduled_ainvoke(scheduler, step["runnable"], step["inputs"], step["config"])).content
+
+
+def gan_feedback_loop(
+    model_generator_llm,  # LLM instance for Model 1
+    model_critic_llm,     # LLM instance for Model 2
+    prompt,
+    require_user_feedback=False,
+    require_user_confirmation=False,
+    min_score=8,
+    max_attempts=5,
+    stagnation_threshold=2,
+    min_change=None,
+    model_precheck_llm=None,
+    retention="full",
+    keep_last=3,
+    edit_mode=False,
+    critique_chunk_tokens=None,
+    chunk_cache=None,
+    metrics_sink=None,
+    scheduler=None,
+    checkpoint_path=None
+):
+    """
+    Implements a Generative-Adversarial inspired feedback loop between two LLMs using LangChain.
     
-    # Print the JSON result in a pretty format
-    pprint.pprint(result)
+    Parameters:
+    - model_generator_llm: The LLM instance for Model 1 (e.g., OpenAI model).
+    - model_critic_llm: The LLM instance for Model 2. Critiques scoring within the ambiguity band of
+      the "critic" escalation of the router are redone with its stronger model, see
+      `routing.ModelRouter`.
+    - prompt: The initial prompt to generate content.
+    - require_user_feedback: Boolean flag for user feedback between iterations.
+    - require_user_confirmation: Boolean flag for user confirmation between iterations.
+    - min_score: The minimum score to reach before stopping.
+    - max_attempts: Maximum number of iterations.
+    - stagnation_threshold: Number of iterations with no improvement before stopping.
+    - min_change: Minimum fraction of words changed since the last critiqued content for a new
+      critique (e.g. 0.05). Below it, the critic call is skipped: the last score is reused and the
+      iteration counts toward `stagnation_threshold`. None always critiques.
+    - model_precheck_llm: Optional cheaper critic LLM (structured with the same schema) run before
+      the critic from the second iteration on. If it predicts no improvement over the last score,
+      the critic call is skipped as above.
+    - retention: Which critiques the result keeps in `CritiqueHistory`: "full" (all of them),
+      "scores" (none, only `ScoreHistory`) or "last_n" (the last `keep_last`), so that batch runs
+      don't accumulate every critique in memory.
+    - keep_last: Number of critiques kept with the "last_n" retention.
+    - edit_mode: From the second iteration on, the generator returns patches to the sections of the
+      content (its blocks separated by blank lines) instead of rewriting all of it, and the critic
+      gets its previous critique and the changed sections only. Output and critic tokens then scale
+      with the size of the edits rather than of the content. Iterations changing nothing are not
+      critiqued and count toward `stagnation_threshold`. Not streamed token by token.
+    - critique_chunk_tokens: Optional token budget of a critic call. Longer content is split into
+      chunks of whole sections, critiqued concurrently with one batched call, and the critiques are
+      reduced into one (texts joined part by part, scores averaged by chunk size, suggestions and
+      questions concatenated). Chunk critiques are cached, so that the chunks an iteration leaves
+      unchanged are not critiqued again.
+    - chunk_cache: Optional cache of the chunk critiques (e.g. a `cache.MemoryCache`), to share
+      them between runs with the same critic. Defaults to a cache of the run.
+    - metrics_sink: Optional sink receiving a span for every LLM call (e.g. a `metrics.JSONLMetricsSink`).
+    - scheduler: Optional `ratelimit.RateLimitScheduler` shared with the other callers of the same quota.
+    - checkpoint_path: Optional file the loop state is saved to after every generator and critic
+      step, so that an interrupted run can be picked up with `resume_gan_feedback_loop`.
+    
+    Returns:
+    - A dictionary containing the final results, including the reason for stopping, final score, 
+      generated content, critique history (see `retention`), score history, and any user feedback
+      incorporated, plus the number of iterations and of skipped critiques and the calls, tokens,
+      latency and cost of the run and of each iteration. The result is logged to the module logger:
+      a one-line summary at INFO level and the whole dictionary at DEBUG level.
+    """
+    steps = _feedback_loop_steps(
+        model_generator_llm, model_critic_llm, prompt, require_user_feedback, require_user_confirmation,
+        min_score, max_attempts, stagnation_threshold, min_change, model_precheck_llm, retention, keep_last,
+        edit_mode, critique_chunk_tokens, chunk_cache, metrics_sink, checkpoint_path,
+        scheduled=scheduler is not None
+    )
+    return _run_to_result(steps, scheduler)
+
+
+def resume_gan_feedback_loop(model_generator_llm, model_critic_llm, checkpoint_path, scheduler=None, **loop_options):
+    """
+    Resumes a `gan_feedback_loop` run from its checkpoint, where it left off: a generated but
+    uncritiqued content is critiqued without being generated again. A finished run just returns
+    its result.
+
+    Parameters:
+    - model_generator_llm, model_critic_llm, scheduler: As for `gan_feedback_loop`.
+    - checkpoint_path: The `checkpoint_path` of the interrupted run. The checkpoint keeps being
+      updated as the run goes on.
+    - loop_options: Other keyword arguments of `gan_feedback_loop`. The settings of the interrupted
+      run (scores, attempts, thresholds, user interaction) are reused unless overridden.
+
+    Returns:
+    - The same dictionary as `gan_feedback_loop`, with the metrics of the whole run.
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    state = LoopState.from_dict(checkpoint["state"])
+    options = {**checkpoint["settings"], **loop_options}
+    steps = _feedback_loop_steps(
+        model_generator_llm, model_critic_llm, state.prompt, checkpoint_path=checkpoint_path, state=state,
+        scheduled=scheduler is not None, **options
+    )
+    return _run_to_result(steps, scheduler)
+
+
+def _run_to_result(steps, scheduler):
+    for event in _run_steps(steps, scheduler=scheduler):
+        if event["type"] == "result":
+            result = event["result"]
+    
+    log_result(result)
     
     return result
 
 
-# Load API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    raise ValueError("Please set the OPENAI_API_KEY environment variable.")
+async def _arun_to_result(steps, scheduler):
+    async for event in _arun_steps(steps, scheduler=scheduler):
+        if event["type"] == "result":
+            result = event["result"]
+
+    log_result(result)
+
+    return result
+
+
+def log_result(result):
+    """
+    Logs a one-line summary of a loop result at INFO level, and the whole result in a pretty
+    format at DEBUG level (only formatted when DEBUG is enabled).
+    """
+    logger.info(
+        "GAN feedback loop finished: %s Final score %s after %s iterations.",
+        result["ReasonToStop"], result["FinalScore"], result.get("Iterations", result.get("Rounds"))
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("GAN feedback loop result:\n%s", pprint.pformat(result))
+
+
+def gan_feedback_loop_stream(model_generator_llm, model_critic_llm, prompt, scheduler=None, **loop_options):
+    """
+    Streaming version of `gan_feedback_loop`: yields the generator tokens as they arrive, so that
+    the content can be shown while it is being written. The critic starts as soon as a generation
+    completes.
+
+    Parameters:
+    - model_generator_llm, model_critic_llm, prompt, scheduler: As for `gan_feedback_loop`.
+    - loop_options: The other keyword arguments of `gan_feedback_loop`. With
+      `require_user_confirmation`, the generated content is not printed again before asking.
+
+    Yields:
+    - Event dictionaries, by "type":
+      - "token": a chunk of generated text ("attempt", "text").
+      - "generation": the complete content of an iteration ("attempt", "content").
+      - "critique": the critique of an iteration ("attempt", "critique", "score", and "skipped" when
+        the last critique was reused).
+      - "result": the final dictionary of `gan_feedback_loop` ("result"), always last.
+
+    Example:
+        for event in gan_feedback_loop_stream(generator_llm, critic_llm, prompt):
+            if event["type"] == "token":
+                print(event["text"], end="", flush=True)
+    """
+    steps = _feedback_loop_steps(
+        model_generator_llm, model_critic_llm, prompt, echo_content=False, scheduled=scheduler is not None,
+        **loop_options
+    )
+    yield from _run_steps(steps, stream=True, scheduler=scheduler)
+
+
+async def agan_feedback_loop_stream(model_generator_llm, model_critic_llm, prompt, scheduler=None, **loop_options):
+    """
+    Async iterator version of `gan_feedback_loop_stream`, yielding the same events.
+    Interactive feedback and confirmation read from stdin and block the event loop, avoid them here.
+    """
+    steps = _feedback_loop_steps(
+        model_generator_llm, model_critic_llm, prompt, echo_content=False, scheduled=scheduler is not None,
+        **loop_options
+    )
+    async for event in _arun_steps(steps, stream=True, scheduler=scheduler):
+        yield event
+
+
+async def agan_feedback_loop(model_generator_llm, model_critic_llm, prompt, scheduler=None, **loop_options):
+    """
+    Async version of `gan_feedback_loop`, without streaming. Returns and logs the same dictionary.
+    """
+    steps = _feedback_loop_steps(
+        model_generator_llm, model_critic_llm, prompt, scheduled=scheduler is not None, **loop_options
+    )
+    return await _arun_to_result(steps, scheduler)
+
+
+def gan_beam_feedback_loop(
+    model_generator_llm,
+    model_critic_llm,
+    prompt,
+    beam_width=3,
+    top_k=1,
+    min_score=8,
+    max_attempts=5,
+    stagnation_threshold=2,
+    max_concurrency=None,
+    metrics_sink=None,
+    scheduler=None
+):
+    """
+    Beam variant of `gan_feedback_loop`: generates `beam_width` candidates per round in parallel,
+    critiques them with batched critic calls and keeps the `top_k` best ones for the next round.
+    Reaches the target score in fewer sequential rounds, at the cost of more calls per round.
+    User feedback and confirmation are not supported in this mode.
+
+    Parameters:
+    - model_generator_llm: The LLM instance for Model 1. Use a non-zero temperature so that the
+      candidates of a round differ.
+    - model_critic_llm: The LLM instance for Model 2.
+    - prompt: The initial prompt to generate content.
+    - beam_width: Number of candidates generated per round.
+    - top_k: Number of candidates kept for the next round.
+    - min_score: The minimum score to reach before stopping.
+    - max_attempts: Maximum number of rounds.
+    - stagnation_threshold: Number of rounds with no improvement before stopping.
+    - max_concurrency: Maximum number of parallel calls per batch (unbounded if None).
+    - metrics_sink: Optional sink receiving a span for every LLM call.
+    - scheduler: Optional `ratelimit.RateLimitScheduler` shared with the other callers of the same quota.
+
+    Returns:
+    - The same dictionary as `gan_feedback_loop`, with the number of rounds and critic calls.
+    """
+    model1_chain, model2_chain = build_chains(model_generator_llm, model_critic_llm)
+    recorder = MetricsRecorder(sink=metrics_sink)
+    generator_config = {**chain_config(recorder, "generator"), "max_concurrency": max_concurrency}
+    critic_config = {**chain_config(recorder, "critic"), "max_concurrency": max_concurrency}
+    router = get_router()
+    escalated_chain = None
+    if router.escalation_model_name("critic"):
+        escalated_chain = build_chains(
+            model_generator_llm, get_critic_llm(router.escalation_model_name("critic"), scheduled=scheduler is not None)
+        )[1]
+    escalation_config = {**chain_config(recorder, "critic_escalation"), "max_concurrency": max_concurrency}
+
+    def generate(parents):
+        if parents[0] is None:
+            responses = scheduled_batch(scheduler, model_generator_llm, [prompt] * len(parents), generator_config)
+        else:
+            responses = scheduled_batch(scheduler, model1_chain, [
+                {
+                    "original_content": parent["content"],
+                    "critique": parent["critique"].get('Critique', ''),
+                    "followup_suggestions": "\n".join(parent["critique"].get('FollowUpSuggestions', [])),
+                    "user_feedback": ""
+                }
+                for parent in parents
+            ], generator_config)
+        return [response.content for response in responses]
+
+    def critique(contents, parents):
+        inputs = [{"content_to_critique": content} for content in contents]
+        critiques = scheduled_batch(scheduler, model2_chain, inputs, critic_config)
+        # Redo the ambiguous critiques with the stronger model, in one batched call
+        ambiguous = [
+            i for i, critique_json in enumerate(critiques)
+            if escalated_chain is not None and router.needs_escalation("critic", critique_json.get("Score"))
+        ]
+        if ambiguous:
+            critiques = list(critiques)
+            escalated = scheduled_batch(scheduler, escalated_chain, [inputs[i] for i in ambiguous], escalation_config)
+            for i, critique_json in zip(ambiguous, escalated):
+                critiques[i] = critique_json
+        return critiques
+
+    search = beam_search(
+        generate,
+        critique,
+        "Score",
+        beam_width=beam_width,
+        top_k=top_k,
+        min_score=min_score,
+        max_attempts=max_attempts,
+        stagnation_threshold=stagnation_threshold
+    )
+
+    return {
+        "ReasonToStop": search["ReasonToStop"],
+        "FinalScore": search["FinalScore"],
+        "ContentGenerated": search["BestCandidate"]["content"] if search["BestCandidate"] else "",
+        "CritiqueHistory": search["CritiqueHistory"],
+        "UserFeedbackIncorporated": None,
+        "Rounds": search["Rounds"],
+        "CriticCalls": search["CriticCalls"],
+        "Metrics": recorder.summary()
+    }
 
-# Replace 'your-openai-api-key' with your actual API key
-generator_llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=openai_api_key)
 
 # Define JSON schema for critic LLM
 json_schema = {
@@ -205,22 +875,54 @@ json_schema = {
     "required": ["Critique", "ClarifyingQuestions", "Score", "FollowUpSuggestions"]
 }
 
-critic_llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=openai_api_key).with_structured_output(json_schema)
 
-input_prompt = input("Add here your request: ")
+@lru_cache(maxsize=None)
+def get_generator_llm(model=None, scheduled=False):
+    """
+    Returns the generator LLM, creating it on first use and reusing it afterwards.
+    Defaults to the model the router assigns to the "generator" stage, see `routing.get_router`.
+    Set `scheduled` when its calls go through a `ratelimit.RateLimitScheduler`, which retries
+    them: the client then does not retry on its own.
+    """
+    return make_chat_model(model or get_router().model_name("generator"), scheduled=scheduled)
 
-result = gan_feedback_loop(
-    model_generator_llm=generator_llm,
-    model_critic_llm=critic_llm,
-    prompt=input_prompt,
-    require_user_feedback=False,
-    require_user_confirmation=False,
-    min_score=85,
-    max_attempts=6,
-    stagnation_threshold=3
-)
 
+@lru_cache(maxsize=None)
+def get_critic_llm(model=None, scheduled=False):
+    """
+    Returns the critic LLM with structured output, creating it on first use and reusing it afterwards.
+    Defaults to the model the router assigns to the "critic" stage, see `routing.get_router`.
+    See `get_generator_llm` for `scheduled`.
+    """
+    return make_chat_model(
+        model or get_router().model_name("critic"), scheduled=scheduled
+    ).with_structured_output(json_schema)
+
+
+def main():
+    input_prompt = input("Add here your request: ")
+
+    # Show the content while it is being generated
+    for event in gan_feedback_loop_stream(
+        model_generator_llm=get_generator_llm(),
+        model_critic_llm=get_critic_llm(),
+        prompt=input_prompt,
+        require_user_feedback=False,
+        require_user_confirmation=False,
+        min_score=85,
+        max_attempts=6,
+        stagnation_threshold=3
+    ):
+        if event["type"] == "token":
+            print(event["text"], end="", flush=True)
+        elif event["type"] == "critique":
+            print(f"\n\nScore: {event['score']}\n")
+        elif event["type"] == "result":
+            result = event["result"]
+
+    print("Reason to Stop:", result['ReasonToStop'])
+    print("Final Score:", result['FinalScore'])
+    print("Generated Content:\n", result['ContentGenerated'])
 
-print("Reason to Stop:", result['ReasonToStop'])
-print("Final Score:", result['FinalScore'])
-print("Generated Content:\n", result['ContentGenerated'])
+if __name__ == "__main__":
+    main()
@@ -1,155 +1,874 @@
-import os, json
-from langchain_openai import ChatOpenAI
+import json, asyncio, contextvars, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from cache import MemoryCache, cache_key
+from chunked import CHUNK_HEADER, chunk_content, reduce_critiques
+from tokens import count_tokens
+from answers import CommandLineAnswers, resolve_answer_provider
+from models import make_chat_model
+from routing import get_router
+from near_duplicates import same_prompt
+from prompt_budget import PromptBuilder
+from metrics import MetricsRecorder, chain_config
+from ratelimit import scheduled_invoke, scheduled_ainvoke, scheduled_batch, scheduled_abatch
+from ensemble import sample_until_confident, asample_until_confident, difference_interval
 from langchain_core.prompts import ChatPromptTemplate
-from dotenv import load_dotenv
 from custom_prompts import prompt_optimization_job, prompt_optimization_system_prompt
 from custom_prompts import prompt_critique_system_prompt, prompt_critique_request
 
-def optimize_prompt(prompt_to_optimize, context=None):
+logger = logging.getLogger(__name__)
+
+# Define JSON schema for the optimization chain
+OPTIMIZED_PROMPT_SCHEMA = {
+    "title": "optimizedPrompt",
+    "description": "Prompt optimized",
+    "type": "object",
+    "properties": {
+        "optimizedPrompt": {
+            "type": "string",
+            "description": "A string containing the best prompt you can generate, given all the context",
+        },
+        "clarifyingQuestions": {
+            "type": "array",
+            "items": {"type": "string"},
+            "description": "Questions for the user to further improve the prompt",
+        },
+    },
+    "required": ["optimizedPrompt", "clarifyingQuestions"],
+}
+
+# Define JSON schema for the critique chain
+PROMPT_CRITIQUE_SCHEMA = {
+    "title": "promptCritique",
+    "description": "Critique of a prompt including reasoning and a score.",
+    "type": "object",
+    "properties": {
+        "reasoning": {
+            "type": "string",
+            "description": "The detailed reasoning for the critique, including a breakdown of the analysis.",
+        },
+        "score": {
+            "type": "number",
+            "description": "The final score of the prompt, from 0 to 1.",
+            "minimum": 0,
+            "maximum": 1,
+        },
+    },
+    "required": ["reasoning", "score"],
+}
+
+
+def _combine_context(qa_pairs, context):
     """
-    Optimizes a given prompt by generating clarifying questions and refining it based on user input.
-    
-    Args:
-        prompt_to_optimize (str): The prompt to optimize.
-    
-    Returns:
-        tuple: A tuple containing the optimized prompt and a list of tuples with questions and user answers.
+    Joins the user answers and the optional additional context into a single string.
     """
-    load_dotenv()
-
-    # Load API key from environment variables
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    if not openai_api_key:
-        raise ValueError("Please set the OPENAI_API_KEY environment variable.")
-
-    # Initialize the model
-    model = ChatOpenAI(model="gpt-4o-mini", openai_api_key=openai_api_key)
-
-    # Define JSON schema
-    json_schema = {
-        "title": "optimizedPrompt",
-        "description": "Prompt optimized",
-        "type": "object",
-        "properties": {
-            "optimizedPrompt": {
-                "type": "string",
-                "description": "A string containing the best prompt you can generate, given all the context",
-            },
-            "clarifyingQuestions": {
-                "type": "array",
-                "items": {"type": "string"},
-                "description": "Questions for the user to further improve the prompt",
-            },
-        },
-        "required": ["optimizedPrompt", "clarifyingQuestions"],
+    combined_context = (
+        "\n".join(answer for _, answer in qa_pairs)  # Answers from qa_pairs as a single string
+    )
+    if context:  # Include additional context if provided
+        combined_context += f"\n{context}"
+    return combined_context
+
+
+def _seed_context(neighbour, context):
+    """
+    Adds the optimized version of a near-duplicate prompt, if any, to the additional context.
+    """
+    if neighbour is None:
+        return context
+    reference = f"Optimized version of a near-identical prompt, for reference:\n{neighbour['optimized_prompt']}"
+    return f"{context}\n{reference}" if context else reference
+
+
+def _trivial_answers(user_answers):
+    """
+    Tells whether the user answers add nothing to the prompt (all of them blank).
+    """
+    return all(not answer.strip() for answer in user_answers)
+
+
+def _ensemble_result(critiques, statistics):
+    """
+    Builds an ensemble critique: the reasoning of the sample closest to the mean score, with the
+    statistics of all the samples.
+    """
+    closest = min(critiques, key=lambda critique: abs(critique["score"] - statistics["mean"]))
+    return {
+        "reasoning": closest["reasoning"],
+        "score": statistics["mean"],
+        "variance": statistics["variance"],
+        "ci": statistics["ci"],
+        "samples": statistics["samples"],
+        "scores": [critique["score"] for critique in critiques],
     }
 
-    # Initialize structured LLM with schema
-    structured_llm = model.with_structured_output(json_schema)
 
-    # Create prompt template
-    prompt_template = ChatPromptTemplate.from_messages(
-        [("system", prompt_optimization_system_prompt), ("user", prompt_optimization_job)]
-    )
+def _benchmark_result(optimized_prompt, original_critique_result, optimized_critique_result, recorder,
+                      confidence=0.95):
+    """
+    Builds the `optimize_and_benchmark` result dictionary.
+    """
+    score_difference = optimized_critique_result["score"] - original_critique_result["score"]
 
-    # Combine template and model into a chain
-    chain = prompt_template | structured_llm
+    result = {
+        "optimized_prompt": optimized_prompt,
+        "score_difference": score_difference,
+        "original_critique_result_score": original_critique_result["score"],
+        "optimized_critique_result_score": optimized_critique_result["score"],
+        "original_critique_result": original_critique_result,
+        "optimized_critique_result": optimized_critique_result,
+        "metrics": recorder.summary()
+    }
+    if "samples" in original_critique_result:
+        # Ensemble critiques: tell whether the difference stands out of the sampling noise
+        result["score_difference_ci"] = difference_interval(*(
+            {"mean": critique["score"], "variance": critique["variance"], "samples": critique["samples"]}
+            for critique in (original_critique_result, optimized_critique_result)
+        ), confidence=confidence)
+        result["significant"] = not result["score_difference_ci"][0] <= 0 <= result["score_difference_ci"][1]
+    return result
 
-    # Step 1: Generate clarifying questions
-    response = chain.invoke({"prompt_to_optimize": prompt_to_optimize, "context": context})
 
-    # Step 2: Collect user answers and create a list of question-answer tuples
-    clarifying_questions = response["clarifyingQuestions"]
-    qa_pairs = []
-    for question in clarifying_questions:
-        user_answer = input(f"Answer to '{question}': ")  # Collect user input
-        qa_pairs.append((question, user_answer))
+async def _ainvoke(chain, inputs, semaphore=None, config=None, scheduler=None):
+    """
+    Invokes a chain asynchronously, holding `semaphore` (if any) for the duration of the call
+    and going through the rate limit `scheduler` (if any).
+    """
+    if semaphore is None:
+        return await scheduled_ainvoke(scheduler, chain, inputs, config)
+    async with semaphore:
+        return await scheduled_ainvoke(scheduler, chain, inputs, config)
 
-    # Step 3: Refine the prompt with user answers
-    combined_context = (
-        "\n".join(answer for _, answer in qa_pairs)  # Answers from qa_pairs as a single string
-    )
-    if context:  # Include additional context if provided
-        combined_context += f"\n{context}"
 
-    refined_response = chain.invoke({
-        "prompt_to_optimize": prompt_to_optimize,
-        "context": combined_context,  # Use the combined string for context
-    })
-    
+class _LoopLocalTransport(httpx.AsyncBaseTransport):
+    """
+    Async HTTP transport keeping one connection pool per event loop.
 
-    # Return the final optimized prompt and the QA pairs
-    return refined_response["optimizedPrompt"], qa_pairs
+    The connections of an `httpx.AsyncClient` belong to the event loop that opened them, so a
+    client used by several `asyncio.run` calls in turn fails on the loops after the first one.
+    The pools of the loops closed since are dropped when a new one is created.
+    """
 
+    def __init__(self, limits):
+        self.limits = limits
+        self._transports = {}
+        self._lock = threading.Lock()
+
+    def _transport(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._transports.get(loop)
+            if transport is None:
+                # Their connections reference the loop, so they cannot be weakly keyed by it
+                for closed in [other for other in self._transports if other.is_closed()]:
+                    del self._transports[closed]
+                transport = self._transports[loop] = httpx.AsyncHTTPTransport(limits=self.limits)
+        return transport
+
+    async def handle_async_request(self, request):
+        return await self._transport().handle_async_request(request)
+
+    async def aclose(self):
+        # Only the pool of the running loop can be closed from it
+        with self._lock:
+            transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+class PromptOptimizer:
+    """
+    Reusable client for prompt optimization and critique.
 
+    The models, the structured-output chains and the HTTP clients are built once, when the
+    client is created, and shared by every call. All calls go through the same pooled HTTP
+    connections, so high-QPS callers don't pay the setup and connection costs per request.
+    The instance is safe to share between threads, and between event loops: the async calls get
+    a connection pool per event loop, e.g. per `asyncio.run` call.
 
-def critique_prompt(prompt_to_analyze):
+    Each stage (question generation, refinement, critique) uses the model its router assigns
+    to it, and ambiguous critiques can be escalated to a stronger model, see `routing.ModelRouter`.
+
+    Args:
+        model (str, optional): The OpenAI chat model of the stages without a route. Defaults to
+            the default model of the router.
+        openai_api_key (str, optional): Defaults to the OPENAI_API_KEY environment variable.
+        max_connections (int): Maximum number of pooled HTTP connections.
+        max_keepalive_connections (int): Maximum number of idle connections kept open.
+        timeout (float): HTTP timeout in seconds.
+        critique_cache (optional): Cache for critique responses, e.g. a `cache.TieredCache`.
+            Any object with `get(key)` and `set(key, value)` methods can be used. The chunk
+            critiques of `critique_prompt_chunked` go to it too, or to an in-memory cache without it.
+        llm (BaseChatModel, optional): Use this chat model instead of creating one for `model`,
+            e.g. a `fake_llm.FakeChatModel`. The HTTP client settings are then ignored. Stages
+            routed to other models still get their own.
+        metrics_sink (optional): Receives a span for every LLM call, e.g. a `metrics.JSONLMetricsSink`.
+        scheduler (ratelimit.RateLimitScheduler, optional): Rate limits and retries every LLM call.
+            Share one scheduler between all the clients and loops using the same quota.
+        router (routing.ModelRouter, optional): Assigns the models of the stages. Defaults to the
+            process-wide router, configured by the PROMPT_OPTIMIZER_MODELS environment variable.
+        max_prompt_tokens (int, optional): Token budget of each optimization call. The context
+            (additional context and user answers) is truncated deterministically to fit it, or left
+            out with a warning when the prompt alone is over the budget.
+        speculative_refinement (bool): When the answers don't come from the command line, start the
+            refinement without answers at the same time as the question generation. If the answers
+            turn out to be blank, the speculative refinement is used and the prompt is optimized in
+            about the time of one call; otherwise it is discarded and the refinement runs as usual.
+        prompt_index (near_duplicates.NearDuplicateIndex, optional): Remembers the optimized prompts.
+            The near-duplicates of an optimized prompt, with the same context, skip the question
+            generation: its clarifying questions are reused, and its optimized prompt is given to the
+            refinement as reference. A prompt differing from it only by whitespace or casing gets
+            its optimized prompt back without any call, if both were optimized without answers.
     """
-    Critiques a given prompt and returns a JSON with reasoning and a score.
+
+    def __init__(self, model=None, openai_api_key=None, max_connections=100,
+                 max_keepalive_connections=20, timeout=60.0, critique_cache=None, llm=None,
+                 metrics_sink=None, scheduler=None, router=None, max_prompt_tokens=None,
+                 speculative_refinement=False, prompt_index=None):
+        self.router = router or get_router()
+        model = model or self.router.default
+        self.model_name = model
+        self.metrics_sink = metrics_sink
+        self.scheduler = scheduler
+        self.speculative_refinement = speculative_refinement
+        self.prompt_index = prompt_index
+        self._speculation_executor = None
+        self._speculation_lock = threading.Lock()
+        self._model_kwargs = {
+            "openai_api_key": openai_api_key,
+            # Retries are left to the scheduler when there is one
+            "scheduled": scheduler is not None,
+        }
+        if llm is None:
+            # Shared connection pools for the sync and async code paths, and for all the models
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+            self.http_client = httpx.Client(limits=limits, timeout=timeout)
+            self.http_async_client = httpx.AsyncClient(timeout=timeout, transport=_LoopLocalTransport(limits))
+            self._model_kwargs.update(http_client=self.http_client, http_async_client=self.http_async_client)
+            self._models = {}
+        else:
+            self.http_client = None
+            self.http_async_client = None
+            self._models = {model: llm}
+        self.model = self._chat_model(model)
+
+        # Combine templates and structured models into chains, with the model of each stage
+        optimization_template = ChatPromptTemplate.from_messages(
+            [("system", prompt_optimization_system_prompt), ("user", prompt_optimization_job)]
+        )
+        critique_template = ChatPromptTemplate.from_messages(
+            [("system", prompt_critique_system_prompt), ("user", prompt_critique_request)]
+        )
+        self.questions_chain = optimization_template | self._stage_model("questions").with_structured_output(
+            OPTIMIZED_PROMPT_SCHEMA
+        )
+        self.refinement_chain = optimization_template | self._stage_model("refinement").with_structured_output(
+            OPTIMIZED_PROMPT_SCHEMA
+        )
+        self.critique_chain = critique_template | self._stage_model("critique").with_structured_output(
+            PROMPT_CRITIQUE_SCHEMA
+        )
+        self.optimization_builder = None
+        if max_prompt_tokens is not None:
+            self.optimization_builder = PromptBuilder(optimization_template, max_prompt_tokens, ("context",), model)
+        escalation_model = self.router.escalation_model_name("critique")
+        self.escalated_critique_chain = None
+        if escalation_model:
+            self.escalated_critique_chain = critique_template | self._chat_model(escalation_model).with_structured_output(
+                PROMPT_CRITIQUE_SCHEMA
+            )
+
+        # Critiques are cached on everything that determines the response
+        self.critique_cache = critique_cache
+        self.chunk_cache = critique_cache if critique_cache is not None else MemoryCache()
+        self._critique_cache_namespace = cache_key(
+            self.router.model_name("critique", model), self.router.escalation.get("critique"),
+            prompt_critique_system_prompt, prompt_critique_request, PROMPT_CRITIQUE_SCHEMA
+        )
+
+    def _chat_model(self, name):
+        """
+        Returns the chat model `name`, created on first use with the shared HTTP clients.
+        """
+        if name not in self._models:
+            self._models[name] = make_chat_model(name, **self._model_kwargs)
+        return self._models[name]
+
+    def _stage_model(self, stage):
+        return self._chat_model(self.router.model_name(stage, self.model_name))
+
+    def _speculates(self, answer_provider):
+        """Tells whether to refine speculatively: enabled, and the answers don't come from a person."""
+        return self.speculative_refinement and not isinstance(answer_provider, CommandLineAnswers)
+
+    def _speculate(self, *args):
+        """
+        Runs `scheduled_invoke(*args)` in the background, in the current context (e.g. the call priority).
+        """
+        if self._speculation_executor is None:
+            with self._speculation_lock:
+                if self._speculation_executor is None:
+                    self._speculation_executor = ThreadPoolExecutor(thread_name_prefix="speculative-refinement")
+        return self._speculation_executor.submit(contextvars.copy_context().run, scheduled_invoke, *args)
+
+    def _near_duplicate(self, prompt_to_optimize, context):
+        """
+        Looks up the optimization of a near-duplicate of `prompt_to_optimize` with the same context.
+
+        Returns:
+            tuple: The indexed optimization (None without a near-duplicate), and whether it can be
+            reused as is if the answers turn out to be blank: the same prompt up to whitespace and
+            casing, and optimized without answers itself.
+        """
+        if self.prompt_index is None:
+            return None, False
+        found = self.prompt_index.lookup(prompt_to_optimize, accept=lambda value: value["context"] == context)
+        if found is None:
+            return None, False
+        _, indexed_prompt, neighbour = found
+        return neighbour, same_prompt(indexed_prompt, prompt_to_optimize) and neighbour["trivial_answers"]
+
+    def _index_optimization(self, prompt_to_optimize, context, clarifying_questions, qa_pairs, optimized_prompt):
+        if self.prompt_index is not None:
+            self.prompt_index.add(prompt_to_optimize, {
+                "context": context,
+                "questions": clarifying_questions,
+                "qa_pairs": qa_pairs,
+                "trivial_answers": _trivial_answers(answer for _, answer in qa_pairs),
+                "optimized_prompt": optimized_prompt,
+            })
+
+    def _optimization_inputs(self, prompt_to_optimize, context):
+        """
+        Builds the inputs of the optimization chains, fitting the context to the token budget if any.
+        """
+        inputs = {"prompt_to_optimize": prompt_to_optimize, "context": context}
+        if self.optimization_builder is not None:
+            try:
+                inputs, _ = self.optimization_builder.build(inputs)
+            except ValueError as e:
+                # The prompt alone is over the budget: send it as is, only the context can be dropped
+                logger.warning("%s The context is left out.", e)
+                inputs["context"] = ""
+        return inputs
+
+    def close(self):
+        """Closes the synchronous HTTP client. Use `aclose` to close the async one."""
+        if self._speculation_executor is not None:
+            self._speculation_executor.shutdown(wait=False)
+        if self.http_client is not None:
+            self.http_client.close()
+
+    async def aclose(self):
+        """Closes both HTTP clients. Only the async connections of the running event loop are closed."""
+        self.close()
+        if self.http_async_client is not None:
+            await self.http_async_client.aclose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def _recorder(self, recorder):
+        """
+        Returns the recorder a call reports to: the given one, or a new one feeding the
+        metrics sink, or None if metrics are not collected.
+        """
+        if recorder is None and self.metrics_sink is not None:
+            recorder = MetricsRecorder(sink=self.metrics_sink)
+        return recorder
+
+    def optimize_prompt(self, prompt_to_optimize, context=None, answers=None, recorder=None):
+        """
+        Optimizes a given prompt by generating clarifying questions and refining it based on user input.
+
+        Args:
+            prompt_to_optimize (str): The prompt to optimize.
+            context (str, optional): Additional context to take into account.
+            answers (optional): How the clarifying questions get answered: an `answers.AnswerProvider`,
+                a function called with each question, a dict of question to answer, or "skip".
+                Defaults to asking the user on the command line.
+            recorder (metrics.MetricsRecorder, optional): Records the LLM calls.
+
+        Returns:
+            tuple: A tuple containing the optimized prompt and a list of tuples with questions and user answers.
+        """
+        recorder = self._recorder(recorder)
+        answer_provider = resolve_answer_provider(answers)
+
+        # Step 0: Look for the optimization of a near-duplicate prompt to start from
+        neighbour, reusable = self._near_duplicate(prompt_to_optimize, context)
+
+        # Step 1: Generate clarifying questions, and speculatively refine the prompt without answers
+        speculation = None
+        if neighbour is not None:
+            # The questions of the near-duplicate apply to this prompt too
+            clarifying_questions = neighbour["questions"]
+        else:
+            if self._speculates(answer_provider):
+                speculation = self._speculate(
+                    self.scheduler, self.refinement_chain, self._optimization_inputs(prompt_to_optimize, context),
+                    chain_config(recorder, "refinement", speculative=True),
+                )
+            response = scheduled_invoke(
+                self.scheduler, self.questions_chain, self._optimization_inputs(prompt_to_optimize, context),
+                chain_config(recorder, "questions"),
+            )
+            clarifying_questions = response["clarifyingQuestions"]
+
+        # Step 2: Collect user answers and create a list of question-answer tuples
+        user_answers = answer_provider.answer(prompt_to_optimize, clarifying_questions, recorder)
+        qa_pairs = list(zip(clarifying_questions, user_answers))
+
+        # Step 3: Refine the prompt with user answers, unless the near-duplicate or the speculative
+        # refinement can be used
+        if reusable and _trivial_answers(user_answers):
+            return neighbour["optimized_prompt"], qa_pairs
+        refined_response = None
+        if speculation is not None:
+            if _trivial_answers(user_answers):
+                try:
+                    refined_response = speculation.result()
+                except Exception:
+                    pass  # Refine normally instead
+            else:
+                speculation.cancel()  # The answers add information, the speculation is discarded
+        if refined_response is None:
+            refined_response = scheduled_invoke(
+                self.scheduler, self.refinement_chain,
+                # Use the combined string for context
+                self._optimization_inputs(prompt_to_optimize, _combine_context(qa_pairs, _seed_context(neighbour, context))),
+                chain_config(recorder, "refinement", seeded=neighbour is not None),
+            )
+
+        # Return the final optimized prompt and the QA pairs
+        optimized_prompt = refined_response["optimizedPrompt"]
+        self._index_optimization(prompt_to_optimize, context, clarifying_questions, qa_pairs, optimized_prompt)
+        return optimized_prompt, qa_pairs
+
+    def critique_prompt(self, prompt_to_analyze, recorder=None):
+        """
+        Critiques a given prompt and returns a JSON with reasoning and a score.
+
+        Args:
+            prompt_to_analyze (str): The prompt to analyze.
+            recorder (metrics.MetricsRecorder, optional): Records the LLM call.
+
+        Returns:
+            dict: A JSON object containing the reasoning (text) and the score (float from 0 to 1).
+        """
+        cached = self._cached_critique(prompt_to_analyze)
+        if cached is not None:
+            return cached
+
+        # Invoke the chain with the input prompt
+        recorder = self._recorder(recorder)
+        response = scheduled_invoke(
+            self.scheduler, self.critique_chain, {"current_prompt": prompt_to_analyze},
+            chain_config(recorder, "critique"),
+        )
+
+        # Redo ambiguous critiques with the stronger model, if the router escalates them
+        if self.router.needs_escalation("critique", response["score"]):
+            response = scheduled_invoke(
+                self.scheduler, self.escalated_critique_chain, {"current_prompt": prompt_to_analyze},
+                chain_config(recorder, "critique_escalation"),
+            )
+
+        # Return the reasoning and score as a JSON object
+        return self._store_critique(prompt_to_analyze, response)
+
+    def critique_prompt_ensemble(self, prompt_to_analyze, recorder=None, **sampling):
+        """
+        Critiques a prompt with several sampled critiques instead of a single noisy one. Samples are
+        drawn in batched calls until the confidence interval of their mean score is tight enough.
+
+        Args:
+            prompt_to_analyze (str): The prompt to analyze.
+            recorder (metrics.MetricsRecorder, optional): Records the LLM calls.
+            **sampling: `min_samples`, `max_samples`, `batch_size`, `tolerance` and `confidence`,
+                see `ensemble.sample_until_confident`.
+
+        Returns:
+            dict: The reasoning of the sample closest to the mean, the mean score, its variance and
+            confidence interval (`ci`), the number of samples and their scores.
+        """
+        inputs = {"current_prompt": prompt_to_analyze}
+        config = chain_config(self._recorder(recorder), "critique", ensemble=True)
+        critiques, statistics = sample_until_confident(
+            lambda count: scheduled_batch(self.scheduler, self.critique_chain, [inputs] * count, config),
+            "score", **sampling
+        )
+        return _ensemble_result(critiques, statistics)
+
+    def critique_prompt_chunked(self, prompt_to_analyze, max_chunk_tokens=2000, recorder=None):
+        """
+        Critiques a long prompt in chunks: it is split into chunks of whole sections, the chunks are
+        critiqued concurrently with one batched call, and their critiques reduced into one. Chunk
+        critiques are cached, so only the chunks that changed are critiqued again.
+
+        Args:
+            prompt_to_analyze (str): The prompt to analyze.
+            max_chunk_tokens (int): Token budget of a chunk. A prompt within it is critiqued whole,
+                as by `critique_prompt`.
+            recorder (metrics.MetricsRecorder, optional): Records the LLM calls.
+
+        Returns:
+            dict: The critiques of the chunks joined part by part as the reasoning, and their scores
+            averaged by chunk size as the score.
+        """
+        chunks = chunk_content(prompt_to_analyze, max_chunk_tokens, self.model_name)
+        if len(chunks) <= 1:
+            return self.critique_prompt(prompt_to_analyze, recorder=recorder)
+        critiques, missing = self._cached_chunk_critiques(chunks)
+        if missing:
+            responses = scheduled_batch(
+                self.scheduler, self.critique_chain, [{"current_prompt": CHUNK_HEADER + chunks[i]} for i in missing],
+                chain_config(self._recorder(recorder), "critique", chunked=True),
+            )
+            self._store_chunk_critiques(chunks, critiques, missing, responses)
+        return self._reduce_chunk_critiques(chunks, critiques)
+
+    def _cached_chunk_critiques(self, chunks):
+        """
+        Returns the cached critique of every chunk (None on a miss), and the indices of the missing ones.
+        """
+        critiques = [self.chunk_cache.get(self._critique_cache_key(CHUNK_HEADER + chunk)) for chunk in chunks]
+        return critiques, [i for i, critique in enumerate(critiques) if critique is None]
+
+    def _store_chunk_critiques(self, chunks, critiques, missing, responses):
+        for i, response in zip(missing, responses):
+            critiques[i] = {"reasoning": response["reasoning"], "score": response["score"]}
+            self.chunk_cache.set(self._critique_cache_key(CHUNK_HEADER + chunks[i]), critiques[i])
+
+    def _reduce_chunk_critiques(self, chunks, critiques):
+        weights = [count_tokens(chunk, self.model_name) for chunk in chunks]
+        return reduce_critiques(critiques, weights, "reasoning", "score")
+
+    def _critique_cache_key(self, prompt_to_analyze):
+        return cache_key(self._critique_cache_namespace, {"current_prompt": prompt_to_analyze})
+
+    def _cached_critique(self, prompt_to_analyze):
+        """
+        Returns the cached critique of `prompt_to_analyze`, or None if caching is disabled or on a miss.
+        """
+        if self.critique_cache is None:
+            return None
+        return self.critique_cache.get(self._critique_cache_key(prompt_to_analyze))
+
+    def _store_critique(self, prompt_to_analyze, response):
+        """
+        Extracts the reasoning and score from a critique response and caches them.
+        """
+        critique = {
+            "reasoning": response["reasoning"],
+            "score": response["score"]
+        }
+        if self.critique_cache is not None:
+            self.critique_cache.set(self._critique_cache_key(prompt_to_analyze), critique)
+        return critique
+
+    def optimize_and_benchmark(self, prompt, answers=None, ensemble=None):
+        """
+        Optimize a given prompt, critique both the original and optimized versions,
+        and compare their performance. See the module-level `optimize_and_benchmark`.
+        """
+        recorder = MetricsRecorder(sink=self.metrics_sink)
+        if ensemble is None:
+            critique = self.critique_prompt
+        else:
+            critique = lambda prompt_to_analyze, recorder: self.critique_prompt_ensemble(
+                prompt_to_analyze, recorder=recorder, **ensemble
+            )
+        original_critique_result = critique(prompt, recorder=recorder)
+        optimized_prompt, qa_pairs = self.optimize_prompt(prompt, answers=answers, recorder=recorder)
+        optimized_critique_result = critique(optimized_prompt, recorder=recorder)
+        return _benchmark_result(
+            optimized_prompt, original_critique_result, optimized_critique_result, recorder,
+            **({"confidence": ensemble["confidence"]} if ensemble and "confidence" in ensemble else {})
+        )
+
+    async def aoptimize_prompt(self, prompt_to_optimize, context=None, answers=None, semaphore=None,
+                               recorder=None):
+        """
+        Async version of `optimize_prompt`.
+
+        Args:
+            prompt_to_optimize (str): The prompt to optimize.
+            context (str, optional): Additional context to take into account.
+            answers (optional): How the clarifying questions get answered, see `optimize_prompt`.
+                Functions may also return an awaitable.
+            semaphore (asyncio.Semaphore, optional): Bounds the number of concurrent LLM calls.
+            recorder (metrics.MetricsRecorder, optional): Records the LLM calls.
+
+        Returns:
+            tuple: A tuple containing the optimized prompt and a list of tuples with questions and user answers.
+        """
+        recorder = self._recorder(recorder)
+        answer_provider = resolve_answer_provider(answers)
+
+        # Step 0: Look for the optimization of a near-duplicate prompt to start from
+        neighbour, reusable = self._near_duplicate(prompt_to_optimize, context)
+
+        # Step 1: Generate clarifying questions, and speculatively refine the prompt without answers
+        speculation = None
+        if neighbour is None and self._speculates(answer_provider):
+            speculation = asyncio.ensure_future(_ainvoke(
+                self.refinement_chain, self._optimization_inputs(prompt_to_optimize, context), semaphore,
+                chain_config(recorder, "refinement", speculative=True), self.scheduler,
+            ))
+        try:
+            if neighbour is not None:
+                # The questions of the near-duplicate apply to this prompt too
+                clarifying_questions = neighbour["questions"]
+            else:
+                response = await _ainvoke(
+                    self.questions_chain, self._optimization_inputs(prompt_to_optimize, context), semaphore,
+                    chain_config(recorder, "questions"), self.scheduler,
+                )
+                clarifying_questions = response["clarifyingQuestions"]
+
+            # Step 2: Collect user answers and create a list of question-answer tuples
+            user_answers = await answer_provider.aanswer(prompt_to_optimize, clarifying_questions, recorder)
+            qa_pairs = list(zip(clarifying_questions, user_answers))
+        except BaseException:
+            if speculation is not None:
+                speculation.cancel()
+            raise
+
+        # Step 3: Refine the prompt with user answers, unless the near-duplicate or the speculative
+        # refinement can be used
+        if reusable and _trivial_answers(user_answers):
+            return neighbour["optimized_prompt"], qa_pairs
+        refined_response = None
+        if speculation is not None:
+            if _trivial_answers(user_answers):
+                try:
+                    refined_response = await speculation
+                except Exception:
+                    pass  # Refine normally instead
+            else:
+                speculation.cancel()  # The answers add information, the speculation is discarded
+        if refined_response is None:
+            refined_response = await _ainvoke(
+                self.refinement_chain,
+                self._optimization_inputs(prompt_to_optimize, _combine_context(qa_pairs, _seed_context(neighbour, context))),
+                semaphore, chain_config(recorder, "refinement", seeded=neighbour is not None), self.scheduler,
+            )
+
+        optimized_prompt = refined_response["optimizedPrompt"]
+        self._index_optimization(prompt_to_optimize, context, clarifying_questions, qa_pairs, optimized_prompt)
+        return optimized_prompt, qa_pairs
+
+    async def acritique_prompt(self, prompt_to_analyze, semaphore=None, recorder=None):
+        """
+        Async version of `critique_prompt`.
+
+        Args:
+            prompt_to_analyze (str): The prompt to analyze.
+            semaphore (asyncio.Semaphore, optional): Bounds the number of concurrent LLM calls.
+            recorder (metrics.MetricsRecorder, optional): Records the LLM call.
+
+        Returns:
+            dict: A JSON object containing the reasoning (text) and the score (float from 0 to 1).
+        """
+        cached = self._cached_critique(prompt_to_analyze)
+        if cached is not None:
+            return cached
+
+        recorder = self._recorder(recorder)
+        response = await _ainvoke(
+            self.critique_chain, {"current_prompt": prompt_to_analyze}, semaphore,
+            chain_config(recorder, "critique"), self.scheduler,
+        )
+        if self.router.needs_escalation("critique", response["score"]):
+            response = await _ainvoke(
+                self.escalated_critique_chain, {"current_prompt": prompt_to_analyze}, semaphore,
+                chain_config(recorder, "critique_escalation"), self.scheduler,
+            )
+        return self._store_critique(prompt_to_analyze, response)
+
+    async def acritique_prompt_ensemble(self, prompt_to_analyze, recorder=None, **sampling):
+        """
+        Async version of `critique_prompt_ensemble`.
+        """
+        inputs = {"current_prompt": prompt_to_analyze}
+        config = chain_config(self._recorder(recorder), "critique", ensemble=True)
+        critiques, statistics = await asample_until_confident(
+            lambda count: scheduled_abatch(self.scheduler, self.critique_chain, [inputs] * count, config),
+            "score", **sampling
+        )
+        return _ensemble_result(critiques, statistics)
+
+    async def acritique_prompt_chunked(self, prompt_to_analyze, max_chunk_tokens=2000, recorder=None):
+        """
+        Async version of `critique_prompt_chunked`.
+        """
+        chunks = chunk_content(prompt_to_analyze, max_chunk_tokens, self.model_name)
+        if len(chunks) <= 1:
+            return await self.acritique_prompt(prompt_to_analyze, recorder=recorder)
+        critiques, missing = self._cached_chunk_critiques(chunks)
+        if missing:
+            responses = await scheduled_abatch(
+                self.scheduler, self.critique_chain, [{"current_prompt": CHUNK_HEADER + chunks[i]} for i in missing],
+                chain_config(self._recorder(recorder), "critique", chunked=True),
+            )
+            self._store_chunk_critiques(chunks, critiques, missing, responses)
+        return self._reduce_chunk_critiques(chunks, critiques)
+
+    async def acritique_prompts(self, prompts, max_concurrency=8, recorder=None):
+        """
+        Critiques many prompts with a single batched call.
+
+        Args:
+            prompts (list): The prompts to analyze.
+            max_concurrency (int): Maximum number of critiques in flight at once.
+            recorder (metrics.MetricsRecorder, optional): Records the LLM calls.
+
+        Returns:
+            list: One `{"reasoning", "score"}` dict per prompt, in the same order as `prompts`.
+        """
+        recorder = self._recorder(recorder)
+        critiques = [self._cached_critique(prompt) for prompt in prompts]
+        missing = [i for i, critique in enumerate(critiques) if critique is None]
+        if missing:
+            config = chain_config(recorder, "critique")
+            if self.scheduler is None:
+                responses = await self.critique_chain.abatch(
+                    [{"current_prompt": prompts[i]} for i in missing],
+                    config={**config, "max_concurrency": max_concurrency},
+                )
+            else:
+                # Each critique goes through the scheduler on its own
+                semaphore = asyncio.Semaphore(max_concurrency)
+                responses = await asyncio.gather(*(
+                    _ainvoke(self.critique_chain, {"current_prompt": prompts[i]}, semaphore, config, self.scheduler)
+                    for i in missing
+                ))
+
+            # Redo the ambiguous critiques with the stronger model, if the router escalates them
+            escalated = [
+                j for j, response in enumerate(responses) if self.router.needs_escalation("critique", response["score"])
+            ]
+            if escalated:
+                semaphore = asyncio.Semaphore(max_concurrency)
+                escalated_responses = await asyncio.gather(*(
+                    _ainvoke(
+                        self.escalated_critique_chain, {"current_prompt": prompts[missing[j]]}, semaphore,
+                        chain_config(recorder, "critique_escalation"), self.scheduler,
+                    )
+                    for j in escalated
+                ))
+                responses = list(responses)
+                for j, response in zip(escalated, escalated_responses):
+                    responses[j] = response
+            for i, response in zip(missing, responses):
+                critiques[i] = self._store_critique(prompts[i], response)
+        return critiques
+
+    async def aoptimize_and_benchmark(self, prompt, answers=None, semaphore=None, ensemble=None):
+        """
+        Async version of `optimize_and_benchmark`.
+
+        The critique of the original prompt does not depend on the optimization, so it runs
+        concurrently with it instead of before it. Ensemble critiques don't use `semaphore`, their
+        samples are batched.
+        """
+        recorder = MetricsRecorder(sink=self.metrics_sink)
+        if ensemble is None:
+            critique = lambda prompt_to_analyze: self.acritique_prompt(
+                prompt_to_analyze, semaphore=semaphore, recorder=recorder
+            )
+        else:
+            critique = lambda prompt_to_analyze: self.acritique_prompt_ensemble(
+                prompt_to_analyze, recorder=recorder, **ensemble
+            )
+        original_critique_result, (optimized_prompt, qa_pairs) = await asyncio.gather(
+            critique(prompt),
+            self.aoptimize_prompt(prompt, answers=answers, semaphore=semaphore, recorder=recorder),
+        )
+        optimized_critique_result = await critique(optimized_prompt)
+        return _benchmark_result(
+            optimized_prompt, original_critique_result, optimized_critique_result, recorder,
+            **({"confidence": ensemble["confidence"]} if ensemble and "confidence" in ensemble else {})
+        )
+
+
+_default_optimizer = None
+_default_optimizer_lock = threading.Lock()
+
+
+def get_default_optimizer():
+    """
+    Returns the process-wide `PromptOptimizer` used by the module-level functions,
+    creating it on first use.
+    """
+    global _default_optimizer
+    if _default_optimizer is None:
+        with _default_optimizer_lock:
+            if _default_optimizer is None:
+                _default_optimizer = PromptOptimizer()
+    return _default_optimizer
+
+
+def set_default_optimizer(optimizer):
+    """
+    Replaces the `PromptOptimizer` used by the module-level functions, e.g. with one
+    configured with a `critique_cache`.
+    """
+    global _default_optimizer
+    with _default_optimizer_lock:
+        _default_optimizer = optimizer
+
+
+def optimize_prompt(prompt_to_optimize, context=None, answers=None):
+    """
+    Optimizes a given prompt by generating clarifying questions and refining it based on user input.
 
     Args:
-        prompt_to_analyze (str): The prompt to analyze.
+        prompt_to_optimize (str): The prompt to optimize.
+        context (str, optional): Additional context to take into account.
+        answers (optional): How the clarifying questions get answered: an `answers.AnswerProvider`,
+            a function called with each question, a dict of question to answer, or "skip".
+            Defaults to asking the user on the command line.
 
     Returns:
-        dict: A JSON object containing the reasoning (text) and the score (float from 0 to 1).
+        tuple: A tuple containing the optimized prompt and a list of tuples with questions and user answers.
     """
-    load_dotenv()
-
-    # Load API key from environment variables
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    if not openai_api_key:
-        raise ValueError("Please set the OPENAI_API_KEY environment variable.")
-
-    # Initialize the model
-    model = ChatOpenAI(model="gpt-4o-mini", openai_api_key=openai_api_key)
-
-    # Define JSON schema
-    json_schema = {
-        "title": "promptCritique",
-        "description": "Critique of a prompt including reasoning and a score.",
-        "type": "object",
-        "properties": {
-            "reasoning": {
-                "type": "string",
-                "description": "The detailed reasoning for the critique, including a breakdown of the analysis.",
-            },
-            "score": {
-                "type": "number",
-                "description": "The final score of the prompt, from 0 to 1.",
-                "minimum": 0,
-                "maximum": 1,
-            },
-        },
-        "required": ["reasoning", "score"],
-    }
+    return get_default_optimizer().optimize_prompt(prompt_to_optimize, context=context, answers=answers)
 
-    # Initialize structured LLM with schema
-    structured_llm = model.with_structured_output(json_schema)
-
-    # Create prompt template
-    prompt_template = ChatPromptTemplate.from_messages(
-        [("system", prompt_critique_system_prompt), ("user", prompt_critique_request)]
-    )
 
-    # Combine template and model into a chain
-    chain = prompt_template | structured_llm
+def critique_prompt(prompt_to_analyze):
+    """
+    Critiques a given prompt and returns a JSON with reasoning and a score.
 
-    # Invoke the chain with the input prompt
-    response = chain.invoke({"current_prompt": prompt_to_analyze})
+    Args:
+        prompt_to_analyze (str): The prompt to analyze.
 
-    # Return the reasoning and score as a JSON object
-    return {
-        "reasoning": response["reasoning"],
-        "score": response["score"]
-    }
+    Returns:
+        dict: A JSON object containing the reasoning (text) and the score (float from 0 to 1).
+    """
+    return get_default_optimizer().critique_prompt(prompt_to_analyze)
 
-def optimize_and_benchmark(prompt):
+def optimize_and_benchmark(prompt, answers=None, ensemble=None):
     """
-    Optimize a given prompt, critique both the original and optimized versions, 
+    Optimize a given prompt, critique both the original and optimized versions,
     and compare their performance.
 
     Parameters:
         prompt (str): The original prompt to be optimized and critiqued.
+        answers (optional): Answers the clarifying questions, see `optimize_prompt`.
+        ensemble (dict, optional): Critique both prompts with sampled ensembles instead of single
+            critiques, with these sampling options (`{}` for the defaults), see
+            `PromptOptimizer.critique_prompt_ensemble`.
 
     Returns:
         dict: A dictionary containing:
@@ -159,6 +878,11 @@ def optimize_and_benchmark(prompt):
             - optimized_critique_result_score (float): The critique score of the optimized prompt.
             - original_critique_result (dict): Detailed critique results of the original prompt.
             - optimized_critique_result (dict): Detailed critique results of the optimized prompt.
+            - score_difference_ci (list) and significant (bool): With `ensemble`, the confidence
+              interval of the score difference and whether it excludes zero.
+            - metrics (dict): Calls, tokens, latency and estimated cost of the LLM calls, in total
+              and per stage (questions, refinement, critique, critique_escalation), see
+              `metrics.MetricsRecorder.summary`.
 
     Process:
         1. Critique the original prompt using `critique_prompt`.
@@ -176,25 +900,46 @@ def optimize_and_benchmark(prompt):
         print("Score Difference:", results["score_difference"])
         print("Optimized Prompt:", results["optimized_prompt"])
     """
-    original_critique_result = critique_prompt(prompt)
-    optimized_prompt, qa_pairs = optimize_prompt(prompt)
-    optimized_critique_result = critique_prompt(optimized_prompt)
-    score_difference = optimized_critique_result["score"] - original_critique_result["score"]
+    return get_default_optimizer().optimize_and_benchmark(prompt, answers=answers, ensemble=ensemble)
+
+
+async def aoptimize_prompt(prompt_to_optimize, context=None, answers=None, semaphore=None):
+    """
+    Async version of `optimize_prompt`, see `PromptOptimizer.aoptimize_prompt`.
+    """
+    return await get_default_optimizer().aoptimize_prompt(
+        prompt_to_optimize, context=context, answers=answers, semaphore=semaphore
+    )
+
+
+async def acritique_prompt(prompt_to_analyze, semaphore=None):
+    """
+    Async version of `critique_prompt`, see `PromptOptimizer.acritique_prompt`.
+    """
+    return await get_default_optimizer().acritique_prompt(prompt_to_analyze, semaphore=semaphore)
+
+
+async def acritique_prompts(prompts, max_concurrency=8):
+    """
+    Critiques many prompts with a single batched call, see `PromptOptimizer.acritique_prompts`.
+    """
+    return await get_default_optimizer().acritique_prompts(prompts, max_concurrency=max_concurrency)
+
+
+async def aoptimize_and_benchmark(prompt, answers=None, semaphore=None, ensemble=None):
+    """
+    Async version of `optimize_and_benchmark`, see `PromptOptimizer.aoptimize_and_benchmark`.
+    """
+    return await get_default_optimizer().aoptimize_and_benchmark(
+        prompt, answers=answers, semaphore=semaphore, ensemble=ensemble
+    )
 
-    return {
-        "optimized_prompt": optimized_prompt,
-        "score_difference": score_difference,
-        "original_critique_result_score": original_critique_result["score"],
-        "optimized_critique_result_score": optimized_critique_result["score"],
-        "original_critique_result": original_critique_result,
-        "optimized_critique_result": optimized_critique_result
-    }
 
 if __name__ == "__main__":
-    user_prompt = input(f"Add here the prompt you need to optimize: ") 
+    user_prompt = input(f"Add here the prompt you need to optimize: ")
 
     print("Thinking about how to optimize your prompt...")
     result = optimize_and_benchmark(user_prompt)
     print("\nEvaluating the output...")
-    print(json.dumps(result, indent=4))  
-   
\ No newline at end of file
+    print(json.dumps(result, indent=4))
+
@@ -0,0 +1,213 @@
+import json, threading, time
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Estimated price in USD per million tokens: (prompt, completion)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, prices=MODEL_PRICES):
+    """
+    Estimates the cost of a call in USD, or returns None for models without a known price.
+    Dated model names (e.g. "gpt-4o-mini-2024-07-18") use the price of their base model.
+    """
+    price = prices.get(model)
+    if price is None and model:
+        # Longest matching prefix, so that "gpt-4o-mini-..." is not priced as "gpt-4o"
+        matches = [name for name in prices if model.startswith(name)]
+        price = prices[max(matches, key=len)] if matches else None
+    if price is None:
+        return None
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+
+def _token_usage(response):
+    # ChatOpenAI reports usage in llm_output; other models on the messages
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage.get("prompt_tokens") is not None:
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    prompt_tokens = completion_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage_metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+            prompt_tokens += usage_metadata.get("input_tokens", 0)
+            completion_tokens += usage_metadata.get("output_tokens", 0)
+    return prompt_tokens, completion_tokens
+
+
+class JSONLMetricsSink:
+    """
+    Appends every span to a local JSONL file.
+
+    Args:
+        path (str): The file spans are appended to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, span):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(span) + "\n")
+
+
+class MetricsRecorder(BaseCallbackHandler):
+    """
+    LangChain callback handler recording one span per LLM call.
+
+    Pass it in the `callbacks` of a chain call, see `chain_config`. Each span records the stage
+    and the other metadata of the call, the model, the prompt and completion tokens, the
+    latency, the retries, the estimated cost and the error, if any.
+
+    A failed attempt of a call going through a `ratelimit.RateLimitScheduler` is held until the
+    scheduler decides: if it retries, the span counts as a retry (its error is kept under
+    "retried_error"), otherwise as an error.
+
+    Args:
+        sink (optional): Object with a `write(span)` method receiving every finished span,
+            e.g. a `JSONLMetricsSink`.
+        prices (dict): Price table used to estimate costs, see `MODEL_PRICES`.
+    """
+
+    def __init__(self, sink=None, prices=MODEL_PRICES):
+        self.sink = sink
+        self.prices = prices
+        self.spans = []
+        self._running = {}
+        self._failed_attempts = {}  # scheduler call id -> failed spans awaiting the retry decision
+        self._lock = threading.Lock()
+
+    def _start(self, run_id, metadata, kwargs):
+        metadata = dict(metadata or {})
+        scheduler_call = metadata.pop("scheduler_call", None)
+        metadata.pop("scheduler_attempt", None)
+        invocation_params = kwargs.get("invocation_params") or {}
+        model = (
+            metadata.get("ls_model_name")
+            or invocation_params.get("model_name")
+            or invocation_params.get("model")
+        )
+        with self._lock:
+            self._running[run_id] = {
+                "stage": metadata.get("stage"),
+                "metadata": {key: value for key, value in metadata.items() if not key.startswith(("ls_", "lc_"))},
+                "model": model,
+                "start": time.perf_counter(),
+                "retries": 0,
+                "scheduler_call": scheduler_call,
+            }
+
+    def _finish(self, run_id, prompt_tokens=0, completion_tokens=0, error=None):
+        with self._lock:
+            running = self._running.pop(run_id, None)
+        if running is None:
+            return
+        span = {
+            "stage": running["stage"],
+            "metadata": running["metadata"],
+            "model": running["model"],
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency": time.perf_counter() - running["start"],
+            "retries": running["retries"],
+            "cost": estimate_cost(running["model"], prompt_tokens, completion_tokens, self.prices),
+            "error": error,
+            "retried_error": None,
+            "timestamp": time.time(),
+        }
+        if error is not None and running["scheduler_call"] is not None:
+            with self._lock:
+                self._failed_attempts.setdefault(running["scheduler_call"], []).append(span)
+            return
+        self._publish([span])
+
+    def _publish(self, spans):
+        with self._lock:
+            self.spans.extend(spans)
+        if self.sink is not None:
+            for span in spans:
+                self.sink.write(span)
+
+    def on_scheduler_retry(self, call_id):
+        """Called by the scheduler when it retries a failed call: its failed spans count as retries."""
+        with self._lock:
+            spans = self._failed_attempts.pop(call_id, [])
+        for span in spans:
+            span["retries"] += 1
+            span["retried_error"], span["error"] = span["error"], None
+        self._publish(spans)
+
+    def on_scheduler_failure(self, call_id):
+        """Called by the scheduler when a call failed for good: its failed spans count as errors."""
+        with self._lock:
+            spans = self._failed_attempts.pop(call_id, [])
+        self._publish(spans)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, metadata, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, metadata, kwargs)
+
+    def on_retry(self, retry_state, *, run_id, **kwargs):
+        with self._lock:
+            if run_id in self._running:
+                self._running[run_id]["retries"] += 1
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_tokens, completion_tokens = _token_usage(response)
+        self._finish(run_id, prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=f"{type(error).__name__}: {error}")
+
+    def summary(self, **metadata):
+        """
+        Aggregates the recorded spans, optionally only those whose metadata matches `metadata`
+        (e.g. `summary(attempt=2)`).
+
+        Returns:
+            dict: Number of calls and errors, total tokens, latency and cost, and the same
+            totals per stage.
+        """
+        with self._lock:
+            spans = [
+                span for span in self.spans
+                if all(span["metadata"].get(key) == value for key, value in metadata.items())
+            ]
+        summary = _aggregate(spans)
+        stages = {}
+        for span in spans:
+            stages.setdefault(span["stage"], []).append(span)
+        summary["stages"] = {stage: _aggregate(stage_spans) for stage, stage_spans in stages.items()}
+        return summary
+
+
+def _aggregate(spans):
+    costs = [span["cost"] for span in spans if span["cost"] is not None]
+    return {
+        "calls": len(spans),
+        "errors": sum(1 for span in spans if span["error"]),
+        "retries": sum(span["retries"] for span in spans),
+        "prompt_tokens": sum(span["prompt_tokens"] for span in spans),
+        "completion_tokens": sum(span["completion_tokens"] for span in spans),
+        "latency": sum(span["latency"] for span in spans),
+        "cost": sum(costs) if costs else None,
+    }
+
+
+def chain_config(recorder, stage, **metadata):
+    """
+    Builds the config of a chain call reporting to `recorder` under `stage`, with extra
+    `metadata` attached to the spans (e.g. the attempt number).
+
+    Returns an empty config when `recorder` is None, so that metrics stay optional.
+    """
+    if recorder is None:
+        return {}
+    return {"callbacks": [recorder], "metadata": {"stage": stage, **metadata}}
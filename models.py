@@ -0,0 +1,45 @@
+import os
+from dotenv import load_dotenv
+
+BACKENDS = ("openai", "fake")
+
+# ChatOpenAI arguments that the fake backend ignores
+_OPENAI_ONLY_ARGUMENTS = ("openai_api_key", "http_client", "http_async_client", "max_retries")
+
+
+def make_chat_model(model="gpt-4o-mini", backend=None, scheduled=False, **kwargs):
+    """
+    Creates a chat model for the configured backend.
+
+    Args:
+        model (str): The model name.
+        backend (str, optional): "openai" or "fake". Defaults to the PROMPT_OPTIMIZER_BACKEND
+            environment variable, or "openai" if it is not set.
+        scheduled (bool): The calls of the model go through a `ratelimit.RateLimitScheduler`,
+            which retries them, so the client must not retry on its own (`max_retries=0`).
+        **kwargs: Extra arguments for the model class, e.g. `http_client` for `ChatOpenAI` or
+            `latency`/`error_rate` for `FakeChatModel`.
+
+    Returns:
+        BaseChatModel: A `ChatOpenAI` or a `fake_llm.FakeChatModel` instance.
+    """
+    load_dotenv()
+    if scheduled:
+        kwargs.setdefault("max_retries", 0)
+    backend = backend or os.getenv("PROMPT_OPTIMIZER_BACKEND", "openai")
+
+    if backend == "fake":
+        from fake_llm import FakeChatModel
+        kwargs = {key: value for key, value in kwargs.items() if key not in _OPENAI_ONLY_ARGUMENTS}
+        return FakeChatModel(model_name=model, **kwargs)
+
+    if backend == "openai":
+        from langchain_openai import ChatOpenAI
+
+        # Load API key from environment variables
+        openai_api_key = kwargs.pop("openai_api_key", None) or os.getenv("OPENAI_API_KEY")
+        if not openai_api_key:
+            raise ValueError("Please set the OPENAI_API_KEY environment variable.")
+        return ChatOpenAI(model=model, openai_api_key=openai_api_key, **kwargs)
+
+    raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}.")
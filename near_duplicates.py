@@ -0,0 +1,149 @@
+import hashlib, random, re, threading
+from collections import OrderedDict
+
+# Mersenne prime bounding the universal hash functions of the MinHash permutations
+_PRIME = (1 << 61) - 1
+
+
+def normalize(text):
+    """Lowercases `text` and collapses its whitespace, so trivially different prompts compare equal."""
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+
+def same_prompt(first, second):
+    """
+    Tells whether two prompts differ only by whitespace or casing. Only then can one's optimization
+    be reused for the other as is: a single changed word ("Use Python" / "Use Rust") may change
+    the meaning, however similar the texts are.
+    """
+    return normalize(first) == normalize(second)
+
+
+def shingles(text, size=5):
+    """
+    Returns the set of character `size`-grams of the normalized `text`. Character shingles keep
+    a swapped word from changing more than a few percent of the set of a prompt.
+    """
+    text = normalize(text)
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def jaccard(first, second):
+    """Returns the Jaccard similarity of two shingle sets."""
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+class NearDuplicateIndex:
+    """
+    Similarity index of previously optimized prompts, so that a prompt differing from a known one
+    only by whitespace, casing or a word or two can start from its optimization.
+
+    Prompts are reduced to MinHash signatures split into bands (locality-sensitive hashing): two
+    prompts become candidates when all the rows of one band agree, which makes a lookup cost a
+    few dict accesses whatever the size of the index. Candidates are then ranked by the exact
+    Jaccard similarity of their shingles.
+
+    Args:
+        threshold (float): Jaccard similarity from which an indexed prompt is a near-duplicate,
+            whose optimization seeds the new one (its clarifying questions are reused and its
+            optimized prompt given as reference). Similarity says nothing about meaning, use
+            `same_prompt` to decide whether an optimization can be reused as is.
+        num_perm (int): Length of the MinHash signatures.
+        bands (int): Number of LSH bands, dividing `num_perm`. With 16 bands of 4 rows, prompts
+            from about 0.5 similar are likely to be candidates.
+        shingle_size (int): Size of the character shingles.
+        max_entries (int): Number of prompts kept before the least recently used one is evicted.
+        seed (int): Seed of the MinHash permutations.
+    """
+
+    def __init__(self, threshold=0.7, num_perm=64, bands=16, shingle_size=5, max_entries=10_000, seed=0):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands}).")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        generator = random.Random(seed)
+        self._permutations = [
+            (generator.randrange(1, _PRIME), generator.randrange(0, _PRIME)) for _ in range(num_perm)
+        ]
+        self._entries = OrderedDict()  # entry id -> (shingles, band keys, prompt, value)
+        self._buckets = {}  # band key -> set of entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _signature(self, prompt_shingles):
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+            for shingle in prompt_shingles
+        ]
+        return [min((a * h + b) % _PRIME for h in hashes) for a, b in self._permutations]
+
+    def _band_keys(self, signature):
+        return [(band, *signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def add(self, prompt, value):
+        """Indexes `prompt` with the `value` to return for its near-duplicates."""
+        prompt_shingles = frozenset(shingles(prompt, self.shingle_size))
+        band_keys = self._band_keys(self._signature(prompt_shingles))
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (prompt_shingles, band_keys, prompt, value)
+            for key in band_keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        evicted_id, (_, band_keys, _, _) = self._entries.popitem(last=False)
+        for key in band_keys:
+            bucket = self._buckets[key]
+            bucket.discard(evicted_id)
+            if not bucket:
+                del self._buckets[key]
+
+    def lookup(self, prompt, accept=None):
+        """
+        Finds the indexed prompt most similar to `prompt`, if at least `threshold` similar.
+
+        Args:
+            prompt (str): The prompt to look up.
+            accept (callable, optional): Filters the candidates on their value, e.g. to require
+                the same additional context.
+
+        Returns:
+            tuple: `(similarity, indexed prompt, value)`, or None if there is no near-duplicate.
+        """
+        prompt_shingles = shingles(prompt, self.shingle_size)
+        band_keys = self._band_keys(self._signature(prompt_shingles))
+        best = None
+        with self._lock:
+            candidates = set().union(*(self._buckets.get(key, ()) for key in band_keys))
+            for entry_id in candidates:
+                entry_shingles, _, entry_prompt, value = self._entries[entry_id]
+                if accept is not None and not accept(value):
+                    continue
+                similarity = jaccard(prompt_shingles, entry_shingles)
+                if similarity >= self.threshold and (best is None or similarity > best[0]):
+                    best = (similarity, entry_id, entry_prompt, value)
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best[1])
+            self.hits += 1
+        return best[0], best[2], best[3]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Returns the hit/miss counters and the current size."""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
@@ -0,0 +1,33 @@
+import difflib
+
+
+def change_ratio(previous, current):
+    """
+    Measures how much a text changed between two iterations, on a word basis.
+
+    Args:
+        previous (str): The previous version of the text.
+        current (str): The new version of the text.
+
+    Returns:
+        float: The fraction of changed words, from 0.0 (identical) to 1.0 (nothing in common).
+    """
+    previous_words, current_words = previous.split(), current.split()
+    if not previous_words and not current_words:
+        return 0.0
+    return 1.0 - difflib.SequenceMatcher(None, previous_words, current_words, autojunk=False).ratio()
+
+
+def negligible_change(previous, current, min_change):
+    """
+    Tells whether `current` differs too little from `previous` to be worth a new critique.
+
+    Args:
+        previous (str or None): The content critiqued last, None on the first iteration.
+        current (str): The new content.
+        min_change (float or None): Minimum fraction of changed words (see `change_ratio`) for a new
+            critique. None disables the check.
+    """
+    if min_change is None or previous is None:
+        return False
+    return change_ratio(previous, current) < min_change
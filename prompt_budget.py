@@ -0,0 +1,91 @@
+import json
+from langchain_core.prompts import ChatPromptTemplate
+from tokens import count_tokens, truncate_tokens
+import custom_prompts
+
+
+def template_token_report(model="gpt-4o-mini"):
+    """
+    Reports the token size of every template of `custom_prompts`, placeholders excluded.
+
+    Returns:
+        dict: Token count per template name, largest first.
+    """
+    report = {}
+    for name, template in vars(custom_prompts).items():
+        if name.startswith("_") or not isinstance(template, str):
+            continue
+        placeholders = ChatPromptTemplate.from_messages([("user", template)]).input_variables
+        report[name] = count_tokens(template.format(**dict.fromkeys(placeholders, "")), model)
+    return dict(sorted(report.items(), key=lambda item: item[1], reverse=True))
+
+
+class PromptBuilder:
+    """
+    Assembles the inputs of a chat prompt template within a per-call token budget.
+
+    The static part of the template and the inputs that cannot be shortened are counted first;
+    what remains of the budget goes to the `truncatable` inputs, in order, each one shortened
+    deterministically with `tokens.truncate_tokens` if it does not fit.
+
+    Args:
+        template (ChatPromptTemplate): The template the inputs are for.
+        max_tokens (int): Token budget of the whole prompt.
+        truncatable (tuple): Names of the inputs that may be shortened, e.g. ("context",).
+        model (str): The model whose tokenizer is used.
+    """
+
+    def __init__(self, template, max_tokens, truncatable=("context",), model="gpt-4o-mini"):
+        self.template = template
+        self.max_tokens = max_tokens
+        self.truncatable = truncatable
+        self.model = model
+        empty_inputs = dict.fromkeys(template.input_variables, "")
+        self.template_tokens = sum(
+            count_tokens(str(message.content), model) for message in template.format_messages(**empty_inputs)
+        )
+
+    def build(self, inputs):
+        """
+        Fits `inputs` to the budget.
+
+        Returns:
+            tuple: The inputs to invoke the template with, and a report with the token counts of
+            the template and of every input, the tokens removed per input and the total.
+
+        Raises:
+            ValueError: If the template and the inputs that cannot be shortened exceed the budget.
+        """
+        input_tokens = {name: count_tokens(str(value or ""), self.model) for name, value in inputs.items()}
+        available = self.max_tokens - self.template_tokens - sum(
+            tokens for name, tokens in input_tokens.items() if name not in self.truncatable
+        )
+        if available < 0:
+            raise ValueError(
+                f"The prompt needs {self.max_tokens - available} tokens without its truncatable inputs, "
+                f"over the budget of {self.max_tokens}."
+            )
+
+        fitted = dict(inputs)
+        truncated = {}
+        for name in self.truncatable:
+            if not inputs.get(name):
+                continue
+            if input_tokens[name] > available:
+                fitted[name] = truncate_tokens(str(inputs[name]), available, self.model)
+                truncated[name] = input_tokens[name] - count_tokens(fitted[name], self.model)
+            available -= min(available, count_tokens(str(fitted[name]), self.model))
+
+        report = {
+            "template_tokens": self.template_tokens,
+            "input_tokens": input_tokens,
+            "truncated_tokens": truncated,
+            "total_tokens": self.template_tokens + sum(
+                count_tokens(str(value or ""), self.model) for value in fitted.values()
+            ),
+        }
+        return fitted, report
+
+
+if __name__ == "__main__":
+    print(json.dumps(template_token_report(), indent=4))
@@ -0,0 +1,363 @@
+import asyncio, contextlib, contextvars, email.utils, itertools, json, random, threading, time
+from tokens import count_tokens
+
+try:
+    import openai
+except ImportError:  # Only the fake backend is available
+    openai = None
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Errors without an HTTP status worth retrying: timeouts and dropped connections
+RETRYABLE_ERRORS = (TimeoutError, ConnectionError) + (
+    (openai.APITimeoutError, openai.APIConnectionError) if openai is not None else ()
+)
+
+_priority = contextvars.ContextVar("rate_limit_priority", default=INTERACTIVE)
+_call_ids = itertools.count()
+
+
+@contextlib.contextmanager
+def priority(level):
+    """
+    Sets the priority of the calls scheduled in this context (thread or asyncio task).
+
+    Example:
+        with priority(BATCH):
+            optimize_and_benchmark(prompt, answers="skip")
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _tag_attempt(kwargs, call_id, attempt):
+    """
+    Adds the scheduler call id and attempt number to the metadata of a chain call made with
+    callbacks, so that a `metrics.MetricsRecorder` can tell retried attempts from errors.
+    """
+    config = kwargs.get("config")
+    if not config or not config.get("callbacks"):
+        return kwargs
+    metadata = {**config.get("metadata", {}), "scheduler_call": call_id, "scheduler_attempt": attempt}
+    return {**kwargs, "config": {**config, "metadata": metadata}}
+
+
+def _notify_attempt(kwargs, retried, call_id):
+    """
+    Tells the callbacks of a chain call that its failed attempt is retried, or that it failed for good.
+    """
+    callbacks = (kwargs.get("config") or {}).get("callbacks")
+    if not isinstance(callbacks, list):
+        return
+    for handler in callbacks:
+        method = getattr(handler, "on_scheduler_retry" if retried else "on_scheduler_failure", None)
+        if method is not None:
+            method(call_id)
+
+
+def estimate_tokens(inputs, completion_tokens=1000):
+    """
+    Estimates the tokens a call consumes: the size of its inputs plus an allowance for the
+    prompt template and the completion.
+    """
+    text = inputs if isinstance(inputs, str) else json.dumps(inputs, default=str)
+    return count_tokens(text) + completion_tokens
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate_per_minute`, holding at most one minute of budget.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.tokens = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now, rate_factor=1.0):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate * rate_factor)
+        self.updated = now
+
+    def wait_time(self, amount, rate_factor=1.0):
+        """Seconds until `amount` is available (requests larger than the bucket wait for a full bucket)."""
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / (self.rate * rate_factor))
+
+    def consume(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+def _status_code(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code
+
+
+def _is_retryable(error):
+    return isinstance(error, RETRYABLE_ERRORS) or _status_code(error) in RETRYABLE_STATUS_CODES
+
+
+def _retry_after(error):
+    # Seconds requested by the server through the Retry-After(-ms) headers, if any
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date else None
+
+
+class RateLimitScheduler:
+    """
+    Central scheduler keeping concurrent LLM calls within a shared quota.
+
+    Every call first waits for budget in two token buckets, one for requests per minute and
+    one for tokens per minute. Interactive calls go first: batch calls wait while an interactive
+    call is waiting for budget. Failed calls with a retryable status (429, 5xx, timeouts) or a
+    network error (see `RETRYABLE_ERRORS`) are retried with jittered exponential backoff, honouring the Retry-After header. On a 429 the
+    refill rate is halved, then recovers gradually with each success, so that the scheduler
+    settles just under the real quota instead of causing error storms.
+
+    The same instance can be shared by threads and asyncio tasks.
+
+    Args:
+        requests_per_minute (int): Request quota.
+        tokens_per_minute (int): Token quota (prompt and completion).
+        max_retries (int): Maximum number of retries of a call.
+        base_delay (float): Backoff delay of the first retry, in seconds.
+        max_delay (float): Maximum backoff delay, in seconds.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200_000, max_retries=6, base_delay=1.0,
+                 max_delay=60.0):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_factor = 1.0
+        self.retries = 0
+        self.rate_limited = 0
+        self._waiting_interactive = 0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, request_count, token_count, level):
+        # Returns 0 if the budget was taken, otherwise how long to wait before trying again
+        with self._lock:
+            if level != INTERACTIVE and self._waiting_interactive:
+                return 0.05
+            now = time.monotonic()
+            self.request_bucket.refill(now, self.rate_factor)
+            self.token_bucket.refill(now, self.rate_factor)
+            wait = max(
+                self.request_bucket.wait_time(request_count, self.rate_factor),
+                self.token_bucket.wait_time(token_count, self.rate_factor),
+            )
+            if wait > 0:
+                return wait
+            self.request_bucket.consume(request_count)
+            self.token_bucket.consume(token_count)
+            return 0
+
+    def _waiting(self, level, delta):
+        if level == INTERACTIVE:
+            with self._lock:
+                self._waiting_interactive += delta
+
+    def acquire(self, request_count=1, token_count=1000, level=None):
+        """Blocks until the budget for the call is available."""
+        level = level or _priority.get()
+        self._waiting(level, 1)
+        try:
+            while (wait := self._try_acquire(request_count, token_count, level)) > 0:
+                time.sleep(wait)
+        finally:
+            self._waiting(level, -1)
+
+    async def aacquire(self, request_count=1, token_count=1000, level=None):
+        """Async version of `acquire`."""
+        level = level or _priority.get()
+        self._waiting(level, 1)
+        try:
+            while (wait := self._try_acquire(request_count, token_count, level)) > 0:
+                await asyncio.sleep(wait)
+        finally:
+            self._waiting(level, -1)
+
+    def _on_success(self):
+        with self._lock:
+            self.rate_factor = min(1.0, self.rate_factor + 0.05)
+
+    def _retry_delay(self, error, attempt):
+        """
+        Returns how long to wait before retrying after `error`, or None if it must not be retried.
+        """
+        if attempt >= self.max_retries or not _is_retryable(error):
+            return None
+        with self._lock:
+            self.retries += 1
+            if _status_code(error) == 429:
+                self.rate_limited += 1
+                self.rate_factor = max(0.1, self.rate_factor / 2)
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, fn, *args, request_count=1, token_count=1000, level=None, **kwargs):
+        """
+        Calls `fn(*args, **kwargs)` within the quota, retrying retryable failures.
+
+        Args:
+            fn (callable): The call to schedule, e.g. `chain.invoke`.
+            request_count (int): Number of requests the call makes (e.g. the size of a batch).
+            token_count (int): Estimated tokens the call consumes, see `estimate_tokens`.
+            level (str, optional): INTERACTIVE or BATCH. Defaults to the current `priority`.
+
+        The metrics recorders in the `config` callbacks of `fn` learn which attempts were retried.
+        """
+        call_id = next(_call_ids)
+        attempt = 0
+        while True:
+            self.acquire(request_count, token_count, level)
+            try:
+                result = fn(*args, **_tag_attempt(kwargs, call_id, attempt))
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                _notify_attempt(kwargs, delay is not None, call_id)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._on_success()
+            return result
+
+    async def acall(self, fn, *args, request_count=1, token_count=1000, level=None, **kwargs):
+        """Async version of `call`, for coroutine functions such as `chain.ainvoke`."""
+        call_id = next(_call_ids)
+        attempt = 0
+        while True:
+            await self.aacquire(request_count, token_count, level)
+            try:
+                result = await fn(*args, **_tag_attempt(kwargs, call_id, attempt))
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                _notify_attempt(kwargs, delay is not None, call_id)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._on_success()
+            return result
+
+    def stats(self):
+        """Returns the number of retries, of rate-limited responses and the current rate factor."""
+        return {"retries": self.retries, "rate_limited": self.rate_limited, "rate_factor": self.rate_factor}
+
+
+def scheduled_invoke(scheduler, runnable, inputs, config=None):
+    """
+    Invokes `runnable` through `scheduler`, or directly if `scheduler` is None.
+    """
+    if scheduler is None:
+        return runnable.invoke(inputs, config=config)
+    return scheduler.call(runnable.invoke, inputs, config=config, token_count=estimate_tokens(inputs))
+
+
+def scheduled_batch(scheduler, runnable, inputs, config=None):
+    """
+    Runs `runnable.batch` through `scheduler`, or directly if `scheduler` is None.
+    """
+    if scheduler is None:
+        return runnable.batch(inputs, config=config)
+    return scheduler.call(
+        runnable.batch, inputs, config=config,
+        request_count=len(inputs), token_count=sum(estimate_tokens(item) for item in inputs),
+    )
+
+
+async def scheduled_ainvoke(scheduler, runnable, inputs, config=None):
+    """
+    Async version of `scheduled_invoke`.
+    """
+    if scheduler is None:
+        return await runnable.ainvoke(inputs, config=config)
+    return await scheduler.acall(runnable.ainvoke, inputs, config=config, token_count=estimate_tokens(inputs))
+
+
+async def scheduled_abatch(scheduler, runnable, inputs, config=None):
+    """
+    Async version of `scheduled_batch`.
+    """
+    if scheduler is None:
+        return await runnable.abatch(inputs, config=config)
+    return await scheduler.acall(
+        runnable.abatch, inputs, config=config,
+        request_count=len(inputs), token_count=sum(estimate_tokens(item) for item in inputs),
+    )
+
+
+def _first_chunk(runnable, inputs, config=None):
+    # Opens the stream and waits for its first chunk, so that failures before it can be retried
+    iterator = iter(runnable.stream(inputs, config=config))
+    return iterator, next(iterator, None)
+
+
+def scheduled_stream(scheduler, runnable, inputs, config=None):
+    """
+    Streams `runnable` through `scheduler`, or directly if `scheduler` is None. Failures before
+    the first chunk are retried like those of `scheduled_invoke`; later ones are raised, since
+    the chunks already yielded cannot be taken back.
+    """
+    if scheduler is None:
+        yield from runnable.stream(inputs, config=config)
+        return
+    iterator, first = scheduler.call(_first_chunk, runnable, inputs, config=config, token_count=estimate_tokens(inputs))
+    if first is not None:
+        yield first
+        yield from iterator
+
+
+async def _afirst_chunk(runnable, inputs, config=None):
+    iterator = runnable.astream(inputs, config=config).__aiter__()
+    try:
+        return iterator, await iterator.__anext__()
+    except StopAsyncIteration:
+        return iterator, None
+
+
+async def scheduled_astream(scheduler, runnable, inputs, config=None):
+    """
+    Async version of `scheduled_stream`.
+    """
+    if scheduler is None:
+        async for chunk in runnable.astream(inputs, config=config):
+            yield chunk
+        return
+    iterator, first = await scheduler.acall(
+        _afirst_chunk, runnable, inputs, config=config, token_count=estimate_tokens(inputs)
+    )
+    if first is not None:
+        yield first
+        async for chunk in iterator:
+            yield chunk
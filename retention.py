@@ -0,0 +1,70 @@
+RETENTION_POLICIES = ("full", "scores", "last_n")
+
+
+class IterationRecord:
+    """
+    Compact record of one critiqued iteration of a GAN loop: its attempt number, its score
+    and, depending on the retention policy, its critique (None once dropped).
+    """
+
+    __slots__ = ("attempt", "score", "critique")
+
+    def __init__(self, attempt, score, critique=None):
+        self.attempt = attempt
+        self.score = score
+        self.critique = critique
+
+    def to_dict(self):
+        return {"attempt": self.attempt, "score": self.score, "critique": self.critique}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["attempt"], data["score"], data["critique"])
+
+
+class IterationHistory:
+    """
+    History of the critiqued iterations of a GAN loop, keeping the full critiques according
+    to a retention policy so that long runs and batch workers keep a flat memory footprint.
+
+    Args:
+        retention (str): "full" keeps every critique, "scores" only the scores, "last_n" the
+            critiques of the last `keep_last` iterations and the scores of the others.
+        keep_last (int): Number of critiques kept by the "last_n" policy.
+    """
+
+    def __init__(self, retention="full", keep_last=3, records=None):
+        if retention not in RETENTION_POLICIES:
+            raise ValueError(f"Unknown retention {retention!r}, expected one of {RETENTION_POLICIES}.")
+        self.retention = retention
+        self.keep_last = keep_last
+        self.records = records or []
+
+    def append(self, attempt, score, critique):
+        keep = self.retention == "full" or (self.retention == "last_n" and self.keep_last > 0)
+        self.records.append(IterationRecord(attempt, score, critique if keep else None))
+        if self.retention == "last_n" and len(self.records) > self.keep_last:
+            # Only the critique leaving the window needs dropping, the older ones already were
+            self.records[-self.keep_last - 1].critique = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def critiques(self):
+        """Returns the critiques still retained, oldest first."""
+        return [record.critique for record in self.records if record.critique is not None]
+
+    def scores(self):
+        """Returns the score of every critiqued iteration, oldest first."""
+        return [record.score for record in self.records]
+
+    def to_dict(self):
+        return {
+            "retention": self.retention,
+            "keep_last": self.keep_last,
+            "records": [record.to_dict() for record in self.records],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["retention"], data["keep_last"], [IterationRecord.from_dict(record) for record in data["records"]])
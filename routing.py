@@ -0,0 +1,130 @@
+import os, threading
+from dotenv import load_dotenv
+
+# Stages a model can be routed to
+STAGES = ("questions", "refinement", "critique", "cot_critique", "generator", "critic")
+# Stages whose ambiguous scores can be escalated to a stronger model: the critique of
+# `PromptOptimizer`, the critic of `gan_feedback_loop` and the critic of `gan_chain_of_thoughts`
+ESCALATION_STAGES = ("critique", "critic", "cot_critique")
+
+
+class ModelRouter:
+    """
+    Assigns a model to each stage of the pipelines, so that latency and cost can be traded
+    against quality per stage, e.g. a cheap critic with a strong generator.
+
+    The critic stages (see `ESCALATION_STAGES`) can also escalate: when the score returned by
+    their model falls within an ambiguity band, the call is retried with a stronger model and
+    the stronger answer is kept.
+
+    Args:
+        default (str): The model of the stages without a route.
+        routes (dict, optional): Model name per stage, see `STAGES`.
+        escalation (dict, optional): Per stage of `ESCALATION_STAGES`, a `(model, low, high)`
+            tuple: results scoring between `low` and `high` (inclusive) are redone with `model`.
+            Use the score scale of the stage, e.g. `{"critique": ("gpt-4o", 0.4, 0.7)}` or
+            `{"critic": ("gpt-4o", 60, 84)}` (GAN scores go from 0 to 100).
+
+    Example:
+        router = ModelRouter(
+            default="gpt-4o-mini",
+            routes={"refinement": "gpt-4o", "generator": "gpt-4o"},
+            escalation={"critique": ("gpt-4o", 0.4, 0.7)},
+        )
+        optimizer = PromptOptimizer(router=router)
+    """
+
+    def __init__(self, default="gpt-4o-mini", routes=None, escalation=None):
+        routes = dict(routes or {})
+        escalation = dict(escalation or {})
+        unknown = (set(routes) | set(escalation)) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages {sorted(unknown)}, expected some of {STAGES}.")
+        unsupported = set(escalation) - set(ESCALATION_STAGES)
+        if unsupported:
+            raise ValueError(
+                f"Stages {sorted(unsupported)} cannot escalate, only {ESCALATION_STAGES} can."
+            )
+        self.default = default
+        self.routes = routes
+        self.escalation = escalation
+
+    @classmethod
+    def from_env(cls, variable="PROMPT_OPTIMIZER_MODELS"):
+        """
+        Builds a router from an environment variable (or the .env file) of comma-separated
+        `stage=model` entries, where `default` sets the default model and a stage of
+        `ESCALATION_STAGES` can escalate with `stage=model>stronger_model@low:high`. Without the
+        variable, every stage uses "gpt-4o-mini".
+
+        Example:
+            PROMPT_OPTIMIZER_MODELS="default=gpt-4o-mini,generator=gpt-4o,critique=gpt-4o-mini>gpt-4o@0.4:0.7"
+        """
+        load_dotenv()
+        default = "gpt-4o-mini"
+        routes = {}
+        escalation = {}
+        for entry in filter(None, (entry.strip() for entry in os.getenv(variable, "").split(","))):
+            stage, _, model = (part.strip() for part in entry.partition("="))
+            if not model:
+                raise ValueError(f"Invalid {variable} entry {entry!r}, expected stage=model.")
+            if ">" in model:
+                model, _, cascade = model.partition(">")
+                strong_model, _, band = cascade.partition("@")
+                low, _, high = band.partition(":")
+                try:
+                    escalation[stage] = (strong_model, float(low), float(high))
+                except ValueError:
+                    raise ValueError(
+                        f"Invalid {variable} entry {entry!r}, expected stage=model>stronger_model@low:high."
+                    ) from None
+            if stage == "default":
+                default = model
+            else:
+                routes[stage] = model
+        return cls(default=default, routes=routes, escalation=escalation)
+
+    def model_name(self, stage, default=None):
+        """
+        Returns the model of `stage`: its route, or `default`, or the default model of the router.
+        """
+        return self.routes.get(stage) or default or self.default
+
+    def escalation_model_name(self, stage):
+        """Returns the stronger model `stage` escalates to, or None if it does not escalate."""
+        escalation = self.escalation.get(stage)
+        return escalation[0] if escalation else None
+
+    def needs_escalation(self, stage, score):
+        """Tells whether a `score` returned at `stage` is ambiguous enough to redo the call."""
+        escalation = self.escalation.get(stage)
+        if escalation is None or score is None:
+            return False
+        _, low, high = escalation
+        return low <= score <= high
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """
+    Returns the process-wide router, created from the environment on first use
+    (see `ModelRouter.from_env`).
+    """
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = ModelRouter.from_env()
+    return _router
+
+
+def set_router(router):
+    """
+    Replaces the process-wide router used by the clients and loops created without one.
+    """
+    global _router
+    with _router_lock:
+        _router = router
@@ -0,0 +1,126 @@
+import re
+
+PATCH_OPERATIONS = ("replace", "insert", "delete")
+
+# JSON schema of the generator response in edit mode
+section_patches_schema = {
+    "title": "SectionPatches",
+    "description": "Edits to apply to the numbered sections of the content, leaving the other sections as they are.",
+    "type": "object",
+    "properties": {
+        "Patches": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "Operation": {
+                        "type": "string",
+                        "enum": list(PATCH_OPERATIONS),
+                        "description": "\"replace\" rewrites section N, \"insert\" adds a new section after section N (0 for the beginning), \"delete\" removes section N."
+                    },
+                    "Section": {
+                        "type": "integer",
+                        "minimum": 0,
+                        "description": "The number N of the section the operation applies to."
+                    },
+                    "Content": {
+                        "type": "string",
+                        "description": "The full new text of the section, empty for \"delete\"."
+                    }
+                },
+                "required": ["Operation", "Section", "Content"]
+            },
+            "description": "The edits, only for the sections that need them. Empty if the content needs no change."
+        }
+    },
+    "required": ["Patches"]
+}
+
+
+def split_sections(content):
+    """
+    Splits content into sections, its blocks separated by blank lines (paragraphs, lists, headings
+    with their text...).
+
+    Parameters:
+    - content: The text to split.
+
+    Returns:
+    - The list of sections, without the blank lines around them.
+    """
+    return [section.strip("\n") for section in re.split(r"\n\s*\n", content) if section.strip()]
+
+
+def join_sections(sections):
+    """
+    Joins sections back into content, separated by blank lines.
+    """
+    return "\n\n".join(sections)
+
+
+def number_sections(sections, indices=None):
+    """
+    Formats sections with their numbers, starting from 1, so that patches can refer to them.
+
+    Parameters:
+    - sections: The list of sections.
+    - indices: Optional indices (from 0) of the only sections to include.
+
+    Returns:
+    - The numbered sections, as a single string.
+    """
+    indices = range(len(sections)) if indices is None else indices
+    return "\n\n".join(f"[{i + 1}]\n{sections[i]}" for i in indices)
+
+
+def apply_patches(sections, patches):
+    """
+    Applies section patches locally. Section numbers refer to `sections` as numbered by
+    `number_sections`, whatever the other patches do: several inserts after the same section
+    keep their order, and a section is replaced or deleted at most once.
+
+    Parameters:
+    - sections: The current list of sections.
+    - patches: Dictionaries with an "Operation", a "Section" number and a "Content", see
+      `section_patches_schema`.
+
+    Returns:
+    - A tuple with the new list of sections, the indices (from 0) of the new or rewritten sections
+      in it, the deleted sections (replacing a section with nothing deletes it) and the patches
+      that could not be applied (unknown operation or section, second edit of a section).
+    """
+    replaced = {}
+    inserted = {}
+    rejected = []
+    for patch in patches:
+        operation, number = patch.get("Operation"), patch.get("Section")
+        if operation not in PATCH_OPERATIONS or not isinstance(number, int):
+            rejected.append(patch)
+        elif operation == "insert" and 0 <= number <= len(sections) and patch.get("Content", "").strip():
+            inserted.setdefault(number, []).append(patch["Content"].strip("\n"))
+        elif operation != "insert" and 1 <= number <= len(sections) and number not in replaced:
+            replaced[number] = None if operation == "delete" else patch.get("Content", "").strip("\n")
+        else:
+            rejected.append(patch)
+
+    new_sections = []
+    changed = []
+    deleted = []
+
+    def add(section, is_change):
+        if is_change:
+            changed.append(len(new_sections))
+        new_sections.append(section)
+
+    for section in inserted.get(0, []):
+        add(section, True)
+    for number, section in enumerate(sections, start=1):
+        if number not in replaced:
+            add(section, False)
+        elif replaced[number] is not None and replaced[number].strip():
+            add(replaced[number], replaced[number] != section)
+        else:
+            deleted.append(section)
+        for inserted_section in inserted.get(number, []):
+            add(inserted_section, True)
+    return new_sections, changed, deleted, rejected
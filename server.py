@@ -0,0 +1,398 @@
+import argparse, asyncio, bisect, itertools, json, os, time
+from collections import OrderedDict
+from http import HTTPStatus
+from urllib.parse import urlsplit
+from cache import cache_key
+from main import get_default_optimizer
+import gan_feedback_loop
+
+# Largest request body accepted, in bytes
+MAX_BODY_SIZE = 1_000_000
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_positive_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 1
+
+
+# Options of `gan_feedback_loop` a job may set, with the check of their value and its description
+GAN_OPTIONS = {
+    "min_score": (_is_number, "a number"),
+    "max_attempts": (_is_positive_integer, "a positive integer"),
+    "stagnation_threshold": (_is_positive_integer, "a positive integer"),
+    "min_change": (lambda value: value is None or (_is_number(value) and 0 <= value <= 1),
+                   "null or a number between 0 and 1"),
+}
+
+
+class HTTPError(Exception):
+    """
+    Error answered to the client with `status` and a JSON `{"error": message}` body.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Coalescer:
+    """
+    Shares one in-flight call between identical concurrent requests: the first request with a
+    given key starts the call, the others await its result instead of making their own.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def run(self, key, make_call):
+        """
+        Returns the result of `make_call()` (a coroutine function), or of the call already
+        running for `key`.
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(make_call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # A client going away must not cancel the call the others are waiting for
+        return await asyncio.shield(task)
+
+
+class GanJob:
+    """
+    A `gan_feedback_loop` run queued by the server, with the events it produced so far.
+
+    Events are kept as `(event id, event)` pairs. The token events of an attempt are dropped once
+    its "generation" event, which holds the whole content, arrives (or the job ends), so a job
+    keeps a few events per attempt rather than one per token. Ids are not reused: a client
+    resuming after a dropped token event continues from the generation.
+    """
+
+    def __init__(self, job_id, prompt, options):
+        self.id = job_id
+        self.prompt = prompt
+        self.options = options
+        self.status = "queued"
+        self.events = []
+        self.event_count = 0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self._changed = asyncio.Condition()
+
+    async def add_event(self, event):
+        async with self._changed:
+            if event["type"] == "generation":
+                self._drop_tokens()
+            self.events.append((self.event_count, event))
+            self.event_count += 1
+            self._changed.notify_all()
+
+    def _drop_tokens(self):
+        # The token events of the current attempt are the last events
+        while self.events and self.events[-1][1]["type"] == "token":
+            self.events.pop()
+
+    async def finish(self, status, result=None, error=None):
+        async with self._changed:
+            self._drop_tokens()
+            self.status = status
+            self.result = result
+            self.error = error
+            self._changed.notify_all()
+
+    @property
+    def done(self):
+        return self.status in ("done", "error")
+
+    async def wait_events(self, start):
+        """
+        Waits until there are events from id `start` or the job is done, and returns them as
+        `(event id, event)` pairs.
+        """
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.event_count > start or self.done)
+            return self.events[bisect.bisect_left(self.events, start, key=lambda pair: pair[0]):]
+
+    def to_dict(self):
+        scores = [event["score"] for _, event in self.events if event["type"] == "critique"]
+        return {
+            "id": self.id,
+            "status": self.status,
+            "attempt": max((event["attempt"] for _, event in self.events if "attempt" in event), default=0),
+            "scores": scores,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class PromptOptimizerServer:
+    """
+    Asynchronous HTTP service exposing the optimizer and the GAN feedback loop.
+
+    Endpoints (JSON bodies):
+        POST /critique   {"prompt"}                            -> critique
+        POST /optimize   {"prompt", "context", "answers"}      -> optimized prompt and Q&A pairs
+        POST /benchmark  {"prompt", "answers"}                 -> `optimize_and_benchmark` result
+        POST /gan        {"prompt", "min_score", ...}          -> 202 with the job id
+        GET  /gan/<id>                                         -> job status, scores and result
+        GET  /gan/<id>/events                                  -> Server-Sent Events of the job
+        GET  /health                                           -> queue and coalescing statistics
+
+    Clarifying questions are never asked interactively: `answers` is a dict of question to answer,
+    or "skip" (the default). Identical concurrent requests share a single upstream call, and
+    identical GAN submissions share the same job while it is queued or running.
+
+    Args:
+        optimizer (main.PromptOptimizer, optional): Defaults to the process-wide optimizer.
+        generator_llm (optional): Generator of the GAN jobs, defaults to `gan_feedback_loop.get_generator_llm()`.
+        critic_llm (optional): Critic of the GAN jobs, defaults to `gan_feedback_loop.get_critic_llm()`.
+        max_jobs (int): Number of GAN jobs running at the same time, the others wait in the queue.
+        max_finished_jobs (int): Number of finished jobs kept for polling.
+    """
+
+    def __init__(self, optimizer=None, generator_llm=None, critic_llm=None, max_jobs=4, max_finished_jobs=1000):
+        self.optimizer = optimizer or get_default_optimizer()
+        scheduled = self.optimizer.scheduler is not None
+        self.generator_llm = generator_llm or gan_feedback_loop.get_generator_llm(scheduled=scheduled)
+        self.critic_llm = critic_llm or gan_feedback_loop.get_critic_llm(scheduled=scheduled)
+        self.max_jobs = max_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self.coalescer = Coalescer()
+        self.jobs = OrderedDict()
+        self._job_ids = itertools.count(1)
+        self._active_jobs = {}
+        self._queue = None
+        self._workers = []
+
+    # Request handlers
+
+    async def critique(self, body):
+        prompt = _required(body, "prompt")
+        return await self.coalescer.run(
+            cache_key("critique", prompt), lambda: self.optimizer.acritique_prompt(prompt)
+        )
+
+    async def optimize(self, body):
+        prompt = _required(body, "prompt")
+        context = body.get("context")
+        answers = _answers(body)
+
+        async def call():
+            optimized_prompt, qa_pairs = await self.optimizer.aoptimize_prompt(prompt, context=context, answers=answers)
+            return {"optimized_prompt": optimized_prompt, "qa_pairs": qa_pairs}
+
+        return await self.coalescer.run(cache_key("optimize", prompt, context, answers), call)
+
+    async def benchmark(self, body):
+        prompt = _required(body, "prompt")
+        answers = _answers(body)
+        return await self.coalescer.run(
+            cache_key("benchmark", prompt, answers),
+            lambda: self.optimizer.aoptimize_and_benchmark(prompt, answers=answers),
+        )
+
+    async def submit_gan(self, body):
+        prompt = _required(body, "prompt")
+        options = {name: body[name] for name in GAN_OPTIONS if name in body}
+        for name, value in options.items():
+            is_valid, expected = GAN_OPTIONS[name]
+            if not is_valid(value):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name!r} must be {expected}.")
+        key = cache_key("gan", prompt, options)
+        job = self._active_jobs.get(key)
+        if job is None:
+            job = GanJob(str(next(self._job_ids)), prompt, options)
+            self.jobs[job.id] = job
+            self._active_jobs[key] = job
+            self._forget_finished_jobs()
+            await self._queue.put((key, job))
+        return {"id": job.id, "status": job.status}
+
+    def job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown job {job_id}.")
+        return job
+
+    def health(self):
+        return {
+            "queued_jobs": self._queue.qsize(),
+            "active_jobs": len(self._active_jobs),
+            "upstream_calls": self.coalescer.calls,
+            "coalesced_requests": self.coalescer.coalesced,
+        }
+
+    # GAN job queue
+
+    async def _run_jobs(self):
+        while True:
+            key, job = await self._queue.get()
+            job.status = "running"
+            try:
+                async for event in gan_feedback_loop.agan_feedback_loop_stream(
+                    self.generator_llm, self.critic_llm, job.prompt, scheduler=self.optimizer.scheduler,
+                    **job.options
+                ):
+                    if event["type"] == "result":
+                        await job.finish("done", result=event["result"])
+                    else:
+                        await job.add_event(event)
+            except Exception as e:
+                await job.finish("error", error=f"{type(e).__name__}: {e}")
+            finally:
+                self._active_jobs.pop(key, None)
+                self._queue.task_done()
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        """Serves one request per connection."""
+        try:
+            method, path, headers, body = await _read_request(reader)
+            route = urlsplit(path).path.rstrip("/").split("/")[1:]
+            if route[:1] == ["gan"] and len(route) == 3 and route[2] == "events" and method == "GET":
+                await self._stream_events(writer, self.job(route[1]), headers)
+                return
+            payload = await self._dispatch(method, route, body)
+            status = HTTPStatus.ACCEPTED if route == ["gan"] else HTTPStatus.OK
+            await _send_json(writer, status, payload)
+        except HTTPError as e:
+            await _send_json(writer, e.status, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            await _send_json(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"})
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, route, body):
+        handlers = {
+            ("POST", "critique"): self.critique,
+            ("POST", "optimize"): self.optimize,
+            ("POST", "benchmark"): self.benchmark,
+            ("POST", "gan"): self.submit_gan,
+        }
+        if route == ["health"] and method == "GET":
+            return self.health()
+        if len(route) == 2 and route[0] == "gan" and method == "GET":
+            return self.job(route[1]).to_dict()
+        handler = handlers.get((method, "/".join(route)))
+        if handler is None:
+            if any(path == "/".join(route) for _, path in handlers):
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} is not allowed here.")
+            raise HTTPError(HTTPStatus.NOT_FOUND, "Not found.")
+        return await handler(_json_body(body))
+
+    async def _stream_events(self, writer, job, headers):
+        # Resumes after the last event the client received, if it reconnects
+        try:
+            start = int(headers.get("last-event-id", -1)) + 1
+        except ValueError:
+            start = 0
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        while True:
+            events = await job.wait_events(start)
+            for event_id, event in events:
+                writer.write(f"id: {event_id}\ndata: {json.dumps(event)}\n\n".encode())
+            if events:
+                start = events[-1][0] + 1
+            await writer.drain()
+            if job.done and start >= job.event_count:
+                break
+        final = {"type": job.status, "result": job.result, "error": job.error}
+        writer.write(f"event: end\ndata: {json.dumps(final)}\n\n".encode())
+        await writer.drain()
+
+    async def start(self, host="127.0.0.1", port=8000):
+        """Starts the job workers and the HTTP server, and returns the `asyncio.Server`."""
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._run_jobs()) for _ in range(self.max_jobs)]
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def serve_forever(self, host="127.0.0.1", port=8000):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def _required(body, name):
+    value = body.get(name)
+    if not isinstance(value, str) or not value:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Missing {name!r}.")
+    return value
+
+
+def _answers(body):
+    answers = body.get("answers", "skip")
+    if answers != "skip" and not isinstance(answers, dict):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "'answers' must be \"skip\" or an object of question to answer.")
+    return answers
+
+
+def _json_body(body):
+    try:
+        body = json.loads(body or b"{}")
+    except json.JSONDecodeError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "The body is not valid JSON.") from None
+    if not isinstance(body, dict):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "The body must be a JSON object.")
+    return body
+
+
+async def _read_request(reader):
+    request_line = (await reader.readline()).decode("latin-1").split()
+    if len(request_line) != 3:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line.")
+    method, path, _ = request_line
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length.") from None
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "The body is too large.")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), path, headers, body
+
+
+async def _send_json(writer, status, payload):
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve prompt optimization, critique and GAN runs over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-jobs", type=int, default=4, help="Number of GAN jobs running at the same time")
+    parser.add_argument("--fake", action="store_true", help="Use the offline fake model backend")
+    args = parser.parse_args()
+
+    if args.fake:
+        os.environ["PROMPT_OPTIMIZER_BACKEND"] = "fake"
+    print(f"Serving on http://{args.host}:{args.port}")
+    asyncio.run(PromptOptimizerServer(max_jobs=args.max_jobs).serve_forever(args.host, args.port))
@@ -0,0 +1,222 @@
+import argparse, asyncio, csv, itertools, json, math, os, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from batch import load_prompts
+from cache import cache_key
+from models import make_chat_model
+from ratelimit import BATCH, RateLimitScheduler, priority
+from routing import get_router
+import gan_feedback_loop
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet output is optional, CSV is always available
+    pyarrow = None
+
+# Parameters of `gan_feedback_loop` a sweep can vary
+SWEEP_PARAMETERS = ("min_score", "max_attempts", "stagnation_threshold")
+
+COLUMNS = (
+    "request_id", *SWEEP_PARAMETERS, "reason_to_stop", "final_score", "iterations", "skipped_critiques",
+    "calls", "prompt_tokens", "completion_tokens", "cost", "duration", "error",
+)
+
+
+def sweep_cells(prompts, grid):
+    """
+    Builds the cells of a sweep, every prompt crossed with every combination of parameters.
+
+    Args:
+        prompts (iterable): `(request_id, prompt)` tuples, see `batch.load_prompts`.
+        grid (dict): Values to try per parameter, e.g. `{"min_score": [80, 90], "max_attempts": [4, 6]}`.
+
+    Returns:
+        tuple: The list of `(request_id, prompt, params)` cells, and a dict mapping the key of every
+        distinct cell (same prompt text and parameters) to one of them, so that duplicates run once.
+    """
+    names = list(grid)
+    cells = []
+    distinct = {}
+    for request_id, prompt in prompts:
+        for values in itertools.product(*(grid[name] for name in names)):
+            params = dict(zip(names, values))
+            cells.append((request_id, prompt, params))
+            distinct.setdefault(cache_key(prompt, params), (prompt, params))
+    return cells, distinct
+
+
+# Rate limit scheduler of the worker process, shared by all its chunks, see `_init_worker`
+_scheduler = None
+
+
+def _init_worker(requests_per_minute=None, tokens_per_minute=None):
+    """
+    Initializes a worker process of the sweep with its share of the quota. The scheduler lives as
+    long as the process, so that its chunks share one budget instead of each starting with a
+    full minute of it.
+    """
+    global _scheduler
+    _scheduler = None
+    if requests_per_minute or tokens_per_minute:
+        _scheduler = RateLimitScheduler(
+            requests_per_minute=requests_per_minute or 500, tokens_per_minute=tokens_per_minute or 200_000
+        )
+
+
+async def _run_cell(prompt, params, semaphore, scheduler, generator_llm, critic_llm):
+    start = time.perf_counter()
+    async with semaphore:
+        try:
+            result = await gan_feedback_loop.agan_feedback_loop(
+                generator_llm, critic_llm, prompt, scheduler=scheduler, **params
+            )
+        except Exception as e:
+            return {"duration": time.perf_counter() - start, "error": f"{type(e).__name__}: {e}"}
+    metrics = result["Metrics"]
+    return {
+        "reason_to_stop": result["ReasonToStop"],
+        "final_score": result["FinalScore"],
+        "iterations": result["Iterations"],
+        "skipped_critiques": result["SkippedCritiques"],
+        "calls": metrics["calls"],
+        "prompt_tokens": metrics["prompt_tokens"],
+        "completion_tokens": metrics["completion_tokens"],
+        "cost": metrics["cost"],
+        "duration": time.perf_counter() - start,
+        "error": None,
+    }
+
+
+def _run_cells(cells, concurrency):
+    """
+    Runs a chunk of distinct cells in a worker process, on its own event loop, within the quota
+    of the process scheduler.
+
+    Returns:
+        dict: The outcome of every cell, by cell key.
+    """
+    scheduler = _scheduler
+
+    async def run():
+        # Models of this event loop: their async HTTP clients cannot be shared with the loops of
+        # the other chunks, unlike the cached ones of `gan_feedback_loop`
+        router = get_router()
+        generator_llm = make_chat_model(router.model_name("generator"), scheduled=scheduler is not None)
+        critic_llm = make_chat_model(
+            router.model_name("critic"), scheduled=scheduler is not None
+        ).with_structured_output(gan_feedback_loop.json_schema)
+        semaphore = asyncio.Semaphore(concurrency)
+        with priority(BATCH):
+            outcomes = await asyncio.gather(*(
+                _run_cell(prompt, params, semaphore, scheduler, generator_llm, critic_llm)
+                for _, (prompt, params) in cells
+            ))
+        return {key: outcome for (key, _), outcome in zip(cells, outcomes)}
+
+    return asyncio.run(run())
+
+
+def run_sweep(prompts, grid, processes=None, concurrency=8, chunk_size=None, requests_per_minute=None,
+              tokens_per_minute=None):
+    """
+    Runs `gan_feedback_loop` over every (prompt x parameters) cell of a sweep.
+
+    Distinct cells are spread over a pool of processes, each running up to `concurrency` loops
+    concurrently on its own event loop. Identical cells (same prompt text and parameters) run once.
+
+    Args:
+        prompts (iterable): `(request_id, prompt)` tuples, see `batch.load_prompts`.
+        grid (dict): Values to try per parameter, see `sweep_cells` and `SWEEP_PARAMETERS`.
+        processes (int, optional): Number of worker processes. Defaults to the number of CPUs, or
+            fewer so that each process gets at least one request per minute of the quota.
+        concurrency (int): Number of loops running at the same time in each process.
+        chunk_size (int, optional): Number of cells sent to a process at once. Defaults to an
+            even split in four chunks per process, so that slow chunks do not hold the sweep back.
+        requests_per_minute (int, optional): Request quota of the whole sweep, split between processes.
+        tokens_per_minute (int, optional): Token quota of the whole sweep, split between processes.
+
+    Raises:
+        ValueError: If a quota is too small to give each of the `processes` a share of it.
+
+    Returns:
+        list: One row per cell, with the `COLUMNS` of the sweep results.
+    """
+    unknown = set(grid) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters {sorted(unknown)}, expected some of {SWEEP_PARAMETERS}.")
+    cells, distinct = sweep_cells(prompts, grid)
+    if processes is None:
+        processes = min(os.cpu_count() or 1, requests_per_minute or math.inf)
+    for name, limit in (("requests_per_minute", requests_per_minute), ("tokens_per_minute", tokens_per_minute)):
+        if limit is not None and limit < processes:
+            raise ValueError(f"{name} ({limit}) must be at least the number of processes ({processes}).")
+    items = list(distinct.items())
+    chunk_size = chunk_size or max(1, -(-len(items) // (processes * 4)))
+    quota = (
+        requests_per_minute and requests_per_minute // processes,
+        tokens_per_minute and tokens_per_minute // processes,
+    )
+
+    outcomes = {}
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=quota) as executor:
+        futures = [
+            executor.submit(_run_cells, items[i:i + chunk_size], concurrency)
+            for i in range(0, len(items), chunk_size)
+        ]
+        for future in as_completed(futures):
+            outcomes.update(future.result())
+
+    rows = []
+    for request_id, prompt, params in cells:
+        row = dict.fromkeys(COLUMNS)
+        row.update(request_id=request_id, **params, **outcomes[cache_key(prompt, params)])
+        rows.append(row)
+    return rows
+
+
+def write_results(rows, output_path):
+    """
+    Writes the sweep rows to `output_path`: a Parquet file if it ends with ".parquet"
+    (requires pyarrow), a CSV file otherwise.
+    """
+    if output_path.endswith(".parquet"):
+        if pyarrow is None:
+            raise ValueError("Writing Parquet files requires pyarrow, use a .csv output instead.")
+        table = pyarrow.table({column: [row[column] for row in rows] for column in COLUMNS})
+        pyarrow.parquet.write_table(table, output_path)
+        return
+    with open(output_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep gan_feedback_loop parameters over a JSONL corpus of prompts.")
+    parser.add_argument("input_path", help="JSONL file with one prompt per line")
+    parser.add_argument("output_path", help="Results file, .csv or .parquet")
+    parser.add_argument("--min-score", type=int, nargs="+", default=[85])
+    parser.add_argument("--max-attempts", type=int, nargs="+", default=[6])
+    parser.add_argument("--stagnation-threshold", type=int, nargs="+", default=[3])
+    parser.add_argument("--processes", type=int, help="Number of worker processes (defaults to the CPU count)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Loops running at the same time per process")
+    parser.add_argument("--rpm", type=int, help="Requests per minute quota of the whole sweep")
+    parser.add_argument("--tpm", type=int, help="Tokens per minute quota of the whole sweep")
+    args = parser.parse_args()
+
+    grid = {
+        "min_score": args.min_score,
+        "max_attempts": args.max_attempts,
+        "stagnation_threshold": args.stagnation_threshold,
+    }
+    start = time.perf_counter()
+    rows = run_sweep(
+        load_prompts(args.input_path), grid, processes=args.processes, concurrency=args.concurrency,
+        requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+    )
+    write_results(rows, args.output_path)
+    print(json.dumps({
+        "cells": len(rows),
+        "errors": sum(1 for row in rows if row["error"]),
+        "duration": time.perf_counter() - start,
+    }, indent=4))
@@ -0,0 +1,71 @@
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken ships with langchain_openai, but keep counting usable without it
+    tiktoken = None
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # The encoding files could not be loaded (e.g. no network access)
+        return None
+
+
+def count_tokens(text, model="gpt-4o-mini"):
+    """
+    Counts the tokens of `text` for `model`.
+
+    Uses tiktoken when available, otherwise falls back to the usual estimate of
+    four characters per token.
+
+    Args:
+        text (str): The text to measure.
+        model (str): The model whose tokenizer is used.
+
+    Returns:
+        int: The number of tokens.
+    """
+    encoding = _encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, max_tokens, model="gpt-4o-mini"):
+    """
+    Shortens `text` to about `max_tokens` tokens, deterministically: the beginning and the end
+    are kept and the middle is replaced by a marker telling how many tokens were removed.
+
+    Args:
+        text (str): The text to shorten.
+        max_tokens (int): The token budget of the result.
+        model (str): The model whose tokenizer is used.
+
+    Returns:
+        str: `text` itself if it fits the budget, otherwise its shortened version.
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    encoding = _encoding(model)
+    if encoding is None:
+        # Work on characters, four per token
+        units, decode, scale = text, "".join, 4
+    else:
+        units, decode, scale = encoding.encode(text, disallowed_special=()), encoding.decode, 1
+    # The marker takes about 12 tokens of the budget; two thirds of the rest go to the beginning
+    keep = max(0, (max_tokens - 12) * scale)
+    head = keep * 2 // 3
+    tail = keep - head
+    removed = (len(units) - keep) // scale
+    marker = f"\n[... {removed} tokens truncated ...]\n"
+    return decode(units[:head]) + marker + (decode(units[len(units) - tail:]) if tail else "")